@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+'''
+Answer files that describe an install, written by the wizard or by hand for unattended installs.
+
+An answer file is JSON with the target disk, the user to create, the timezone, keymap
+and locale, and the pool options, for example:
+
+    {
+        "disk": "/dev/nvme0n1",
+        "user": {"name": "maloney", "password": "secret"},
+        "timezone": "America/New_York",
+        "keymap": "us",
+        "pool": {"name": "zroot", "compression": "zstd"}
+    }
+
+A pool across several disks lists them in "disks" instead and picks a pool layout, fast
+devices can be added as special, log or cache vdevs:
+
+    "disks": ["/dev/sda", "/dev/sdb"],
+    "pool": {"layout": "mirror", "special": ["/dev/nvme0n1"]}
+
+Everything except the disk and the user has a default. The pool ashift and compression
+default to auto, tuning.py then picks them for the disk. The whole file is checked before
+the install starts and every problem is reported at once.
+'''
+
+import copy
+import glob
+import json
+import os
+import re
+import stat
+
+# Where the wizard leaves the answers for the backend
+WIZARD_ANSWERS = "/tmp/maloneyos-answers.json"
+
+DEFAULTS = {
+    "timezone": "America/New_York",
+    "keymap": "de_CH-latin1",
+    "locale": "en_US.UTF-8",
+    # HTTP server to install from instead of the boot media, see netsource.py
+    "server": None,
+    "pool": {
+        "name": "zroot",
+        "ashift": "auto",
+        "compression": "auto",
+        "autotrim": True,
+        "layout": "stripe",
+        "special": [],
+        "log": [],
+        "cache": [],
+    },
+}
+
+KEYS = {"disk", "disks", "user", "timezone", "keymap", "locale", "server", "pool"}
+USER_KEYS = {"name", "password", "password_hash"}
+POOL_KEYS = set(DEFAULTS["pool"])
+# Pool layouts and how many disks each needs at least
+LAYOUTS = {"stripe": 1, "mirror": 2, "raidz": 3, "raidz2": 4, "raidz3": 5}
+
+# Optional vdevs on whole disks of their own, next to the disks the pool stores data on
+AUX_VDEVS = ("special", "log", "cache")
+
+COMPRESSION = {"off", "on", "lz4", "zstd", "gzip", "lzjb", "zle"} | {f"zstd-{level}" for level in range(1, 20)} | {f"gzip-{level}" for level in range(1, 10)}
+
+# Names the live system or the base system already use
+RESERVED_USERS = {"root", "archie", "bin", "daemon", "mail", "ftp", "http", "nobody", "dbus"}
+
+class AnswerError(ValueError):
+    '''
+    An answer file that cannot be installed from, with every problem found in it.
+    '''
+    def __init__(self, problems):
+        super().__init__("Invalid answers:\n" + "\n".join(f"  - {problem}" for problem in problems))
+        self.problems = problems
+
+def _merge(answers):
+    '''
+    The answers with every missing optional value filled in from the defaults.
+    '''
+    merged = copy.deepcopy(DEFAULTS)
+    for key, value in answers.items():
+        if key == "pool" and isinstance(value, dict):
+            merged["pool"].update(value)
+        else:
+            merged[key] = value
+    return merged
+
+def _check_user(user, problems):
+    '''
+    Check the user section of the answers.
+    '''
+    if not isinstance(user, dict):
+        problems.append("user must be an object with a name and a password")
+        return
+    problems.extend(f"unknown user key: {key}" for key in sorted(set(user) - USER_KEYS))
+    name = user.get("name", "")
+    if not isinstance(name, str) or not re.fullmatch(r"[a-z_][a-z0-9_-]{0,31}", name):
+        problems.append(f"user name {name!r} is not a valid login name")
+    elif name in RESERVED_USERS:
+        problems.append(f"user name {name!r} is reserved")
+    if ("password" in user) == ("password_hash" in user):
+        problems.append("user needs exactly one of password and password_hash")
+    elif not isinstance(user.get("password", user.get("password_hash")), str) or not user.get("password", user.get("password_hash")):
+        problems.append("user password must be a non-empty string")
+
+def check_layout(layout, count):
+    '''
+    Why a pool layout does not work with this many disks, None when it does.
+    '''
+    if layout not in LAYOUTS:
+        return f"pool layout {layout!r} must be one of {', '.join(LAYOUTS)}"
+    if count < LAYOUTS[layout]:
+        return f"pool layout {layout} needs at least {LAYOUTS[layout]} disks"
+    return None
+
+def _check_disks(merged, problems, check_system):
+    '''
+    Check the disks of the pool and its optional vdevs, every disk may only be used once.
+    '''
+    roles = {"disks": merged["disks"]}
+    if isinstance(merged["pool"], dict):
+        roles.update((role, merged["pool"].get(role, [])) for role in AUX_VDEVS)
+    used = set()
+    for role, paths in roles.items():
+        if not isinstance(paths, list):
+            problems.append(f"{role} must be a list of /dev paths")
+            continue
+        for disk in paths:
+            if not isinstance(disk, str) or not disk.startswith("/dev/"):
+                problems.append(f"disk {disk!r} must be a /dev path")
+                continue
+            if disk in used:
+                problems.append(f"disk {disk} is used more than once")
+            elif check_system and (not os.path.exists(disk) or not stat.S_ISBLK(os.stat(disk).st_mode)):
+                problems.append(f"disk {disk} is not a block device")
+            used.add(disk)
+    if isinstance(merged["disks"], list) and not merged["disks"]:
+        problems.append("disks must list at least one disk")
+    elif isinstance(merged["disks"], list) and isinstance(merged["pool"], dict):
+        problem = check_layout(merged["pool"]["layout"], len(merged["disks"]))
+        if problem:
+            problems.append(problem)
+
+def _check_pool(pool, problems):
+    '''
+    Check the pool section of the answers.
+    '''
+    if not isinstance(pool, dict):
+        problems.append("pool must be an object")
+        return
+    problems.extend(f"unknown pool key: {key}" for key in sorted(set(pool) - POOL_KEYS))
+    if not isinstance(pool["name"], str) or not re.fullmatch(r"[A-Za-z][A-Za-z0-9_.:-]*", pool["name"]):
+        problems.append(f"pool name {pool['name']!r} is not a valid pool name")
+    if pool["ashift"] != "auto" and (not isinstance(pool["ashift"], int) or isinstance(pool["ashift"], bool) or not 9 <= pool["ashift"] <= 16):
+        problems.append(f"pool ashift {pool['ashift']!r} must be auto or a number from 9 to 16")
+    if pool["compression"] != "auto" and pool["compression"] not in COMPRESSION:
+        problems.append(f"pool compression {pool['compression']!r} is not supported")
+    if not isinstance(pool["autotrim"], bool):
+        problems.append("pool autotrim must be true or false")
+
+def _check_server(server, problems):
+    '''
+    Check the install server, if there is one.
+    '''
+    if server is not None and (not isinstance(server, str) or not re.fullmatch(r"https?://[^\s/]+(/\S*)?", server)):
+        problems.append(f"server {server!r} must be an http:// or https:// URL")
+
+def validate(answers, check_system=True):
+    '''
+    Check answers and return them with the defaults filled in, raising AnswerError on any problem.
+    With check_system the disk, timezone and keymap are also checked against this machine.
+    '''
+    if not isinstance(answers, dict):
+        raise AnswerError(["the answers must be a JSON object"])
+    problems = [f"unknown key: {key}" for key in sorted(set(answers) - KEYS)]
+    if "disk" not in answers and "disks" not in answers:
+        problems.append("missing disk")
+    elif "disk" in answers and "disks" in answers:
+        problems.append("use either disk or disks, not both")
+    if "user" not in answers:
+        problems.append("missing user")
+    merged = _merge(answers)
+
+    # A single disk is the same as a list of one, the first disk is the one the install is known by
+    if "disk" in merged and "disks" not in merged:
+        merged["disks"] = [merged["disk"]]
+    if "disks" in merged:
+        _check_disks(merged, problems, check_system)
+        if isinstance(merged["disks"], list) and merged["disks"]:
+            merged["disk"] = merged["disks"][0]
+    if "user" in merged:
+        _check_user(merged["user"], problems)
+    _check_pool(merged["pool"], problems)
+
+    if not isinstance(merged["locale"], str) or not re.fullmatch(r"[A-Za-z_@]+\.[A-Za-z0-9-]+", merged["locale"]):
+        problems.append(f"locale {merged['locale']!r} must look like en_US.UTF-8")
+    _check_server(merged["server"], problems)
+    if check_system and not os.path.isfile(os.path.join("/usr/share/zoneinfo", str(merged["timezone"]))):
+        problems.append(f"timezone {merged['timezone']!r} does not exist")
+    if check_system and os.path.isdir("/usr/share/kbd/keymaps") and not glob.glob(f"/usr/share/kbd/keymaps/**/{glob.escape(str(merged['keymap']))}.map*", recursive=True):
+        problems.append(f"keymap {merged['keymap']!r} does not exist")
+
+    if problems:
+        raise AnswerError(problems)
+    return merged
+
+def load(path, check_system=True):
+    '''
+    Read and validate an answer file.
+    '''
+    try:
+        with open(path, encoding="utf-8") as f:
+            answers = json.load(f)
+    except OSError as e:
+        raise AnswerError([f"cannot read {path}: {e.strerror}"]) from e
+    except ValueError as e:
+        raise AnswerError([f"{path} is not valid JSON: {e}"]) from e
+    return validate(answers, check_system)
+
+def save(path, answers):
+    '''
+    Write an answer file only root can read, it holds the password.
+    '''
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+        json.dump(answers, f, indent=2)
+        f.write("\n")
+
+# End-of-file (EOF)
@@ -2,25 +2,155 @@
 
 """
 Backend script that will process information collected during the install wizard and install.
+
+The wizard saves its selections as an answer file, answer files written by hand run the
+same install unattended: backend.py --answers install.json --summary -
 """
 
+import argparse
+import concurrent.futures
+import json
 import os
+import re
 import shutil
+import struct
 import subprocess
+import sys
+import tempfile
+import time
+
+import answers
+import chroot
+import disks
+import events
+import extract
+import factoryreset
+import journal
+import netsource
+import receive
+import scheduler
+import tuning
 
 MNT = "/tmp/maloneyos"
+
+# Where the live system has the boot media mounted
+BOOTMNT = "/run/archiso/bootmnt"
+
+# Largest swap partition in GiB, the partition gets half the RAM up to this, 0 turns it off
 SWAPSIZE = 4
+
+# Pool space in GiB held back by a reservation so the pool never fills up completely
 RESERVE = 1
 
-# Use 'with' statement for file operations
-with open("/tmp/selected-disk", encoding="utf-8") as disk_file:
-    DISK = disk_file.read().strip()
+# Memory limits of the ARC as a percentage of RAM so it does not fight the desktop for memory
+ARC_MIN_PERCENT = 6
+ARC_MAX_PERCENT = 25
+
+# Compressed swap in RAM used before the swap partition, size as a zram-generator expression
+ZRAM_SIZE = "min(ram / 2, 8192)"
+ZRAM_CONFIG = "etc/systemd/zram-generator.conf"
+ZFS_MODPROBE_CONFIG = "etc/modprobe.d/zfs.conf"
+
+# Extraction engine settings, run extract.py --benchmark to pick the fastest strategy
+EXTRACT_STRATEGY = "unsquashfs"
+EXTRACT_PROCESSORS = None
+EXTRACT_MEMORY = None
+
+# How the root filesystem is laid down: "auto" receives the zfs send stream when the ISO
+# has one and extracts the squashfs otherwise, "extract" always extracts
+INSTALL_METHOD = "auto"
+
+# Properties of the root dataset received from a send stream
+RECEIVE_PROPERTIES = {"mountpoint": "/", "canmount": "noauto"}
+
+# Where the squashfs downloaded from an install server is kept until it is extracted, in the target
+NETWORK_IMAGE = ".maloneyos-airootfs.sfs"
+
+# The generic zfs initramfs the ISO build made, "prebuilt" copies it into place and "build"
+# runs mkinitcpio -P during the install. With INITRAMFS_FIRST_BOOT the installed system
+# builds its autodetect image in the background on first boot.
+INITRAMFS = "prebuilt"
+PREBUILT_INITRAMFS = "/usr/lib/maloneyos/initramfs-linux-lts.img"
+INITRAMFS_FIRST_BOOT = True
+
+# Offline Flatpak repo the ISO build can put on the boot media, relative to it
+FLATPAK_BUNDLE = "flatpak"
+
+# Snapshot of the finished root dataset that the reset tool clones into a fresh boot environment
+FACTORY_SNAPSHOT = "factory"
+FACTORY_HOLD = "maloneyos-factory"
+RESET_TOOL = "usr/local/bin/maloneyos-reset"
+
+# Packages the ISO build made from its own DKMS output, only the live system may keep them
+BUILD_PACKAGE_PREFIX = "zfs-dkms-built-"
+
+# How many independent install steps may run at the same time
+MAX_PARALLEL_STEPS = 4
+
+# Step timing report written on the installed system
+TIMING_REPORT = "/var/log/maloneyos/install-timings.json"
+
+# Exit status of the backend: installed, install failed, answers rejected before starting
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_INVALID = 2
+
+class Install:
+    """
+    State shared by the install steps, the validated answers and the chroot session.
+    """
+    def __init__(self, selection, mnt=MNT, pool=None):
+        self.disk = selection["disk"]
+        self.disks = selection["disks"]
+        self.layout = selection["pool"]["layout"]
+        self.aux = {role: selection["pool"][role] for role in answers.AUX_VDEVS}
+        self.username = selection["user"]["name"]
+        self.password = selection["user"].get("password")
+        self.password_hash = selection["user"].get("password_hash")
+        self.timezone = selection["timezone"]
+        self.keymap = selection["keymap"]
+        self.locale = selection["locale"]
+        # The pool is created as pool_name on disk, pool is the name it has while installing.
+        # Concurrent installs give every pool a temporary name so they do not collide.
+        self.pool_name = selection["pool"]["name"]
+        self.pool = pool or self.pool_name
+        self.pool_options = selection["pool"]
+        self.mnt = mnt
+        # Boot media, root filesystem image and send stream, the image and stream are found
+        # on the live system when left unset
+        self.bootmnt = BOOTMNT
+        self.source = None
+        self.stream = None
+        # HTTP install server from the answers, netsource.Source once detect_media reached it
+        self.server = selection["server"]
+        self.netsource = None
+        # Whether this is the only install on the machine and may export every pool and
+        # add boot entries, multi.py runs several installs that only touch their own pool
+        self.exclusive = True
+        # Shared reading of the image when multi.py installs to several disks at once
+        self.fanout = None
+        self.session = None
+        self.journal = journal.Journal(self.pool, self.disk)
+        self.events = events.EventLog()
+
+def all_disks(ctx):
+    """
+    Every disk the install writes to, the pool's disks followed by those of its optional vdevs.
+    """
+    return ctx.disks + [disk for role in answers.AUX_VDEVS for disk in ctx.aux[role]]
 
-with open("/tmp/username", encoding="utf-8") as username_file:
-    USERNAME = username_file.read().strip()
+def efi_disks(ctx):
+    """
+    Disks that get an EFI partition to boot from, every member of a redundant pool.
+    """
+    return ctx.disks if ctx.layout != "stripe" else [ctx.disk]
 
-with open("/tmp/password", encoding="utf-8") as password_file:
-    PASSWORD = password_file.read().strip()
+def each_disk(function, items):
+    """
+    Call function for every disk at the same time and return the results in order.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(items), 1)) as executor:
+        return list(executor.map(function, items))
 
 def get_iso_device():
     '''
@@ -39,13 +169,20 @@ def get_iso_device():
         print(f"Error: {e}")
         return None
 
-def detect_media():
+def detect_media(ctx):
     '''
     This function will get iso device if bootmnt is not mounted.
     '''
+    # Installing from a server needs no boot media
+    if ctx.server:
+        if ctx.netsource is None:
+            ctx.netsource = netsource.Source(ctx.server)
+        print(f"Installing from {ctx.server}")
+        return
+
     try:
-        # Check if /run/archiso/bootmnt exists
-        bootmnt_path = '/run/archiso/bootmnt'
+        # Check if the boot media mount exists
+        bootmnt_path = ctx.bootmnt
 
         if os.path.exists(bootmnt_path):
             print(f"{bootmnt_path} already exists. Skipping operation.")
@@ -57,11 +194,11 @@ def detect_media():
         if iso_device:
             print(f"The ISO device is: {iso_device}")
 
-            # Create /run/archiso/bootmnt directory
+            # Create the boot media directory
             os.makedirs(bootmnt_path, exist_ok=True)
             print(f"Created directory: {bootmnt_path}")
 
-            # Mount the ISO device to /run/archiso/bootmnt
+            # Mount the ISO device on the boot media directory
             subprocess.run(['mount', iso_device, bootmnt_path], check=True)
             print(f"Mounted {iso_device} to {bootmnt_path}")
 
@@ -76,136 +213,413 @@ def detect_media():
     except PermissionError as e:
         print(f"Permission error: {e}")
 
-def cleanup():
+def release_mounts(ctx):
+    """
+    Unmount anything an earlier attempt left mounted inside the mount directory.
+    """
+    mnt = ctx.mnt
+
+    # Make mount directory if it does not exist
+    if not os.path.isdir(mnt):
+        os.mkdir(mnt)
+
+    # Unmount file systems if they are mounted
+    if os.path.ismount(f"{mnt}/dev"):
+        subprocess.run(["umount", f"{mnt}/dev"], check=True)
+    if os.path.ismount(f"{mnt}/proc"):
+        subprocess.run(["umount", f"{mnt}/proc"], check=True)
+    if os.path.ismount(f"{mnt}/sys/firmware/efi/efivars"):
+        subprocess.run(["umount", f"{mnt}/sys/firmware/efi/efivars"], check=True)
+    if os.path.ismount(f"{mnt}/sys"):
+        subprocess.run(["umount", f"{mnt}/sys"], check=True)
+    if os.path.ismount(f"{mnt}/efi"):
+        subprocess.run(["umount", f"{mnt}/efi"], check=True)
+
+def cleanup(ctx):
     """
-    Cleans up the system by removing existing boot entries, unmounting file systems,
-    exporting active zpools, removing directories, and ensuring disk erasure.
+    Cleans up the system by exporting active zpools, removing directories,
+    and ensuring disk erasure.
 
     This function performs the following steps:
-    1. Checks if the boot menu entry already exists and removes it if found.
-    2. Creates the MNT directory if it does not exist.
-    3. Unmounts various file systems.
-    4. Exports active zpools.
-    5. Clears the label of the zroot zpool.
-    6. Removes the MNT directory and recreates it.
-    7. Ensures the disk has been properly erased using wipefs.
+    1. Exports active zpools.
+    2. Clears the label of the pool being installed to.
+    3. Removes the mount directory and recreates it.
+    4. Ensures every disk has been properly erased using wipefs.
+    """
+    mnt = ctx.mnt
 
-    Note: The constants MNT and DISK are assumed to be defined elsewhere.
+    # Export active zpools, concurrent installs leave the pools of the others alone
+    if ctx.exclusive:
+        subprocess.run(["zpool", "export", "-a"], check=True)
 
+        # Check if the pool exists
+        existing_pools = subprocess.check_output(["zpool", "list", "-H", "-o", "name"]).decode().splitlines()
+        if ctx.pool in existing_pools:
+            subprocess.run(["zpool", "labelclear", ctx.pool, "-f"], check=True)
+
+    # Remove mount directory and recreate it
+    if os.path.exists(mnt):
+        subprocess.run(["rm", "-rf", mnt], check=True)
+    os.mkdir(mnt)
+
+    # Ensure the disks have been erased properly with wipefs
+    each_disk(lambda disk: subprocess.run(["wipefs", "-aq", disk], check=True), all_disks(ctx))
+
+def generate_hostid(ctx):
+    """
+    Generate the hostid the pool is created with, reusing the one from an attempt being resumed.
     """
-    # Make MNT directory if it does not exist
-    if not os.path.isdir(MNT):
-        os.mkdir(MNT)
+    # Concurrent installs share the hostid multi.py generated once for all of them
+    previous = ctx.journal.outputs("generate_hostid").get("hostid")
+    if ctx.exclusive:
+        subprocess.run(["zgenhostid", "-f"] + ([previous] if previous else []), check=True)
+    with open("/etc/hostid", "rb") as hostid_file:
+        return {"hostid": f"{struct.unpack('<I', hostid_file.read(4))[0]:08x}"}
+
+def memory_size():
+    """
+    Bytes of RAM in this machine, the one being installed to.
+    """
+    with open("/proc/meminfo", encoding="utf-8") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("MemTotal missing from /proc/meminfo")
 
-    # Unmount file systems if they are mounted
-    if os.path.ismount(f"{MNT}/dev"):
-        subprocess.run(["umount", f"{MNT}/dev"], check=True)
-    if os.path.ismount(f"{MNT}/proc"):
-        subprocess.run(["umount", f"{MNT}/proc"], check=True)
-    if os.path.ismount(f"{MNT}/sys/firmware/efi/efivars"):
-        subprocess.run(["umount", f"{MNT}/sys/firmware/efi/efivars"], check=True)
-    if os.path.ismount(f"{MNT}/sys"):
-        subprocess.run(["umount", f"{MNT}/sys"], check=True)
-    if os.path.ismount(f"{MNT}/efi"):
-        subprocess.run(["umount", f"{MNT}/efi"], check=True)
-
-    # Export active zpools
-    subprocess.run(["zpool", "export", "-a"], check=True)
-
-    # Check if zroot pool exists
-    existing_pools = subprocess.check_output(["zpool", "list", "-H", "-o", "name"]).decode().splitlines()
-    if "zroot" in existing_pools:
-        subprocess.run(["zpool", "labelclear", "zroot", "-f"], check=True)
-
-    # Remove MNT directory and recreate it
-    if os.path.exists(MNT):
-        subprocess.run(["rm", "-rf", MNT], check=True)
-    os.mkdir(MNT)
-
-    # Ensure disk has been erased properly with wipefs
-    subprocess.run(["wipefs", "-aq", DISK], check=True)
-
-def filesystem():
-    """
-    Creates and mounts filesystems.
-    """
-    # Generate hostid
-    subprocess.run(["zgenhostid", "-f"], check=True)
-
-    # Partition the disk
-    subprocess.run(["sgdisk", "--zap-all", DISK], check=True)
-    subprocess.run(["sgdisk", "-n1:1M:+512M", "-t1:EF00", DISK], check=True)
-    subprocess.run(["sgdisk", "-n2:0:0", "-t2:BF00", DISK], check=True)
-
-    # Create zroot
+def target_memory(ctx):
+    """
+    Bytes of RAM of the machine the install will boot on, None when that is another machine.
+    """
+    return memory_size() if ctx.exclusive else None
+
+def swap_size(ram):
+    """
+    Size of the swap partition in GiB for the RAM, the largest one when the RAM is not known, 0 for none.
+    """
+    if ram is None:
+        return SWAPSIZE
+    return min(SWAPSIZE, max(1, round(ram / 2 ** 31)))
+
+def arc_limits(ram):
+    """
+    zfs_arc_min and zfs_arc_max in bytes for the RAM.
+    """
+    # The module refuses an ARC below 64 MiB
+    return max(ram * ARC_MIN_PERCENT // 100, 2 ** 26), max(ram * ARC_MAX_PERCENT // 100, 2 ** 27)
+
+def partition_disk(disk, swap):
+    """
+    Partition a disk into the EFI partition, the ZFS partition and the swap partition at the end.
+    """
+    subprocess.run(["sgdisk", "--zap-all", disk], check=True)
+    subprocess.run(["sgdisk", "-n1:1M:+512M", "-t1:EF00", disk], check=True)
+    subprocess.run(["sgdisk", f"-n2:0:{f'-{swap}G' if swap else '0'}", "-t2:BF00", disk], check=True)
+    partitions = [disks.partition_path(disk, 1), disks.partition_path(disk, 2)]
+    if swap:
+        subprocess.run(["sgdisk", "-n3:0:0", "-t3:8200", disk], check=True)
+        partitions.append(disks.partition_path(disk, 3))
+    return partitions
+
+def partition(ctx):
+    """
+    Partition the pool's disks alike so mirror and raidz members are the same size.
+    The disks of the optional vdevs are only cleared, zpool uses them whole.
+    """
+    swap = swap_size(target_memory(ctx))
+    aux = [disk for disk in all_disks(ctx) if disk not in ctx.disks]
+    each_disk(lambda disk: subprocess.run(["sgdisk", "--zap-all", disk], check=True), aux)
+    partitions = each_disk(lambda disk: partition_disk(disk, swap), ctx.disks)
+    return {"partitions": [path for paths in partitions for path in paths], "swap_gib": swap}
+
+def tune(ctx):
+    """
+    Pick the ashift and compression left on auto for the target disk and this machine.
+    """
+    return tuning.tune(ctx.disks, ctx.pool_options["ashift"], ctx.pool_options["compression"], ctx.layout)
+
+def vdevs(ctx):
+    """
+    The vdev arguments of zpool create for the layout and the optional vdevs.
+    """
+    data = [disks.partition_path(disk, 2) for disk in ctx.disks]
+    spec = data if ctx.layout == "stripe" else [ctx.layout] + data
+    for role in answers.AUX_VDEVS:
+        devices = ctx.aux[role]
+        if not devices:
+            continue
+        # Losing the special or log vdev loses data, mirror them when there is more than one disk
+        spec += [role] + (["mirror"] if role != "cache" and len(devices) > 1 else []) + devices
+    return spec
+
+def create_pool(ctx):
+    """
+    Creates the pool with its datasets and mounts them.
+    """
+    options = {**ctx.pool_options, **ctx.journal.outputs("tune")}
+
+    # Create the pool
     subprocess.run(["zpool", "create", "-f",
-                    "-o", "ashift=12",
-                    "-o", "autotrim=on",
+                    "-o", f"ashift={options['ashift']}",
+                    "-o", f"autotrim={'on' if options['autotrim'] else 'off'}",
                     "-O", "acltype=posixacl",
-                    "-O", "compression=zstd",
+                    "-O", f"compression={options['compression']}",
                     "-O", "dnodesize=auto",
                     "-O", "normalization=formD",
                     "-O", "relatime=on",
                     "-O", "xattr=sa",
-                    "-m", "none", "zroot", f"{DISK}2"], check=True)
+                    "-m", "none"] + (["-t", ctx.pool] if ctx.pool != ctx.pool_name else []) + [ctx.pool_name] + vdevs(ctx), check=True)
 
     # Create datasets
-    subprocess.run(["zfs", "create", "-o", "mountpoint=none", "zroot/ROOT"], check=True)
-    subprocess.run(["zfs", "create", "-o", "mountpoint=/", "-o", "canmount=noauto", "zroot/ROOT/arch"], check=True)
-    subprocess.run(["zfs", "create", "-o", "mountpoint=/home", "zroot/home"], check=True)
+    subprocess.run(["zfs", "create", "-o", "mountpoint=none", f"{ctx.pool}/ROOT"], check=True)
+    subprocess.run(["zfs", "create", "-o", "mountpoint=/", "-o", "canmount=noauto", f"{ctx.pool}/ROOT/arch"], check=True)
+    subprocess.run(["zfs", "create", "-o", "mountpoint=/home", f"{ctx.pool}/home"], check=True)
+
+    # Hold back space nothing else can use so a full pool can still be cleaned up
+    if RESERVE:
+        subprocess.run(["zfs", "create", "-o", "canmount=off", "-o", "mountpoint=none", "-o", f"refreservation={RESERVE}G", f"{ctx.pool}/reserved"], check=True)
+
+    # Keep why the pool was created this way for later audit
+    tuning.record(ctx.pool, options)
+
+    # From here on finished steps are journaled on the pool
+    ctx.journal.attach()
+    guid = subprocess.check_output(["zpool", "get", "-H", "-o", "value", "guid", ctx.pool]).decode().strip()
+    return {"pool": ctx.pool, "guid": guid}
+
+def mount_pool(ctx):
+    """
+    Import the pool under the mount directory and mount its datasets.
+    """
+    # Test the pool by importing and exporting, a temporary name is given again by guid since
+    # every pool has the same name on disk
+    subprocess.run(["zpool", "export", ctx.pool], check=True)
+    if ctx.pool != ctx.pool_name:
+        guid = ctx.journal.outputs("create_pool")["guid"]
+        subprocess.run(["zpool", "import", "-N", "-R", ctx.mnt, "-t", guid, ctx.pool], check=True)
+    else:
+        subprocess.run(["zpool", "import", "-N", "-R", ctx.mnt, ctx.pool], check=True)
+    subprocess.run(["zfs", "mount", f"{ctx.pool}/ROOT/arch"], check=True)
+    subprocess.run(["zfs", "mount", f"{ctx.pool}/home"], check=True)
+
+def format_efi(ctx):
+    """
+    Create the EFI filesystems, this does not need to wait for the pool.
+    """
+    each_disk(lambda disk: subprocess.run(["mkfs.vfat", "-F", "32", "-n", "EFI", disks.partition_path(disk, 1)], check=True), efi_disks(ctx))
+
+def format_swap_partition(disk):
+    """
+    Create the swap area on a disk's swap partition and return how fstab refers to it.
+    """
+    path = disks.partition_path(disk, 3)
+    subprocess.run(["mkswap", "-L", "swap", path], check=True)
+    partuuid = subprocess.check_output(["blkid", "-o", "value", "-s", "PARTUUID", path], text=True).strip()
+    return f"/dev/disk/by-partuuid/{partuuid}"
+
+def format_swap(ctx):
+    """
+    Create the swap areas when the disks got swap partitions.
+    """
+    if not ctx.journal.outputs("partition").get("swap_gib"):
+        return {"swap": []}
+    return {"swap": each_disk(format_swap_partition, ctx.disks)}
+
+def memory(ctx):
+    """
+    Configure swap, zram and the ARC limits of the installed system.
+    """
+    ram = target_memory(ctx)
+    arc_min, arc_max = arc_limits(ram) if ram else (None, None)
+    session = ctx.session
+    # An initramfs built during the install gets the limits through the zfs hook, which is
+    # why mkinitcpio waits for this step. The prebuilt one is copied as it is and only gets
+    # them from the command line set_commandline() writes. A disk for another machine keeps
+    # the module's defaults that follow its RAM
+    if ram:
+        session.write(f"/{ZFS_MODPROBE_CONFIG}", f"options zfs zfs_arc_min={arc_min} zfs_arc_max={arc_max}\n")
+    else:
+        session.write(f"/{ZFS_MODPROBE_CONFIG}", "# The ARC limits are the module's defaults for this machine's RAM\n")
+    # zram takes pages first, the swap partition only what does not fit
+    session.write(f"/{ZRAM_CONFIG}", f"[zram0]\nzram-size = {ZRAM_SIZE}\ncompression-algorithm = zstd\nswap-priority = 100\n")
+    # Swap partitions of the same priority are used round robin like a stripe
+    swap = ctx.journal.outputs("format_swap").get("swap", [])
+    fstab = session.read("/etc/fstab")
+    for path in swap:
+        if path not in fstab:
+            session.write("/etc/fstab", f"{path} none swap defaults,pri=10 0 0\n", append=True)
+    return {"arc_min": arc_min, "arc_max": arc_max, "swap": swap}
+
+def mount_efi(ctx):
+    """
+    Mount the EFI partition inside the extracted system.
+    """
+    os.makedirs(f"{ctx.mnt}/efi", exist_ok=True)
+    subprocess.run(["mount", disks.partition_path(ctx.disk, 1), f"{ctx.mnt}/efi"], check=True)
 
-    # Test the pool by importing and exporting
-    subprocess.run(["zpool", "export", "zroot"], check=True)
-    subprocess.run(["zpool", "import", "-N", "-R", MNT, "zroot"], check=True)
-    subprocess.run(["zfs", "mount", "zroot/ROOT/arch"], check=True)
-    subprocess.run(["zfs", "mount", "zroot/home"], check=True)
+class ExtractReport:
+    """
+    Emits extraction progress events every second and prints a summary every few seconds.
+    """
+    def __init__(self, event_log, interval=5):
+        self.event_log = event_log
+        self.interval = interval
+        self.last_event = 0.0
+        self.last = 0.0
+
+    def __call__(self, progress):
+        now = time.monotonic()
+        done = progress.fraction() >= 1.0
+        if now - self.last_event >= 1 or done:
+            self.last_event = now
+            self.event_log.emit("progress", step="install", fraction=round(progress.fraction(), 4),
+                                bytes=progress.bytes, total_bytes=progress.total_bytes,
+                                files=progress.files, total_files=progress.total_files,
+                                rate=round(progress.throughput()))
+        if now - self.last < self.interval and not done:
+            return
+        self.last = now
+        print(f"Extracted {progress.bytes // 1048576} of {progress.total_bytes // 1048576} MiB, "
+              f"{progress.files} of {progress.total_files} files "
+              f"({progress.fraction():.0%}, {progress.throughput() / 1048576:.1f} MiB/s)", flush=True)
 
-    # Create and mount the EFI partition
-    subprocess.run(["mkfs.vfat", "-F", "32", "-n", "EFI", f"{DISK}1"], check=True)
-    os.mkdir(f"{MNT}/efi")
-    subprocess.run(["mount", f"{DISK}1", f"{MNT}/efi"], check=True)
+def install(ctx):
+    """
+    Extracts the system.
+    """
+    if ctx.fanout is not None:
+        return ctx.fanout.install(ctx)
+    if ctx.netsource is not None:
+        return install_from_server(ctx)
+
+    stream = (ctx.stream or receive.find_stream()) if INSTALL_METHOD == "auto" else None
+    if stream:
+        return receive_root(ctx, stream)
+
+    # Extract the image from the loop device archiso attached airootfs.sfs to
+    source = ctx.source or extract.find_airootfs_device()
+    print(f"Extracting {source} to {ctx.mnt} with {EXTRACT_STRATEGY}")
+    progress = extract.extract(source, ctx.mnt, EXTRACT_STRATEGY, ExtractReport(ctx.events),
+                               processors=EXTRACT_PROCESSORS, memory=EXTRACT_MEMORY)
+    return {"method": "extract", "strategy": EXTRACT_STRATEGY, "files": progress.files, "bytes": progress.bytes}
+
+def install_from_server(ctx):
+    """
+    Receive the send stream while it downloads, or download the squashfs and extract it.
+    """
+    source = ctx.netsource
+    if INSTALL_METHOD == "auto" and source.has(netsource.STREAM):
+        return receive_root(ctx, source.open(netsource.STREAM), source.size(netsource.STREAM))
 
-def install():
+    image = os.path.join(ctx.mnt, NETWORK_IMAGE)
+    print(f"Downloading {source.url_of(netsource.IMAGE)}")
+    source.download(netsource.IMAGE, image, ExtractReport(ctx.events))
+    try:
+        print(f"Extracting {image} to {ctx.mnt} with {EXTRACT_STRATEGY}")
+        progress = extract.extract(image, ctx.mnt, EXTRACT_STRATEGY, ExtractReport(ctx.events),
+                                   processors=EXTRACT_PROCESSORS, memory=EXTRACT_MEMORY)
+    finally:
+        os.remove(image)
+    return {"method": "extract", "strategy": EXTRACT_STRATEGY, "files": progress.files, "bytes": progress.bytes,
+            "server": ctx.server}
+
+def receive_root(ctx, stream, size=None):
+    """
+    Replace the empty root dataset with the one in the send stream on the ISO.
+    With a size, stream is a file object reading the send stream from an install server.
     """
-    Extracts the system and makes other customizations.
+    root = clear_root(ctx)
+    print(f"Receiving {stream} into {root}")
+    if size is None:
+        progress = receive.receive(stream, root, ExtractReport(ctx.events), RECEIVE_PROPERTIES)
+    else:
+        progress = receive.receive_from(stream, size, root, ExtractReport(ctx.events), RECEIVE_PROPERTIES)
+    mount_received(ctx)
+    return {"method": "receive", "bytes": progress.bytes}
+
+def clear_root(ctx):
     """
-    # Extract the image
-    subprocess.run(["unsquashfs", "-f", "-d", "/tmp/maloneyos", "/dev/loop0"], check=True)
+    Unmount and destroy the empty root dataset so a send stream can be received in its place.
+    """
+    root = f"{ctx.pool}/ROOT/arch"
+
+    # Home is mounted inside the root dataset, both come off before the root is replaced
+    for mountpoint in (os.path.join(ctx.mnt, "home"), ctx.mnt):
+        if os.path.ismount(mountpoint):
+            subprocess.run(["umount", mountpoint], check=True)
+    if _succeeds(["zfs", "list", root]):
+        subprocess.run(["zfs", "destroy", "-r", root], check=True)
+    return root
 
+def mount_received(ctx):
+    """
+    Drop the snapshot that came with the received root and mount it and home again.
+    """
+    root = f"{ctx.pool}/ROOT/arch"
+    subprocess.run(["zfs", "destroy", f"{root}@%"], check=True)
+    # zfs send --compressed keeps the blocks as the image build compressed them
+    tuning.record_received(root)
+    subprocess.run(["zfs", "mount", root], check=True)
+    subprocess.run(["zfs", "mount", f"{ctx.pool}/home"], check=True)
+
+def system_mounts(ctx):
+    """
+    Mount what OS commands need inside the target and start the chroot session.
+    """
     # Mounts for various OS commands to work
-    subprocess.run(["mount", "-t", "devtmpfs", "none", os.path.join(MNT, "dev")], check=True)
-    subprocess.run(["mount", "-t", "proc", "none", os.path.join(MNT, "proc")], check=True)
-    subprocess.run(["mount", "-t", "sysfs", "none", os.path.join(MNT, "sys")], check=True)
-    subprocess.run(["mount", "-t", "efivarfs", "none", os.path.join(MNT, "sys/firmware/efi/efivars")], check=True)
+    subprocess.run(["mount", "-t", "devtmpfs", "none", os.path.join(ctx.mnt, "dev")], check=True)
+    subprocess.run(["mount", "-t", "proc", "none", os.path.join(ctx.mnt, "proc")], check=True)
+    subprocess.run(["mount", "-t", "sysfs", "none", os.path.join(ctx.mnt, "sys")], check=True)
+    subprocess.run(["mount", "-t", "efivarfs", "none", os.path.join(ctx.mnt, "sys/firmware/efi/efivars")], check=True)
 
     # Copy files to the new system
-    shutil.copy2("/etc/hostid", os.path.join(MNT, "etc/hostid"))
+    shutil.copy2("/etc/hostid", os.path.join(ctx.mnt, "etc/hostid"))
+
+    ctx.session = chroot.ChrootSession(ctx.mnt)
+    ctx.session.start()
+
+def hostid(ctx):
+    """
+    Read the hostid copied into the target as the hex string the hostid command prints.
+    """
+    with open(os.path.join(ctx.mnt, "etc/hostid"), "rb") as hostid_file:
+        return f"{struct.unpack('<I', hostid_file.read(4))[0]:08x}"
 
-def locale():
+def locale(ctx):
     '''
     Function to set keyboard mapping, timezone related things.
     '''
-    subprocess.run(["chroot", MNT, "ln", "-sf", "/usr/share/zoneinfo/America/New_York", "/etc/localtime"], check=True)
-    subprocess.run(["chroot", MNT, "hwclock", "--systohc"], check=True)
-    subprocess.run(["chroot", MNT, "echo", "en_US.UTF-8 UTF-8", ">>", "/etc/locale.gen"], check=True)
-    subprocess.run(["chroot", MNT, "locale-gen"], check=True)
-    subprocess.run(["chroot", MNT, "echo", "LANG=en_US.UTF-8", ">", "/etc/locale.conf"], check=True)
-    subprocess.run(["chroot", MNT, "echo", "KEYMAP=de_CH-latin1", ">", "/etc/vconsole.conf"], check=True)
-
-def mkinitcpio():
+    session = ctx.session
+    session.symlink(f"/usr/share/zoneinfo/{ctx.timezone}", "/etc/localtime")
+    session.run(["hwclock", "--systohc"])
+    entry = f"{ctx.locale} {ctx.locale.split('.', 1)[1]}"
+    if f"\n{entry}\n" not in "\n" + session.read("/etc/locale.gen"):
+        session.write("/etc/locale.gen", f"{entry}\n", append=True)
+    session.run(["locale-gen"])
+    session.write("/etc/locale.conf", f"LANG={ctx.locale}\n")
+    session.write("/etc/vconsole.conf", f"KEYMAP={ctx.keymap}\n")
+
+def boot_files(ctx):
     '''
-    Function to prepare for and gererate image using mkinitcpio.
+    Copy the kernel and microcode from the boot media or the install server, independent of everything in the chroot.
     '''
-    # Copy vmlinuz needed for mkinitcpio to the installed system
-    shutil.copy2("/run/archiso/bootmnt/arch/boot/x86_64/vmlinuz-linux-lts", os.path.join(MNT, "boot/"))
-
-    # Copy microcode updates to the installed system
-    shutil.copy2("/run/archiso/bootmnt/arch/boot/amd-ucode.img", os.path.join(MNT, "boot/"))
-    shutil.copy2("/run/archiso/bootmnt/arch/boot/intel-ucode.img", os.path.join(MNT, "boot/"))
+    # Copy vmlinuz needed for mkinitcpio and the microcode updates to the installed system
+    missing = [name for name in netsource.BOOT_FILES if ctx.netsource is not None and not ctx.netsource.has(name)]
+    if missing:
+        raise netsource.NetSourceError(f"The install server {ctx.netsource.url} does not offer {', '.join(missing)}, "
+                                       f"serve a complete ISO tree or write its manifest again")
+    for name in netsource.BOOT_FILES:
+        if ctx.netsource is not None:
+            ctx.netsource.download(name, os.path.join(ctx.mnt, "boot", os.path.basename(name)))
+        else:
+            shutil.copy2(os.path.join(ctx.bootmnt, name), os.path.join(ctx.mnt, "boot/"))
 
+def mkinitcpio(ctx):
+    '''
+    Function to prepare for and gererate image using mkinitcpio.
+    '''
     # Generate proper preset for the installed system
-    os.remove(os.path.join(MNT, "etc/mkinitcpio.conf.d/archiso.conf"))
-    with open(os.path.join(MNT, "etc/mkinitcpio.d/linux-lts.preset"), "w", encoding="utf-8") as f:
+    ctx.session.remove("/etc/mkinitcpio.conf.d/archiso.conf")
+    with open(os.path.join(ctx.mnt, "etc/mkinitcpio.d/linux-lts.preset"), "w", encoding="utf-8") as f:
         f.write("# mkinitcpio preset file for the 'linux-lts' package\n\n")
         f.write("#ALL_config=\"/etc/mkinitcpio.conf\"\n")
         f.write("ALL_kver=\"/boot/vmlinuz-linux-lts\"\n")
@@ -221,100 +635,356 @@ def mkinitcpio():
         f.write("fallback_options=\"-S autodetect\"\n")
 
     # Configure mkinitcpio
-    subprocess.run(["chroot", MNT, "sed", "-i", "s|filesystems fsck|zfs filesystems|", "/etc/mkinitcpio.conf"], check=True)
-
-    # Run mkinitcpio
-    subprocess.run(["chroot", "/tmp/maloneyos", "mkinitcpio", "-P"], check=True)
-
-def user():
+    config = ctx.session.read("/etc/mkinitcpio.conf")
+    ctx.session.write("/etc/mkinitcpio.conf", config.replace("filesystems fsck", "zfs filesystems"))
+
+    # The generic image works as both images until the machine builds its own
+    prebuilt = os.path.join(ctx.mnt, PREBUILT_INITRAMFS.lstrip("/"))
+    if INITRAMFS == "prebuilt" and os.path.isfile(prebuilt):
+        for image in ("initramfs-linux-lts.img", "initramfs-linux-lts-fallback.img"):
+            shutil.copyfile(prebuilt, os.path.join(ctx.mnt, "boot", image))
+        ctx.session.remove(PREBUILT_INITRAMFS)
+        if INITRAMFS_FIRST_BOOT:
+            ctx.session.write("/var/lib/maloneyos/initramfs-pending", "")
+            ctx.session.run(["systemctl", "enable", "maloneyos-initramfs.service"])
+        return {"initramfs": "prebuilt"}
+
+    # Run mkinitcpio in its own session so the shared one stays free for the other steps
+    with chroot.ChrootSession(ctx.mnt) as session:
+        session.run(["mkinitcpio", "-P"], on_line=MkinitcpioReport(ctx.events, session.read("/etc/mkinitcpio.conf")))
+    return {"initramfs": "built"}
+
+class MkinitcpioReport:
+    """
+    Passes mkinitcpio output through and emits progress as it runs the build hooks of each preset.
+    """
+    def __init__(self, event_log, config, presets=2):
+        self.event_log = event_log
+        hooks = re.search(r"^HOOKS=\((.*?)\)", config, re.MULTILINE)
+        self.total = presets * max(len(hooks.group(1).split()) if hooks else 1, 1)
+        self.done = 0
+
+    def __call__(self, line):
+        print(line, flush=True)
+        if "Running build hook" in line:
+            self.done += 1
+            self.event_log.emit("progress", step="mkinitcpio", fraction=round(min(self.done / self.total, 1.0), 4),
+                                hooks=self.done, total_hooks=self.total)
+
+def user(ctx):
     """
     Creates the users and groups.
     """
-    # Remove user "archie" from chroot
-    subprocess.run(["chroot", MNT, "userdel", "archie"], check=True)
-    subprocess.run(["chroot", MNT, "rm", "-rf", "/home/archie"], check=True)
+    session = ctx.session
+
+    # Remove user "archie" from chroot, a resumed install may have done this already
+    users = [line.split(":")[0] for line in session.read("/etc/passwd").splitlines()]
+    if "archie" in users:
+        session.run(["userdel", "archie"])
+    session.remove("/home/archie")
 
     # Remove archie from sudoers
-    sudoers_dir = "/tmp/maloneyos/etc/sudoers.d"
-    os.remove(f"{sudoers_dir}/00_archie")
+    session.remove("/etc/sudoers.d/00_archie")
 
     # Add user
-    subprocess.run(["chroot", MNT, "useradd", "-m", "-g", "users", "-G", "wheel", USERNAME], check=True)
+    if ctx.username not in users:
+        session.run(["useradd", "-m", "-g", "users", "-G", "wheel", ctx.username])
 
-    # Set PASSWORD for the user
-    subprocess.run(["chroot", MNT, "chpasswd"], input=f"{USERNAME}:{PASSWORD}\n", text=True, check=True)
+    # Set password for the user, answer files may hold it already hashed
+    if ctx.password_hash:
+        session.run(["chpasswd", "--encrypted"], input=f"{ctx.username}:{ctx.password_hash}\n")
+    else:
+        session.run(["chpasswd"], input=f"{ctx.username}:{ctx.password}\n")
 
     # Remove sddm.conf autologin
-    subprocess.run(["chroot", MNT, "rm", "/etc/sddm.conf.d/autologin.conf"], check=True)
+    session.remove("/etc/sddm.conf.d/autologin.conf")
 
     # Add user to sudoers.d
-    with open(f"{sudoers_dir}/00_{USERNAME}", "w", encoding="utf-8") as sudoers_file:
-        sudoers_file.write(f"{USERNAME} ALL=(ALL) ALL\n")
+    session.write(f"/etc/sudoers.d/00_{ctx.username}", f"{ctx.username} ALL=(ALL) ALL\n", mode=0o440)
 
     # Remove installer from installed system
-    subprocess.run(["rm", "-rf", f"{MNT}/maloneyos"], check=True)
+    session.remove("/maloneyos")
 
-def bootloader():
+    # Forget the cached ZFS module package of the ISO build, its files stay as DKMS's own
+    installed = session.run(["pacman", "-Qq"], on_line=lambda line: None).output.split()
+    cached = [name for name in installed if name.startswith(BUILD_PACKAGE_PREFIX)]
+    if cached:
+        session.run(["pacman", "-Rdd", "--dbonly", "--noconfirm"] + cached)
+
+def zfsbootmenu(ctx):
     """
-    Setup and install the bootloader.
+    Put ZFSBootMenu in place on the EFI partition.
     """
-    # Set a cachefile for ZFS
-    subprocess.run(["chroot", MNT, "zpool", "set", "cachefile=/etc/zfs/zpool.cache", "zroot"], check=True)
-
-    # Set the bootfs
-    subprocess.run(["chroot", MNT, "zpool", "set", "bootfs=zroot/ROOT/arch", "zroot"], check=True)
-
-    # Enable all needed daemons
-    subprocess.run(["chroot", MNT, "systemctl", "enable", "zfs-import-cache", "zfs-import.target", "zfs-mount", "zfs-zed", "zfs.target"], check=True)
-
     # Create EFI subfolder
-    subprocess.run(["chroot", MNT, "mkdir", "-p", "/efi/EFI/zbm"], check=True)
+    os.makedirs(os.path.join(ctx.mnt, "efi", "EFI", "zbm"), exist_ok=True)
 
     # Move /zfsbootmenu.EFI to /efi/EFI/zbm/zfsbootmenu.EFI
-    chroot_path = MNT
-    source_path = os.path.join(chroot_path, "zfsbootmenu.EFI")
-    destination_path = os.path.join(chroot_path, "efi", "EFI", "zbm", "zfsbootmenu.EFI")
-    shutil.move(source_path, destination_path)
-
-    # Add an entry to your boot menu
-    subprocess.run(["chroot", MNT, "efibootmgr", "--disk", DISK, "--part", "1", "--create", "--label", "ZFSBootMenu", "--loader", "\\EFI\\zbm\\zfsbootmenu.EFI", "--unicode", "spl_hostid=$(hostid) zbm.timeout=3 zbm.prefer=zroot zbm.import_policy=hostid", "--verbose"], check=True)
+    source_path = os.path.join(ctx.mnt, "zfsbootmenu.EFI")
+    destination_path = os.path.join(ctx.mnt, "efi", "EFI", "zbm", "zfsbootmenu.EFI")
+    if os.path.exists(source_path):
+        shutil.move(source_path, destination_path)
+
+    # A disk installed for another machine gets no boot entry here, its firmware finds
+    # ZFSBootMenu at the path for removable media instead
+    if not ctx.exclusive:
+        os.makedirs(os.path.join(ctx.mnt, "efi", "EFI", "BOOT"), exist_ok=True)
+        shutil.copy2(destination_path, os.path.join(ctx.mnt, "efi", "EFI", "BOOT", "BOOTX64.EFI"))
+
+    # Every member of a redundant pool can boot on its own, copy the EFI partition to the others
+    for disk in efi_disks(ctx)[1:]:
+        target = tempfile.mkdtemp(prefix="maloneyos-efi-")
+        subprocess.run(["mount", disks.partition_path(disk, 1), target], check=True)
+        try:
+            shutil.copytree(os.path.join(ctx.mnt, "efi", "EFI"), os.path.join(target, "EFI"), dirs_exist_ok=True)
+        finally:
+            subprocess.run(["umount", target], check=True)
+            os.rmdir(target)
+
+def bootloader(ctx):
+    """
+    Setup and install the bootloader.
+    """
+    session = ctx.session
 
-    # Set the kernel parameters
-    subprocess.run(["chroot", MNT, "zfs", "set", "org.zfsbootmenu:commandline=noresume init_on_alloc=0 rw spl.spl_hostid=$(hostid)", "zroot/ROOT"], check=True)
+    # Set a cachefile for ZFS, it would keep a temporary pool name so those pools are found by scanning
+    if ctx.pool == ctx.pool_name:
+        session.run(["zpool", "set", "cachefile=/etc/zfs/zpool.cache", ctx.pool])
 
-def services():
+    # Set the bootfs
+    session.run(["zpool", "set", f"bootfs={ctx.pool}/ROOT/arch", ctx.pool])
+
+    # Boot entries belong to the firmware of this machine, not to disks installed for others
+    if not ctx.exclusive:
+        set_commandline(ctx)
+        return
+
+    # Remove entries an earlier attempt created before adding ours
+    entries = session.run(["efibootmgr"], on_line=lambda line: None).output
+    for line in entries.splitlines():
+        if line.startswith("Boot") and "ZFSBootMenu" in line:
+            session.run(["efibootmgr", "--quiet", "--bootnum", line[4:8], "--delete-bootnum"])
+
+    # Add an entry to your boot menu for every disk with an EFI partition, the first disk is
+    # added last so it ends up first in the boot order
+    for disk in reversed(efi_disks(ctx)):
+        label = "ZFSBootMenu" if disk == ctx.disk else f"ZFSBootMenu ({os.path.basename(disk)})"
+        session.run(["efibootmgr", "--disk", disk, "--part", "1", "--create", "--label", label, "--loader", "\\EFI\\zbm\\zfsbootmenu.EFI", "--unicode", f"spl_hostid={hostid(ctx)} zbm.timeout=3 zbm.prefer={ctx.pool_name} zbm.import_policy=hostid", "--verbose"])
+    set_commandline(ctx)
+
+def set_commandline(ctx):
+    """
+    Set the kernel parameters ZFSBootMenu boots the installed system with.
+    """
+    # The ARC limits also go on the command line, the zfs module is loaded before the root is
+    # mounted and the prebuilt initramfs has no zfs.conf in it
+    ram = target_memory(ctx)
+    arc_min, arc_max = arc_limits(ram) if ram else (None, None)
+    arc = f"zfs.zfs_arc_min={arc_min} zfs.zfs_arc_max={arc_max} " if ram else ""
+    ctx.session.run(["zfs", "set", f"org.zfsbootmenu:commandline=noresume init_on_alloc=0 rw spl.spl_hostid={hostid(ctx)} "
+                     f"{arc}zswap.enabled=0", f"{ctx.pool}/ROOT"])
+
+def flatpaks(ctx):
+    """
+    Install the apps of the Flatpak repo on the boot media into the target's system installation.
+    """
+    bundle = os.path.join(ctx.bootmnt, FLATPAK_BUNDLE)
+    if not os.path.isfile(os.path.join(bundle, "apps.json")):
+        print("No Flatpak repo on the boot media, apps are installed from Discover later")
+        return {"apps": []}
+    with open(os.path.join(bundle, "apps.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    # The live system's flatpak writes straight into the target, sideloading every object from the boot media
+    env = dict(os.environ, FLATPAK_SYSTEM_DIR=os.path.join(ctx.mnt, "var/lib/flatpak"))
+    remote = manifest["remote"]
+    subprocess.run(["flatpak", "--system", "remote-add", "--if-not-exists", "--from", remote, os.path.join(bundle, f"{remote}.flatpakrepo")], env=env, check=True)
+    subprocess.run(["flatpak", "--system", "remote-modify", f"--collection-id={manifest['collection_id']}", remote], env=env, check=True)
+    subprocess.run(["flatpak", "--system", "install", "--noninteractive", "-y", f"--sideload-repo={os.path.join(bundle, 'repo')}",
+                    remote, *manifest["apps"]], env=env, check=True)
+    return {"apps": manifest["apps"]}
+
+def services(ctx):
     """
     Starts services.
     """
     # Enable zfs services
-    subprocess.run(["chroot", MNT, "systemctl", "enable", "zfs-import-cache", "zfs-import.target", "zfs-mount", "zfs-zed", "zfs.target"], check=True)
+    ctx.session.run(["systemctl", "enable", "zfs-import-cache", "zfs-import.target", "zfs-mount", "zfs-zed", "zfs.target"])
+    if ctx.pool != ctx.pool_name:
+        ctx.session.run(["systemctl", "enable", "zfs-import-scan"])
 
-def unmount():
+def unmount(ctx):
     """
     Umounts filesystems for cleanup
     """
-    subprocess.run(["umount", os.path.join(MNT, "dev")], check=True)
-    subprocess.run(["umount", os.path.join(MNT, "proc")], check=True)
-    subprocess.run(["umount", os.path.join(MNT, "sys/firmware/efi/efivars")], check=True)
-    subprocess.run(["umount", os.path.join(MNT, "sys")], check=True)
-    subprocess.run(["umount", os.path.join(MNT, "efi")], check=True)
-
-def export_pools():
+    # Keep the step timings on the installed system so slow steps can be compared across machines
+    ctx.events.save(os.path.join(ctx.mnt, TIMING_REPORT.lstrip("/")))
+    ctx.session.close()
+    subprocess.run(["umount", os.path.join(ctx.mnt, "dev")], check=True)
+    subprocess.run(["umount", os.path.join(ctx.mnt, "proc")], check=True)
+    subprocess.run(["umount", os.path.join(ctx.mnt, "sys/firmware/efi/efivars")], check=True)
+    subprocess.run(["umount", os.path.join(ctx.mnt, "sys")], check=True)
+    subprocess.run(["umount", os.path.join(ctx.mnt, "efi")], check=True)
+
+def factory_snapshot(ctx):
+    """
+    Keep the finished system as a held snapshot and install the tool that resets to it.
+    """
+    tool = os.path.join(ctx.mnt, RESET_TOOL)
+    os.makedirs(os.path.dirname(tool), exist_ok=True)
+    shutil.copy2(os.path.join(os.path.dirname(os.path.abspath(__file__)), "factoryreset.py"), tool)
+    os.chmod(tool, 0o755)
+
+    # A snapshot left by an interrupted attempt may predate steps that ran again, take it anew
+    snapshot = f"{ctx.pool}/ROOT/arch@{FACTORY_SNAPSHOT}"
+    if _succeeds(["zfs", "list", snapshot]):
+        subprocess.run(["zfs", "release", FACTORY_HOLD, snapshot], capture_output=True, check=False)
+        subprocess.run(["zfs", "destroy", snapshot], check=True)
+    subprocess.run(["zfs", "snapshot", snapshot], check=True)
+    subprocess.run(["zfs", "hold", FACTORY_HOLD, snapshot], check=True)
+
+    # Set on the parent so every boot environment, clones included, finds it
+    subprocess.run(["zfs", "set", f"{factoryreset.FACTORY_PROPERTY}={ctx.pool_name}/ROOT/arch@{FACTORY_SNAPSHOT}", f"{ctx.pool}/ROOT"], check=True)
+    return {"snapshot": snapshot}
+
+def export_pools(ctx):
     """
     Here we export all pools so system will boot cleanly.
     """
-    subprocess.run(["zpool", "export", "-a"], check=True)
-
-detect_media()
-cleanup()
-filesystem()
-install()
-locale()
-mkinitcpio()
-user()
-bootloader()
-services()
-unmount()
-export_pools()
+    ctx.journal.finish()
+    if ctx.exclusive:
+        subprocess.run(["zpool", "export", "-a"], check=True)
+    else:
+        # A temporary name is only in memory, exported the pool carries its real name again
+        subprocess.run(["zpool", "export", ctx.pool], check=True)
+
+def _succeeds(command):
+    """
+    Whether a command exits cleanly, used to check results recorded by an earlier run.
+    """
+    return subprocess.run(command, capture_output=True, check=False).returncode == 0
+
+def _exists(ctx, *paths):
+    """
+    Whether every path exists inside the target.
+    """
+    return all(os.path.exists(os.path.join(ctx.mnt, path)) for path in paths)
+
+# The install as a dependency graph, each step lists what it needs and what it produces.
+# Resumable steps are skipped on a rerun when the journal has them and verify still passes.
+STEPS = [
+    scheduler.Step("detect_media", detect_media, provides=["bootmnt"], resumable=False),
+    scheduler.Step("release_mounts", release_mounts, provides=["released"], resumable=False),
+    scheduler.Step("cleanup", cleanup, requires=["released"], provides=["clean-disk"]),
+    scheduler.Step("generate_hostid", generate_hostid, provides=["hostid"], resumable=False),
+    scheduler.Step("partition", partition, requires=["clean-disk"], provides=["partitions"],
+                   verify=lambda ctx, outputs: all(os.path.exists(path) for path in outputs.get("partitions", []))),
+    scheduler.Step("tune", tune, provides=["tuning"]),
+    scheduler.Step("create_pool", create_pool, requires=["partitions", "hostid", "tuning"], provides=["pool-created"],
+                   verify=lambda ctx, outputs: _succeeds(["zfs", "list", f"{ctx.pool}/ROOT/arch", f"{ctx.pool}/home"])),
+    scheduler.Step("mount_pool", mount_pool, requires=["pool-created"], provides=["pool"], resumable=False),
+    scheduler.Step("format_efi", format_efi, requires=["partitions"], provides=["efi-filesystem"],
+                   verify=lambda ctx, outputs: all(subprocess.run(["blkid", "-o", "value", "-s", "TYPE", disks.partition_path(disk, 1)], capture_output=True, text=True, check=False).stdout.strip() == "vfat" for disk in efi_disks(ctx))),
+    scheduler.Step("format_swap", format_swap, requires=["partitions"], provides=["swap-area"]),
+    scheduler.Step("install", install, requires=["pool", "bootmnt"], provides=["rootfs"],
+                   verify=lambda ctx, outputs: _exists(ctx, "etc/os-release", "usr/bin/bash")),
+    scheduler.Step("mount_efi", mount_efi, requires=["rootfs", "efi-filesystem"], provides=["efi"], resumable=False),
+    scheduler.Step("system_mounts", system_mounts, requires=["rootfs", "hostid"], provides=["chroot"], resumable=False),
+    scheduler.Step("locale", locale, requires=["chroot"], provides=["locale"],
+                   verify=lambda ctx, outputs: _exists(ctx, "etc/locale.conf", "etc/vconsole.conf")),
+    scheduler.Step("memory", memory, requires=["chroot", "swap-area"], provides=["memory"],
+                   verify=lambda ctx, outputs: _exists(ctx, ZFS_MODPROBE_CONFIG, ZRAM_CONFIG)),
+    scheduler.Step("boot_files", boot_files, requires=["rootfs", "bootmnt"], provides=["boot-files"],
+                   verify=lambda ctx, outputs: _exists(ctx, "boot/vmlinuz-linux-lts")),
+    scheduler.Step("mkinitcpio", mkinitcpio, requires=["chroot", "boot-files", "locale", "memory"], provides=["initramfs"],
+                   verify=lambda ctx, outputs: _exists(ctx, "boot/initramfs-linux-lts.img", "boot/initramfs-linux-lts-fallback.img")),
+    scheduler.Step("user", user, requires=["chroot"], provides=["users"],
+                   verify=lambda ctx, outputs: _exists(ctx, f"etc/sudoers.d/00_{ctx.username}")),
+    scheduler.Step("zfsbootmenu", zfsbootmenu, requires=["efi"], provides=["zfsbootmenu"],
+                   verify=lambda ctx, outputs: _exists(ctx, "efi/EFI/zbm/zfsbootmenu.EFI")),
+    scheduler.Step("bootloader", bootloader, requires=["chroot", "zfsbootmenu"], provides=["bootloader"],
+                   verify=lambda ctx, outputs: subprocess.run(["zpool", "get", "-H", "-o", "value", "bootfs", ctx.pool], capture_output=True, text=True, check=False).stdout.strip() == f"{ctx.pool}/ROOT/arch"),
+    scheduler.Step("flatpaks", flatpaks, requires=["rootfs", "bootmnt"], provides=["flatpaks"],
+                   verify=lambda ctx, outputs: _exists(ctx, *(f"var/lib/flatpak/app/{app}" for app in outputs.get("apps", [])))),
+    scheduler.Step("services", services, requires=["chroot"], provides=["services"]),
+    scheduler.Step("unmount", unmount, requires=["locale", "initramfs", "users", "bootloader", "services", "flatpaks"], provides=["unmounted"], resumable=False),
+    scheduler.Step("factory_snapshot", factory_snapshot, requires=["unmounted"], provides=["factory"],
+                   verify=lambda ctx, outputs: _succeeds(["zfs", "list", outputs.get("snapshot", f"{ctx.pool}/ROOT/arch@{FACTORY_SNAPSHOT}")])),
+    scheduler.Step("export_pools", export_pools, requires=["factory"], resumable=False),
+]
+
+def summary(ctx, ok, error=None):
+    """
+    Machine-readable outcome of an install for unattended runs.
+    """
+    run_end = next((event for event in reversed(ctx.events.events) if event["event"] == "run-end"), {})
+    failed = [event["step"] for event in ctx.events.events if event["event"] == "step-end" and not event.get("ok")]
+    return {
+        "ok": ok,
+        "disk": ctx.disk,
+        "disks": all_disks(ctx),
+        "layout": ctx.layout,
+        "pool": ctx.pool_name,
+        "server": ctx.server,
+        "user": ctx.username,
+        "duration": round(time.time() - ctx.events.started, 3),
+        "failed_steps": failed,
+        "error": error,
+        "steps": ctx.events.durations(),
+        "critical_path": run_end.get("critical_path", []),
+    }
+
+def write_summary(path, result):
+    """
+    Write the summary as JSON to a file, or to stdout for "-".
+    """
+    text = json.dumps(result, indent=2)
+    if path == "-":
+        print(text, flush=True)
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text + "\n")
+
+def main():
+    """
+    Run the install steps from an answer file, resuming an earlier attempt if there is one.
+    """
+    parser = argparse.ArgumentParser(description="Install MaloneyOS from an answer file, written by the install wizard or by hand.")
+    parser.add_argument("--answers", default=answers.WIZARD_ANSWERS, help="answer file describing the install")
+    parser.add_argument("--check", action="store_true", help="only validate the answer file")
+    parser.add_argument("--summary", help="write a JSON summary of the install to this file, - for stdout")
+    parser.add_argument("--fresh", action="store_true", help="ignore the journal of an earlier attempt and start over")
+    args = parser.parse_args()
+
+    try:
+        selection = answers.load(args.answers)
+    except answers.AnswerError as e:
+        print(e, file=sys.stderr)
+        if args.summary:
+            write_summary(args.summary, {"ok": False, "error": "invalid answers", "problems": e.problems})
+        sys.exit(EXIT_INVALID)
+    if args.check:
+        print(f"{args.answers} is valid")
+        return
+
+    ctx = Install(selection)
+    if not args.fresh:
+        ctx.journal.load(ctx.mnt)
+    try:
+        scheduler.Scheduler(STEPS, MAX_PARALLEL_STEPS).run(ctx, ctx.journal, ctx.events)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # Any failure of a step ends the install, report it instead of a traceback
+        print(f"Install failed: {e}", file=sys.stderr, flush=True)
+        if args.summary:
+            write_summary(args.summary, summary(ctx, False, str(e)))
+        sys.exit(EXIT_FAILED)
+    finally:
+        ctx.events.save(events.LIVE_REPORT)
+    if args.summary:
+        write_summary(args.summary, summary(ctx, True))
+    sys.exit(EXIT_OK)
+
+if __name__ == "__main__":
+    main()
 
 # End-of-file (EOF)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+'''
+Benchmark the install on sparse loop disks so changes to the install path come with numbers.
+
+The backend steps run against loop devices backed by sparse files and a built ISO mounted
+as the boot media, so no real disk is touched. Commands that need real hardware or UEFI
+firmware go through shim.py: recorded once on a real machine with --record and replayed
+everywhere else with --replay, or answered with success when there is no recording.
+
+Each step is measured for wall time, CPU time of the backend and the commands it waited
+for, and bytes written to the loop disks. Steps run one at a time by default so the CPU
+time of a step is its own. The chroot session outlives the steps that use it, so its
+shell's CPU time is read from /proc around every step and each step is billed for what
+the session used meanwhile. The result can be saved as a baseline and later runs
+compared to it.
+
+Needs root and the zfs module. The install exports every imported pool, so this refuses
+to run while any pool is imported.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import answers
+import backend
+import extract
+import scheduler
+import shim
+
+POOL = "maloneyos-bench"
+DISK_SIZE = 32 * 1024 * 1024 * 1024
+USER = {"name": "bench", "password": "bench"}
+
+# A metric regressed when it grew by more than the tolerance and, for times, by more than the noise
+TOLERANCE = 0.15
+NOISE_SECONDS = 0.5
+
+def attach(workdir, count, size):
+    '''
+    Create sparse files and attach them as loop devices with partition scanning.
+    '''
+    loops = []
+    for number in range(count):
+        backing = os.path.join(workdir, f"disk{number}.img")
+        with open(backing, "wb") as f:
+            f.truncate(size)
+        loops.append(subprocess.check_output(["losetup", "--find", "--show", "--partscan", backing], text=True).strip())
+    return loops
+
+def written(devices):
+    '''
+    Bytes written to block devices so far according to their statistics.
+    '''
+    total = 0
+    for device in devices:
+        with open(f"/sys/block/{os.path.basename(device)}/stat", encoding="utf-8") as f:
+            total += int(f.read().split()[6]) * 512
+    return total
+
+def cpu_seconds():
+    '''
+    CPU time of this process and the children it waited for.
+    '''
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def session_cpu(session):
+    '''
+    CPU time of a running chroot session's shell and the commands it waited for, 0 without one.
+    '''
+    pid = None if session is None else session.pid
+    if pid is None:
+        return 0.0
+    with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime, stime, cutime and cstime are fields 14 to 17 of the line, the state after the name is field 3
+    return sum(int(value) for value in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+def install_shims(directory):
+    '''
+    Put shim.py and a wrapper for every intercepted command into a directory.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    shutil.copy2(shim.__file__, os.path.join(directory, "shim.py"))
+    for name in shim.INTERCEPT:
+        wrapper = os.path.join(directory, name)
+        with open(wrapper, "w", encoding="utf-8") as f:
+            f.write(f'#!/bin/sh\nexec python3 {directory}/shim.py {name} "$@"\n')
+        os.chmod(wrapper, 0o755)
+
+def steps_until(name):
+    '''
+    The install steps up to and including name, with everything they depend on.
+    '''
+    if name is None:
+        return list(backend.STEPS)
+    by_name = {step.name: step for step in backend.STEPS}
+    providers = {resource: step.name for step in backend.STEPS for resource in step.provides}
+    needed, pending = set(), [name]
+    while pending:
+        current = pending.pop()
+        if current not in needed:
+            needed.add(current)
+            pending.extend(providers[resource] for resource in by_name[current].requires)
+    return [step for step in backend.STEPS if step.name in needed]
+
+class Bench:
+    '''
+    One install on loop disks with every step measured.
+    '''
+    def __init__(self, workdir, loops, shims):
+        self.workdir = workdir
+        self.loops = loops
+        self.shims = shims
+        self.mnt = os.path.join(workdir, "mnt")
+        self.results = {}
+
+    def bind_shims(self, _ctx):
+        '''
+        Make the wrappers visible inside the target, the chroot session finds them in PATH.
+        '''
+        target = self.mnt + self.shims
+        os.makedirs(target, exist_ok=True)
+        subprocess.run(["mount", "--bind", self.shims, target], check=True)
+
+    def unbind_shims(self, _ctx):
+        '''
+        Take the wrappers out of the target again before it is unmounted.
+        '''
+        subprocess.run(["umount", self.mnt + self.shims], check=True)
+
+    def measured(self, step):
+        '''
+        The step with its function wrapped to measure it.
+        '''
+        before = {"unmount": self.unbind_shims}.get(step.name)
+        after = {"system_mounts": self.bind_shims}.get(step.name)
+
+        def run(ctx):
+            wall, cpu, io = time.monotonic(), cpu_seconds(), written(self.loops)
+            session = session_cpu(ctx.session)
+            try:
+                if before:
+                    before(ctx)
+                outputs = step.func(ctx)
+                if after:
+                    after(ctx)
+                return outputs
+            finally:
+                # A session closed in this step was reaped here with all its CPU time, what earlier steps were billed comes off
+                cpu = cpu_seconds() - cpu + session_cpu(ctx.session) - session
+                self.results[step.name] = {"wall": round(time.monotonic() - wall, 3), "cpu": round(cpu, 3),
+                                           "bytes": written(self.loops) - io}
+        return scheduler.Step(step.name, run, step.requires, step.provides, resumable=step.resumable, verify=step.verify)
+
+    def run(self, selection, iso, steps, workers):
+        '''
+        Install with the given steps and return whether it finished and the error if not.
+        '''
+        ctx = backend.Install(selection, self.mnt)
+        if iso:
+            ctx.bootmnt = iso
+            ctx.source = os.path.join(iso, "arch", "x86_64", "airootfs.sfs")
+            stream = os.path.join(iso, "arch", "x86_64", "airootfs.zfs")
+            ctx.stream = stream if os.path.exists(stream) else None
+        try:
+            scheduler.Scheduler([self.measured(step) for step in steps], workers).run(ctx, ctx.journal, ctx.events)
+            return True, None
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # A failing step is a result of the benchmark, the teardown still has to run
+            return False, str(e)
+        finally:
+            if ctx.session is not None:
+                ctx.session.close()
+
+    def teardown(self):
+        '''
+        Remove the pool, the mounts and the loop devices.
+        '''
+        subprocess.run(["umount", "-R", self.mnt], capture_output=True, check=False)
+        if POOL in subprocess.check_output(["zpool", "list", "-H", "-o", "name"], text=True).split():
+            subprocess.run(["zpool", "destroy", "-f", POOL], check=False)
+        for loop in self.loops:
+            subprocess.run(["losetup", "-d", loop], check=False)
+
+def compare(result, baseline, tolerance=TOLERANCE):
+    '''
+    Every step metric that got worse than in the baseline.
+    '''
+    regressions = []
+    for name, now in result["steps"].items():
+        before = baseline.get("steps", {}).get(name)
+        if not before:
+            continue
+        for metric in ("wall", "cpu", "bytes"):
+            grown = now[metric] - before[metric]
+            if grown > before[metric] * tolerance and (metric == "bytes" or grown > NOISE_SECONDS):
+                regressions.append(f"{name} {metric}: {before[metric]} -> {now[metric]}")
+    return regressions
+
+def benchmark(args):
+    '''
+    Set up the loop disks and shims, run the install and tear everything down again.
+    '''
+    workdir = tempfile.mkdtemp(prefix=f"{POOL}-", dir=args.workdir)
+    shims = os.path.join(workdir, "shims")
+    install_shims(shims)
+    hostid = None
+    if os.path.exists("/etc/hostid"):
+        with open("/etc/hostid", "rb") as f:
+            hostid = f.read()
+    iso = None
+    if args.iso:
+        iso = os.path.join(workdir, "iso")
+        os.makedirs(iso)
+        subprocess.run(["mount", "-o", "loop,ro", args.iso, iso], check=True)
+
+    bench = Bench(workdir, attach(workdir, args.disks, args.size), shims)
+    paths = {**{loop: f"{{disk{number}}}" for number, loop in enumerate(bench.loops)}, bench.mnt: "{mnt}"}
+    os.environ.update({shim.MODE: "record" if args.record else "replay", shim.LOG: os.path.join(shims, "calls.jsonl"),
+                       shim.DIR: shims, shim.PATHS: json.dumps(paths), "PATH": f"{shims}{os.pathsep}{os.environ['PATH']}"})
+    if args.replay:
+        shutil.copy2(args.replay, os.environ[shim.LOG])
+
+    selection = answers.validate({"disks": bench.loops, "user": USER, "pool": {"name": POOL, "layout": args.layout}}, check_system=False)
+    started = time.monotonic()
+    ok, error = False, "not run"
+    try:
+        ok, error = bench.run(selection, iso, steps_until(args.until), args.workers)
+        if args.record and os.path.exists(os.environ[shim.LOG]):
+            shutil.copy2(os.environ[shim.LOG], args.record)
+    finally:
+        bench.teardown()
+        if iso:
+            subprocess.run(["umount", iso], check=False)
+        if hostid is not None:
+            with open("/etc/hostid", "wb") as f:
+                f.write(hostid)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {"hardware": extract.hardware(), "ok": ok, "error": error, "layout": args.layout, "disks": args.disks,
+            "workers": args.workers, "wall": round(time.monotonic() - started, 3), "steps": bench.results,
+            "bytes": sum(result["bytes"] for result in bench.results.values())}
+
+def main():
+    '''
+    Command line entry point for benchmarking the install on loop disks.
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the install on sparse loop disks.")
+    parser.add_argument("--iso", help="built ISO to install from, its boot files and images are used")
+    parser.add_argument("--disks", type=int, default=1, help="number of loop disks")
+    parser.add_argument("--size", type=int, default=DISK_SIZE, help="size of every loop disk in bytes, they are sparse")
+    parser.add_argument("--layout", default="stripe", choices=list(answers.LAYOUTS), help="pool layout")
+    parser.add_argument("--until", choices=[step.name for step in backend.STEPS], help="only run the steps up to this one")
+    parser.add_argument("--workers", type=int, default=1, help="steps run at the same time, 1 keeps CPU times per step")
+    parser.add_argument("--workdir", default="/var/tmp", help="directory for the sparse files")
+    parser.add_argument("--record", help="run intercepted commands for real and save their calls to this file")
+    parser.add_argument("--replay", help="answer intercepted commands from a file saved with --record")
+    parser.add_argument("--output", help="append the JSON result to this file")
+    parser.add_argument("--baseline", help="compare with a result saved with --save-baseline")
+    parser.add_argument("--save-baseline", help="save the result as the baseline for later runs")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="fraction a metric may grow before it counts as a regression")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        parser.error("needs root for loop devices and zfs")
+    if subprocess.check_output(["zpool", "list", "-H", "-o", "name"], text=True).strip():
+        parser.error("export every pool first, the install exports all imported pools")
+    if args.iso is None and args.until is None:
+        parser.error("pass --iso, or --until a step before the install needs the image")
+    problem = answers.check_layout(args.layout, args.disks)
+    if problem:
+        parser.error(problem)
+
+    result = benchmark(args)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        result["regressions"] = regressions
+    extract.print_report(result, args.output)
+    if args.save_baseline and result["ok"]:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    sys.exit(0 if result["ok"] and not regressions else 1)
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+'''
+Long-lived chroot session the backend steps submit commands to.
+
+A single shell is started inside the target and every command is written to its stdin,
+so the install pays for one chroot instead of one per command. Each command's exit
+code, output and duration is kept in ChrootSession.results. Files inside the target
+are written in-process rather than by shelling out.
+'''
+
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+
+class CommandResult:
+    '''
+    Outcome of a single command run in the session.
+    '''
+    def __init__(self, args, returncode, output, duration):
+        self.args = args
+        self.returncode = returncode
+        self.output = output
+        self.duration = duration
+
+class ChrootSession:
+    '''
+    A shell running inside root that executes commands one at a time.
+    '''
+    def __init__(self, root, shell="/bin/bash"):
+        self.root = root
+        self.shell = shell
+        self.results = []
+        self._marker = f"__MALONEYOS_{uuid.uuid4().hex}__"
+        self._lock = threading.Lock()
+        self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def pid(self):
+        '''
+        Process id of the shell, None while it is not running.
+        '''
+        return None if self._process is None else self._process.pid
+
+    def start(self):
+        '''
+        Start the shell inside the target.
+        '''
+        # The shell lives for the whole session so it cannot be scoped to a with block
+        self._process = subprocess.Popen(  # pylint: disable=consider-using-with
+            ["chroot", self.root, self.shell, "--noprofile", "--norc"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, encoding="utf-8", errors="replace")
+
+    def close(self):
+        '''
+        Stop the shell and print how long the commands took.
+        '''
+        if self._process is None:
+            return
+        self._process.stdin.write("exit 0\n")
+        self._process.stdin.close()
+        self._process.wait()
+        self._process.stdout.close()
+        self._process = None
+        total = sum(result.duration for result in self.results)
+        print(f"Ran {len(self.results)} commands in the chroot session in {total:.1f}s")
+
+    def run(self, args, input=None, check=True, on_line=None):  # pylint: disable=redefined-builtin
+        '''
+        Run a command in the target and return its CommandResult.
+        Output is printed as it arrives unless on_line is given to receive each line.
+        '''
+        command = shlex.join(args)
+        if input is None:
+            script = f"{command} < /dev/null\n"
+        else:
+            delimiter = f"EOF_{uuid.uuid4().hex}"
+            script = f"{command} <<'{delimiter}'\n{input.rstrip(chr(10))}\n{delimiter}\n"
+        script += f"printf '%s %d\\n' {self._marker} $?\n"
+
+        with self._lock:
+            started = time.monotonic()
+            self._process.stdin.write(script)
+            self._process.stdin.flush()
+            output, returncode = self._collect(on_line or (lambda line: print(line, flush=True)))
+            result = CommandResult(args, returncode, output, time.monotonic() - started)
+            self.results.append(result)
+
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ["chroot", self.root] + list(args), output)
+        return result
+
+    def _collect(self, on_line):
+        '''
+        Read output until the marker line carrying the exit code.
+        '''
+        lines = []
+        for line in self._process.stdout:
+            index = line.find(self._marker)
+            if index < 0:
+                line = line.rstrip("\n")
+                lines.append(line)
+                on_line(line)
+                continue
+            if index > 0:
+                lines.append(line[:index])
+                on_line(line[:index])
+            return "\n".join(lines), int(line[index + len(self._marker):])
+        raise subprocess.SubprocessError(f"Chroot session in {self.root} exited unexpectedly")
+
+    def path(self, path):
+        '''
+        Translate a path inside the target to the path on the live system.
+        '''
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def write(self, path, content, append=False, mode=None):
+        '''
+        Write a file inside the target, creating its directory if needed.
+        '''
+        os.makedirs(os.path.dirname(self.path(path)), exist_ok=True)
+        with open(self.path(path), "a" if append else "w", encoding="utf-8") as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(self.path(path), mode)
+
+    def read(self, path):
+        '''
+        Read a file inside the target.
+        '''
+        with open(self.path(path), encoding="utf-8") as f:
+            return f.read()
+
+    def symlink(self, target, path):
+        '''
+        Point path at target inside the target, replacing what is there like ln -sf.
+        '''
+        if os.path.lexists(self.path(path)):
+            os.remove(self.path(path))
+        os.symlink(target, self.path(path))
+
+    def remove(self, path):
+        '''
+        Remove a file or directory tree inside the target like rm -rf.
+        '''
+        if os.path.isdir(self.path(path)) and not os.path.islink(self.path(path)):
+            shutil.rmtree(self.path(path))
+        elif os.path.lexists(self.path(path)):
+            os.remove(self.path(path))
+
+# End-of-file (EOF)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Block device inventory for the disk selection page and the backend.
+
+Disks are read from sysfs, with the transport, model and serial filled in from
+lsblk --json when it is available. The results are cached by an Inventory, which is
+refreshed when the kernel announces a disk being added, removed or changed on the
+uevent netlink socket. Nothing here needs Qt, the installer runs the probing and the
+hotplug monitor on a worker thread.
+'''
+
+import json
+import os
+import select
+import socket
+import subprocess
+import threading
+import time
+
+SYS_BLOCK = "/sys/block"
+
+# Virtual and optical devices that can never be an install target
+IGNORED_PREFIXES = ("loop", "ram", "zram", "sr", "fd", "dm-", "md", "zd", "nbd")
+
+# Netlink protocol and multicast group the kernel sends uevents on
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP = 1
+
+class Disk:
+    '''
+    A whole disk with the properties that matter for installing to it.
+    '''
+    def __init__(self, name, **properties):
+        self.name = name
+        self.path = f"/dev/{name}"
+        self.size = properties.get("size", 0)
+        self.model = properties.get("model", "")
+        self.serial = properties.get("serial", "")
+        self.transport = properties.get("transport", "")
+        self.rotational = properties.get("rotational", False)
+        self.removable = properties.get("removable", False)
+        self.logical_sector_size = properties.get("logical_sector_size", 512)
+        self.physical_sector_size = properties.get("physical_sector_size", 512)
+        self.optimal_io_size = properties.get("optimal_io_size", 0)
+        self.discard = properties.get("discard", False)
+
+    def describe(self):
+        '''
+        One line summary for the disk selection page.
+        '''
+        kind = "HDD" if self.rotational else "SSD"
+        details = [f"{self.size / 1000 ** 3:.0f} GB", kind]
+        if self.transport:
+            details.append(self.transport.upper())
+        details.append(f"{self.logical_sector_size}/{self.physical_sector_size} byte sectors")
+        if self.discard:
+            details.append("TRIM")
+        if self.removable:
+            details.append("removable")
+        model = f" {self.model}" if self.model else ""
+        return f"{self.name}{model} ({', '.join(details)})"
+
+    def to_dict(self):
+        '''
+        The disk as plain data for JSON output.
+        '''
+        return dict(vars(self))
+
+def _read(name, attribute, default=""):
+    '''
+    A sysfs attribute of a block device, stripped, or default when it is missing.
+    '''
+    try:
+        with open(os.path.join(SYS_BLOCK, name, attribute), encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+def _number(name, attribute):
+    '''
+    A numeric sysfs attribute of a block device, 0 when it is missing.
+    '''
+    value = _read(name, attribute, "0")
+    return int(value) if value.isdigit() else 0
+
+def _lsblk():
+    '''
+    Transport, model and serial of every disk according to lsblk, empty if lsblk fails.
+    '''
+    try:
+        output = subprocess.run(["lsblk", "--json", "--nodeps", "-o", "NAME,TRAN,MODEL,SERIAL"],
+                                capture_output=True, text=True, check=True).stdout
+        return {device["name"]: device for device in json.loads(output).get("blockdevices", [])}
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return {}
+
+def probe():
+    '''
+    Every disk that could be installed to, largest first.
+    '''
+    details = _lsblk()
+    found = []
+    for name in sorted(os.listdir(SYS_BLOCK)):
+        if name.startswith(IGNORED_PREFIXES) or _number(name, "ro"):
+            continue
+        size = _number(name, "size") * 512
+        if not size:
+            continue
+        extra = details.get(name, {})
+        found.append(Disk(
+            name,
+            size=size,
+            model=(extra.get("model") or _read(name, "device/model")).strip(),
+            serial=(extra.get("serial") or _read(name, "device/serial")).strip(),
+            transport=extra.get("tran") or "",
+            rotational=_number(name, "queue/rotational") == 1,
+            removable=_number(name, "removable") == 1,
+            logical_sector_size=_number(name, "queue/logical_block_size") or 512,
+            physical_sector_size=_number(name, "queue/physical_block_size") or 512,
+            optimal_io_size=_number(name, "queue/optimal_io_size"),
+            discard=_number(name, "queue/discard_max_bytes") > 0,
+        ))
+    found.sort(key=lambda disk: disk.size, reverse=True)
+    return found
+
+def find(path):
+    '''
+    The disk at a /dev path, probed fresh, or None if there is no such disk.
+    '''
+    name = os.path.basename(os.path.realpath(path))
+    return next((disk for disk in probe() if disk.name == name), None)
+
+def partition_path(disk, number):
+    '''
+    Path of a partition of a disk, disks whose name ends in a digit like nvme0n1 use a p separator.
+    '''
+    separator = "p" if disk[-1].isdigit() else ""
+    return f"{disk}{separator}{number}"
+
+class Inventory:
+    '''
+    Cached disk list that is only probed again after a hotplug event.
+    '''
+    def __init__(self):
+        self._disks = None
+        self._lock = threading.Lock()
+
+    def disks(self):
+        '''
+        The cached disks, probing on first use.
+        '''
+        with self._lock:
+            if self._disks is None:
+                self._disks = probe()
+            return list(self._disks)
+
+    def refresh(self):
+        '''
+        Probe again and return the disks.
+        '''
+        with self._lock:
+            self._disks = probe()
+            return list(self._disks)
+
+class Monitor:
+    '''
+    Listens for kernel uevents about whole disks on a netlink socket.
+    '''
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self.socket.bind((0, UEVENT_GROUP))
+
+    def wait(self, timeout):
+        '''
+        Wait up to timeout seconds and return whether a disk was added, removed or changed.
+        '''
+        deadline = time.monotonic() + timeout
+        changed = False
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not select.select([self.socket], [], [], remaining)[0]:
+                break
+            fields = self.socket.recv(65536).split(b"\0")
+            uevent = dict(field.decode("utf-8", "replace").split("=", 1) for field in fields[1:] if b"=" in field)
+            if uevent.get("SUBSYSTEM") == "block" and uevent.get("DEVTYPE") == "disk":
+                changed = True
+                # Give the rest of a burst of events a moment to arrive before reporting
+                deadline = min(deadline, time.monotonic() + 0.5)
+        return changed
+
+    def close(self):
+        '''
+        Close the netlink socket.
+        '''
+        self.socket.close()
+
+# End-of-file (EOF)
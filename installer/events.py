@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+'''
+Machine-readable progress events shared by the backend and the installer.
+
+The backend prints each event as a single line starting with MARKER followed by JSON,
+so it can be mixed with the regular command output. The installer picks those lines
+out and feeds them to a ProgressModel, which weighs every step by how long it took in
+earlier runs to drive the progress bar and estimate the time left.
+'''
+
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+MARKER = "@@maloneyos "
+
+# Timing report the backend leaves on the live system after every run
+LIVE_REPORT = "/tmp/maloneyos-timings.json"
+
+# Where timing reports from earlier runs are read from, reports collected from installed
+# machines can be copied into the timings directory next to the installer
+HISTORY = [
+    LIVE_REPORT,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "timings", "*.json"),
+]
+
+# Typical step durations in seconds used until there is history to go on
+DEFAULT_WEIGHTS = {
+    "detect_media": 1,
+    "release_mounts": 1,
+    "cleanup": 3,
+    "generate_hostid": 1,
+    "partition": 3,
+    "tune": 3,
+    "create_pool": 5,
+    "mount_pool": 3,
+    "format_efi": 2,
+    "format_swap": 1,
+    "install": 300,
+    "mount_efi": 1,
+    "system_mounts": 2,
+    "memory": 1,
+    "locale": 5,
+    "boot_files": 2,
+    "mkinitcpio": 5,
+    "user": 3,
+    "zfsbootmenu": 1,
+    "bootloader": 3,
+    "flatpaks": 30,
+    "services": 2,
+    "unmount": 2,
+    "factory_snapshot": 1,
+    "export_pools": 3,
+}
+
+class EventLog:
+    '''
+    Prints events for the installer and keeps them for the timing report.
+    '''
+    def __init__(self, stream=None, target=None):
+        self.stream = stream or sys.stdout
+        # Disk every event is tagged with when several installs print to the same output
+        self.target = target
+        self.events = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        '''
+        Print one event line and remember it.
+        '''
+        record = {"event": event, "time": round(time.time(), 3)}
+        if self.target:
+            record["target"] = self.target
+        record.update(fields)
+        with self._lock:
+            self.events.append(record)
+            self.stream.write(MARKER + json.dumps(record) + "\n")
+            self.stream.flush()
+
+    def durations(self):
+        '''
+        How long each finished step took in seconds.
+        '''
+        return {event["step"]: event["duration"] for event in self.events if event["event"] == "step-end" and event.get("ok")}
+
+    def report(self):
+        '''
+        The timing report saved on the installed system and used as history by the installer.
+        '''
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), "unknown")
+        return {
+            "started": self.started,
+            "duration": round(time.time() - self.started, 3),
+            "hardware": {"cpu": cpu, "cores": os.cpu_count()},
+            "steps": self.durations(),
+            "events": list(self.events),
+        }
+
+    def save(self, *paths):
+        '''
+        Write the timing report to every path given.
+        '''
+        report = json.dumps(self.report(), indent=2)
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(report + "\n")
+
+def parse(line):
+    '''
+    Return the event on a line of backend output, or None for regular output.
+    '''
+    if not line.startswith(MARKER):
+        return None
+    try:
+        return json.loads(line[len(MARKER):])
+    except ValueError:
+        return None
+
+def load_weights(patterns=None):
+    '''
+    Average step durations from earlier timing reports over the defaults.
+    '''
+    samples = {}
+    for pattern in patterns or HISTORY:
+        for path in glob.glob(pattern):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    steps = json.load(f).get("steps", {})
+            except (OSError, ValueError):
+                continue
+            for name, duration in steps.items():
+                samples.setdefault(name, []).append(duration)
+
+    weights = dict(DEFAULT_WEIGHTS)
+    for name, durations in samples.items():
+        weights[name] = max(sum(durations) / len(durations), 0.1)
+    return weights
+
+class ProgressModel:
+    '''
+    Turns step events into an overall fraction and an estimate of the time left.
+    '''
+    def __init__(self, weights=None):
+        self.weights = weights or load_weights()
+        self.started = None
+        self.finished = set()
+        self.skipped = set()
+        self.running = {}
+        self.current = None
+
+    def update(self, event):
+        '''
+        Account for one event from the backend.
+        '''
+        if self.started is None:
+            self.started = time.monotonic()
+        kind = event.get("event")
+        step = event.get("step")
+        if kind == "step-start":
+            self.running[step] = 0.0
+            self.current = step
+        elif kind == "step-end":
+            self.running.pop(step, None)
+            self.finished.add(step)
+        elif kind == "step-skip":
+            # Steps a resumed install skips take no time, leave them out of the estimate
+            self.skipped.add(step)
+        elif kind == "progress" and step in self.running:
+            self.running[step] = min(max(event.get("fraction", 0.0), 0.0), 1.0)
+            self.current = step
+
+    def fraction(self):
+        '''
+        Weighted fraction of the install that is done.
+        '''
+        total = sum(weight for step, weight in self.weights.items() if step not in self.skipped)
+        if not total:
+            return 0.0
+        done = sum(self.weights.get(step, 0.0) for step in self.finished)
+        done += sum(self.weights.get(step, 0.0) * fraction for step, fraction in self.running.items())
+        return min(done / total, 1.0)
+
+    def eta(self):
+        '''
+        Seconds left going by how fast the weighted fraction has moved so far, None until it has.
+        '''
+        fraction = self.fraction()
+        if self.started is None or fraction <= 0.01:
+            return None
+        elapsed = time.monotonic() - self.started
+        return elapsed * (1.0 - fraction) / fraction
+
+# End-of-file (EOF)
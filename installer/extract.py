@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+'''
+Extraction engine that lays the live image down onto the target for backend.install().
+
+Each strategy copies the airootfs squashfs into a directory while reporting how many
+files and bytes are done. Run this script with --benchmark to compare the strategies
+on the current hardware.
+'''
+
+import abc
+import argparse
+import contextlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+AIROOTFS = "airootfs.sfs"
+AIROOTFS_FILES = [
+    "/run/archiso/bootmnt/arch/x86_64/airootfs.sfs",
+    "/run/archiso/copytoram/airootfs.sfs",
+]
+CHUNK_SIZE = 1024 * 1024
+POLL_INTERVAL = 0.5
+
+# unsquashfs redraws "[====|    ] 1234/5678  21%" with carriage returns
+PROGRESS_BAR = re.compile(r"\]\s+(\d+)/(\d+)\s+\d+%")
+
+class Progress:
+    '''
+    Running totals for an extraction, handed to the report callback as it advances.
+    '''
+    def __init__(self, total_files=0, total_bytes=0):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    def elapsed(self):
+        '''
+        Seconds since the extraction started.
+        '''
+        return time.monotonic() - self.started
+
+    def fraction(self):
+        '''
+        Best estimate of how much of the image is done, by bytes when the total is known.
+        '''
+        if self.total_bytes:
+            return min(self.bytes / self.total_bytes, 1.0)
+        if self.total_files:
+            return min(self.files / self.total_files, 1.0)
+        return 0.0
+
+    def throughput(self):
+        '''
+        Bytes per second written so far.
+        '''
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+def find_airootfs_device():
+    '''
+    Find the loop device archiso attached airootfs.sfs to instead of assuming /dev/loop0.
+    Falls back to the image file itself when no loop device is backing it.
+    '''
+    for name in sorted(os.listdir("/sys/block")):
+        if not name.startswith("loop"):
+            continue
+        try:
+            with open(f"/sys/block/{name}/loop/backing_file", encoding="utf-8") as f:
+                backing_file = f.read().strip()
+        except OSError:
+            continue
+        if os.path.basename(backing_file) == AIROOTFS:
+            return f"/dev/{name}"
+
+    for path in AIROOTFS_FILES:
+        if os.path.exists(path):
+            return path
+
+    raise FileNotFoundError(f"Unable to find a loop device or file for {AIROOTFS}")
+
+def scan_image(source):
+    '''
+    Count the files and bytes in a squashfs image from its metadata so progress has a total.
+    '''
+    listing = subprocess.run(["unsquashfs", "-lls", source], capture_output=True, text=True, check=True)
+    files = 0
+    total = 0
+    for line in listing.stdout.splitlines():
+        fields = line.split()
+        if len(fields) < 6 or len(fields[0]) != 10 or fields[0][0] not in "-dlcbps":
+            continue
+        files += 1
+        if fields[0][0] == "-":
+            total += int(fields[2])
+    return files, total
+
+def find_mountpoint(device):
+    '''
+    Return where a device is already mounted, archiso mounts airootfs under /run/archiso.
+    '''
+    device = os.path.realpath(device)
+    with open("/proc/mounts", encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if os.path.realpath(fields[0]) == device:
+                return fields[1].replace("\\040", " ")
+    return None
+
+@contextlib.contextmanager
+def mounted(source):
+    '''
+    Directory a squashfs is mounted at, mounting it read-only meanwhile when it is not already.
+    '''
+    mountpoint = find_mountpoint(source)
+    if mountpoint:
+        yield mountpoint
+        return
+
+    tmpdir = tempfile.mkdtemp(prefix="maloneyos-squashfs-")
+    subprocess.run(["mount", "-t", "squashfs", "-o", "ro", source, tmpdir], check=True)
+    try:
+        yield tmpdir
+    finally:
+        subprocess.run(["umount", tmpdir], check=True)
+        os.rmdir(tmpdir)
+
+def tar_create(src):
+    '''
+    Command writing a tar stream of src to stdout with owners, xattrs and ACLs.
+    '''
+    return ["tar", "-C", src, "--numeric-owner", "--xattrs", "--acls", "-cf", "-", "."]
+
+def tar_unpack(dest, verbose=False):
+    '''
+    Command extracting a tar stream from stdin into dest, listing the files with verbose.
+    '''
+    return ["tar", "-C", dest, "--numeric-owner", "--xattrs", "--xattrs-include=*", "--acls", "-xpvf" if verbose else "-xpf", "-"]
+
+def _written_bytes(pid):
+    '''
+    Bytes a process has written so far according to /proc/PID/io.
+    '''
+    try:
+        with open(f"/proc/{pid}/io", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+class Strategy(abc.ABC):
+    '''
+    Base class for a way of extracting the squashfs image into a directory.
+    '''
+    name = None
+    tools = ()
+
+    def __init__(self, processors=None, memory=None):
+        self.processors = processors or os.cpu_count() or 1
+        self.memory = memory
+
+    def available(self):
+        '''
+        Check the tools this strategy needs are installed.
+        '''
+        return all(shutil.which(tool) for tool in self.tools)
+
+    @abc.abstractmethod
+    def extract(self, source, dest, report=None):
+        '''
+        Extract source into dest, calling report(progress) as it goes, and return the Progress.
+        '''
+
+class UnsquashfsStrategy(Strategy):
+    '''
+    Extract with unsquashfs using every processor and bounded decompression queues.
+    '''
+    name = "unsquashfs"
+    tools = ("unsquashfs",)
+
+    def command(self, source, dest):
+        '''
+        Build the unsquashfs command line, memory is split between the data and fragment queues.
+        '''
+        command = ["unsquashfs", "-f", "-d", dest, "-processors", str(self.processors)]
+        if self.memory:
+            queue = str(max(self.memory // 2, 1))
+            command += ["-data-queue", queue, "-frag-queue", queue]
+        return command + [source]
+
+    def extract(self, source, dest, report=None):
+        files, total = scan_image(source)
+        progress = Progress(files, total)
+        with subprocess.Popen(self.command(source, dest), stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+            done = threading.Event()
+            poller = threading.Thread(target=self._poll, args=(process.pid, progress, report, done), daemon=True)
+            poller.start()
+            pending = b""
+            while True:
+                chunk = process.stdout.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                parts = re.split(rb"[\r\n]", pending + chunk)
+                pending = parts.pop()
+                for part in parts:
+                    self._parse(part.decode("utf-8", "replace"), progress)
+            done.set()
+            poller.join()
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, self.command(source, dest))
+        progress.files = progress.total_files
+        progress.bytes = max(progress.bytes, progress.total_bytes)
+        if report:
+            report(progress)
+        return progress
+
+    @staticmethod
+    def _parse(line, progress):
+        '''
+        Pick the file count out of the progress bar and pass anything else through.
+        '''
+        match = PROGRESS_BAR.search(line)
+        if match:
+            progress.files = int(match.group(1))
+        elif line.strip():
+            print(line.strip(), flush=True)
+
+    @staticmethod
+    def _poll(pid, progress, report, done):
+        '''
+        Sample how much unsquashfs has written until it exits.
+        '''
+        while not done.wait(POLL_INTERVAL):
+            written = _written_bytes(pid)
+            if written is not None:
+                progress.bytes = written
+            if report:
+                report(progress)
+
+class TarStrategy(Strategy):
+    '''
+    Mount the squashfs read-only and copy it through a tar pipeline, counting bytes in between.
+    '''
+    name = "tar"
+    tools = ("tar",)
+
+    def extract(self, source, dest, report=None):
+        files, total = scan_image(source)
+        progress = Progress(files, total)
+        with mounted(source) as src:
+            return self._copy(src, dest, progress, report)
+
+    def _copy(self, src, dest, progress, report):
+        '''
+        Relay a tar stream of src into an extracting tar in dest.
+        '''
+        create = tar_create(src)
+        unpack = tar_unpack(dest, verbose=True)
+        with subprocess.Popen(create, stdout=subprocess.PIPE) as producer, \
+                subprocess.Popen(unpack, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as consumer:
+            counter = threading.Thread(target=_count_lines, args=(consumer.stdout, progress), daemon=True)
+            counter.start()
+            relay(producer.stdout, [consumer.stdin], progress, report)
+            consumer.stdin.close()
+            counter.join()
+            if producer.wait() != 0:
+                raise subprocess.CalledProcessError(producer.returncode, create)
+            if consumer.wait() != 0:
+                raise subprocess.CalledProcessError(consumer.returncode, unpack)
+        if report:
+            report(progress)
+        return progress
+
+def _count_lines(stream, progress):
+    '''
+    Count the file names a verbose tar prints as it extracts.
+    '''
+    for _ in stream:
+        progress.files += 1
+
+def relay(stream, sinks, progress, report=None):
+    '''
+    Copy a stream into every sink in fixed size chunks, adding to progress.bytes as it goes.
+    '''
+    last = 0.0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        for sink in sinks:
+            sink.write(chunk)
+        progress.bytes += len(chunk)
+        now = time.monotonic()
+        if report and now - last >= POLL_INTERVAL:
+            report(progress)
+            last = now
+
+def fan_out(stream, consumers, progress, report=None):
+    '''
+    Copy a stream into the stdin of every consumer process like relay, a consumer that breaks
+    off is dropped and the others go on. Returns the consumers that broke off.
+    '''
+    live = list(consumers)
+    broken = []
+    last = 0.0
+    while live:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        for consumer in list(live):
+            try:
+                consumer.stdin.write(chunk)
+            except OSError:
+                live.remove(consumer)
+                broken.append(consumer)
+        progress.bytes += len(chunk)
+        now = time.monotonic()
+        if report and now - last >= POLL_INTERVAL:
+            report(progress)
+            last = now
+    for consumer in consumers:
+        try:
+            consumer.stdin.close()
+        except OSError:
+            pass
+    return broken
+
+STRATEGIES = {
+    UnsquashfsStrategy.name: UnsquashfsStrategy,
+    TarStrategy.name: TarStrategy,
+}
+
+def extract(source, dest, strategy="unsquashfs", report=None, **options):
+    '''
+    Extract source into dest with the named strategy and return the final Progress.
+    Options are passed to the strategy, processors and a memory cap in MiB.
+    '''
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown extraction strategy: {strategy}")
+    return STRATEGIES[strategy](**options).extract(source, dest, report)
+
+def hardware():
+    '''
+    Describe the hardware class a benchmark ran on.
+    '''
+    cpu = "unknown"
+    with open("/proc/cpuinfo", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("model name"):
+                cpu = line.split(":", 1)[1].strip()
+                break
+    with open("/proc/meminfo", encoding="utf-8") as f:
+        memory = int(f.readline().split()[1]) * 1024
+    return {"cpu": cpu, "cores": os.cpu_count(), "memory": memory}
+
+def benchmark(source, workdir, strategies=None, processors=None, memory=None):
+    '''
+    Extract the image once per strategy into a scratch directory and time each run.
+    '''
+    results = []
+    for name in strategies or STRATEGIES:
+        engine = STRATEGIES[name](processors, memory)
+        if not engine.available():
+            results.append({"strategy": name, "skipped": "missing tools"})
+            continue
+        dest = tempfile.mkdtemp(prefix=f"extract-{name}-", dir=workdir)
+        try:
+            progress = engine.extract(source, dest)
+            results.append({
+                "strategy": name,
+                "seconds": round(progress.elapsed(), 2),
+                "files": progress.files,
+                "bytes": progress.bytes,
+                "mib_per_second": round(progress.throughput() / (1024 * 1024), 1),
+            })
+        finally:
+            shutil.rmtree(dest, ignore_errors=True)
+    timed = [result for result in results if "seconds" in result]
+    fastest = min(timed, key=lambda result: result["seconds"])["strategy"] if timed else None
+    return {"hardware": hardware(), "source": source, "results": results, "fastest": fastest}
+
+def print_report(report, output=None):
+    '''
+    Print a benchmark report and append it to output as one JSON line.
+    '''
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(report) + "\n")
+
+def main():
+    '''
+    Command line entry point for comparing strategies on this machine.
+    '''
+    parser = argparse.ArgumentParser(description="Compare image extraction strategies.")
+    parser.add_argument("--benchmark", action="store_true", help="time every strategy")
+    parser.add_argument("--source", help="squashfs image or device, found automatically by default")
+    parser.add_argument("--workdir", default="/tmp", help="directory to extract into while benchmarking")
+    parser.add_argument("--strategy", action="append", choices=sorted(STRATEGIES), help="strategy to include, repeatable")
+    parser.add_argument("--processors", type=int, help="processors to use, all by default")
+    parser.add_argument("--memory", type=int, help="memory cap in MiB")
+    parser.add_argument("--output", help="append the JSON report to this file")
+    args = parser.parse_args()
+
+    source = args.source or find_airootfs_device()
+    if not args.benchmark:
+        print(source)
+        return
+
+    print_report(benchmark(source, args.workdir, args.strategy, args.processors, args.memory), args.output)
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+'''
+Reset an installed MaloneyOS to the state it was in right after the install.
+
+The installer keeps the finished root dataset as a held snapshot, named in the
+org.maloneyos:factory property of the boot environment parent. This tool clones that
+snapshot into a new boot environment and makes it the pool's bootfs, so ZFSBootMenu
+boots it next. The new boot environment is promoted, which moves the factory snapshot
+and its hold to it and leaves the old boot environment a plain clone, so the old one can
+be destroyed once it is no longer needed, however often the system was reset before.
+The home dataset is left as it is.
+
+Installed as /usr/local/bin/maloneyos-reset, it only uses the standard library.
+'''
+
+import argparse
+import subprocess
+import sys
+import time
+
+FACTORY_PROPERTY = "org.maloneyos:factory"
+
+def _zfs_value(prop, dataset):
+    '''
+    Value of a ZFS property, None when it is not set.
+    '''
+    value = subprocess.check_output(["zfs", "get", "-H", "-o", "value", prop, dataset], text=True).strip()
+    return None if value == "-" else value
+
+def current_root():
+    '''
+    Dataset the running system booted from.
+    '''
+    return subprocess.check_output(["findmnt", "-n", "-o", "SOURCE", "/"], text=True).strip()
+
+def reset(name=None, dry_run=False):
+    '''
+    Clone the factory snapshot into a new boot environment that owns the snapshot from then
+    on and boot it next, returning the current and the new boot environment.
+    '''
+    root = current_root()
+    parent = root.rsplit("/", 1)[0]
+    snapshot = _zfs_value(FACTORY_PROPERTY, parent)
+    if snapshot is None:
+        raise RuntimeError(f"No factory snapshot recorded on {parent}")
+    environment = f"{parent}/{name or time.strftime('factory-%Y%m%d-%H%M%S')}"
+    pool = parent.split("/", 1)[0]
+    commands = [
+        ["zfs", "clone", "-o", "mountpoint=/", "-o", "canmount=noauto", snapshot, environment],
+        # The snapshot keeps its name below the boot environment it moves to
+        ["zfs", "promote", environment],
+        ["zfs", "set", f"{FACTORY_PROPERTY}={environment}@{snapshot.split('@', 1)[1]}", parent],
+        ["zpool", "set", f"bootfs={environment}", pool],
+    ]
+    for command in commands:
+        print(" ".join(command))
+        if not dry_run:
+            subprocess.run(command, check=True)
+    return root, environment
+
+def main():
+    '''
+    Command line entry point of maloneyos-reset.
+    '''
+    parser = argparse.ArgumentParser(description="Boot a fresh copy of the system as it was installed, home is kept.")
+    parser.add_argument("--name", help="name of the new boot environment, factory-<date> by default")
+    parser.add_argument("--dry-run", action="store_true", help="only print the commands")
+    parser.add_argument("--reboot", action="store_true", help="reboot into the new boot environment right away")
+    args = parser.parse_args()
+
+    try:
+        old, new = reset(args.name, args.dry_run)
+    except (RuntimeError, subprocess.CalledProcessError) as e:
+        print(f"Reset failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.dry_run:
+        return
+    print(f"{new} boots next and keeps the factory snapshot. {old} is kept, remove it with: zfs destroy -r {old}")
+    if args.reboot:
+        subprocess.run(["systemctl", "reboot"], check=True)
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
@@ -5,15 +5,26 @@ Installer for MaloneyOS that collects info and processes with backend.
 
 import sys
 import subprocess
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QPushButton, QStackedWidget, QLineEdit, QTextEdit
-from PyQt5.QtCore import QThread, pyqtSignal, QProcess
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QStackedWidget, QLineEdit, QPlainTextEdit, QProgressBar, QComboBox
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal, QProcess
+
+import answers
+import disks
+import events
+import logsink
+
+# How often queued backend output is drawn, in milliseconds
+LOG_REFRESH_MS = 100
+
+# What a disk can be used for on the disk page, shown name and the answers role
+DISK_ROLES = [("Not used", None), ("Pool", "disks"), ("Special vdev", "special"), ("Log vdev", "log"), ("Cache vdev", "cache")]
 
 class MaloneyOSInstaller(QWidget):
     '''
     Define the QStackedWidget class so we can navigate through several screens collecting info and then install.
     '''
     def __init__(self):
-        self.disk = None
+        self.disk_roles = {}
         self.commands_executed = False
         self.username = ""
         self.password = ""
@@ -40,22 +51,20 @@ class MaloneyOSInstaller(QWidget):
         # Disk Selection Page
         disk_selection_page = QWidget()
         disk_selection_layout = QVBoxLayout()
-        disk_label = QLabel("Select a disk:")
+        disk_label = QLabel("Select the disks of the pool and how to use them:")
         disk_selection_layout.addWidget(disk_label)
-
-        try:
-            # Run lsblk command to get the list of disks
-            disks = subprocess.check_output(["lsblk", "-d", "-n", "-o", "NAME"]).decode().splitlines()
-            for disk in disks:
-                # Check if the disk name contains any digits, if not, add it to the list
-                if not any(char.isdigit() for char in disk):
-                    disk_button = QPushButton(disk)
-                    disk_button.clicked.connect(lambda _, disk=disk: self.select_disk(disk))
-                    disk_selection_layout.addWidget(disk_button)
-
-        except subprocess.CalledProcessError as e:
-            # Handle the specific exception for subprocess.CalledProcessError
-            print(f"Error getting disk information: {str(e)}")
+        self.layout_input = QComboBox()
+        self.layout_input.addItems(list(answers.LAYOUTS))
+        self.layout_input.currentTextChanged.connect(self.check_disks)
+        disk_selection_layout.addWidget(self.layout_input)
+
+        # Disks are probed on a worker thread and a row for each filled in when they arrive
+        self.disk_status = QLabel("Looking for disks...")
+        disk_selection_layout.addWidget(self.disk_status)
+        self.disk_buttons = QVBoxLayout()
+        disk_selection_layout.addLayout(self.disk_buttons)
+        self.layout_problem = QLabel("")
+        disk_selection_layout.addWidget(self.layout_problem)
 
         next_button = QPushButton("Next")
         next_button.clicked.connect(self.show_user_creation)
@@ -95,9 +104,25 @@ class MaloneyOSInstaller(QWidget):
         installation_page = QWidget()
         installation_layout = QVBoxLayout()
 
-        self.output_text = QTextEdit()
+        self.progress_label = QLabel("Ready to install")
+        installation_layout.addWidget(self.progress_label)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 1000)
+        self.progress_bar.setTextVisible(False)
+        installation_layout.addWidget(self.progress_bar)
+        self.progress_model = events.ProgressModel()
+
+        # Output is collected by the log sink and drawn in batches, only the newest lines are kept
+        self.log = logsink.LogSink()
+        self.output_text = QPlainTextEdit()
         self.output_text.setReadOnly(True)
+        self.output_text.setMaximumBlockCount(logsink.MAX_LINES)
         installation_layout.addWidget(self.output_text)
+        self.log_status = QLabel("")
+        installation_layout.addWidget(self.log_status)
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start(LOG_REFRESH_MS)
 
         self.install_restart_button = QPushButton("Click to Install")
         self.install_restart_button.clicked.connect(self.run_commands)
@@ -114,24 +139,78 @@ class MaloneyOSInstaller(QWidget):
         self.setLayout(QVBoxLayout())
         self.layout().addWidget(self.stacked_widget)
 
-        self.worker_thread = WorkerThread()
-        self.worker_thread.output_signal.connect(self.read_output)
+        self.worker_thread = WorkerThread(self.log)
+        self.worker_thread.event_signal.connect(self.update_progress)
         self.worker_thread.finished.connect(self.show_restart_button)
 
         self.commands_executed = False  # Flag to track if commands have been executed
 
+        self.disk_probe = DiskProbeThread()
+        self.disk_probe.disks_signal.connect(self.update_disks)
+        self.disk_probe.start()
+
     def show_disk_selection(self):
         '''
         Function to show disk selection.
         '''
         self.stacked_widget.setCurrentIndex(1)
 
-    def select_disk(self, disk):
+    def update_disks(self, found):
+        '''
+        Show a row for every disk the probe found, dropping the roles of disks that are gone.
+        '''
+        while self.disk_buttons.count():
+            self.disk_buttons.takeAt(0).widget().deleteLater()
+        self.disk_roles = {disk.name: self.disk_roles[disk.name] for disk in found if disk.name in self.disk_roles}
+        for disk in found:
+            row = QWidget()
+            row_layout = QHBoxLayout(row)
+            row_layout.setContentsMargins(0, 0, 0, 0)
+            row_layout.addWidget(QLabel(disk.describe()), 1)
+            role_input = QComboBox()
+            role_input.addItems([name for name, _ in DISK_ROLES])
+            role_input.setCurrentIndex([role for _, role in DISK_ROLES].index(self.disk_roles.get(disk.name)))
+            role_input.currentIndexChanged.connect(lambda index, disk=disk.name: self.select_disk(disk, DISK_ROLES[index][1]))
+            row_layout.addWidget(role_input)
+            self.disk_buttons.addWidget(row)
+        self.disk_status.setText("No disks found, connect a disk to continue.")
+        self.disk_status.setVisible(not found)
+        self.check_disks()
+
+    def closeEvent(self, event):  # pylint: disable=invalid-name
+        '''
+        Stop watching for disks when the window closes.
+        '''
+        self.disk_probe.requestInterruption()
+        self.disk_probe.wait()
+        self.log.close()
+        super().closeEvent(event)
+
+    def select_disk(self, disk, role):
+        '''
+        Remember what a disk is used for.
+        '''
+        if role is None:
+            self.disk_roles.pop(disk, None)
+        else:
+            self.disk_roles[disk] = role
+        self.check_disks()
+
+    def selected(self, role):
         '''
-        If we have no disk selected prevent next from being pressed.
+        Paths of the disks selected for a role.
         '''
-        self.disk = disk
-        self.next_button_disk.setEnabled(True)
+        return ["/dev/" + disk for disk, selected in self.disk_roles.items() if selected == role]
+
+    def check_disks(self):
+        '''
+        Prevent next from being pressed until the pool disks fit the layout.
+        '''
+        problem = answers.check_layout(self.layout_input.currentText(), len(self.selected("disks")))
+        if not self.selected("disks"):
+            problem = "Select at least one disk for the pool."
+        self.layout_problem.setText(problem or "")
+        self.next_button_disk.setEnabled(problem is None)
 
     def show_user_creation(self):
         '''
@@ -150,24 +229,17 @@ class MaloneyOSInstaller(QWidget):
         else:
             self.next_button_user.setEnabled(False)
 
-    def output_disk_value(self):
+    def output_answers(self):
         '''
-        Construct disk output as /dev/$DEVICE to be used by backend.
+        Save the selections as the answer file the backend installs from.
         '''
-        disk_value = "/dev/" + self.disk
-        with open('/tmp/selected-disk', 'w', encoding='utf-8') as file:
-            file.write(disk_value)
-
-    def output_credentials(self):
-        '''
-        Save credentials to be read by the backend to create users, add user to group, sudoers, etc.
-        '''
-        username_value = self.username
-        password_value = self.password
-        with open('/tmp/username', 'w', encoding='utf-8') as username_file:
-            username_file.write(username_value)
-        with open('/tmp/password', 'w', encoding='utf-8') as password_file:
-            password_file.write(password_value)
+        pool = {"layout": self.layout_input.currentText()}
+        pool.update((role, self.selected(role)) for role in answers.AUX_VDEVS)
+        answers.save(answers.WIZARD_ANSWERS, {
+            "disks": self.selected("disks"),
+            "user": {"name": self.username, "password": self.password},
+            "pool": pool,
+        })
 
     def show_installation(self):
         '''
@@ -176,8 +248,7 @@ class MaloneyOSInstaller(QWidget):
         self.username = self.username_input.text()
         self.password = self.password_input.text()
         self.stacked_widget.setCurrentIndex(3)
-        self.output_disk_value()
-        self.output_credentials()
+        self.output_answers()
 
     def run_commands(self):
         '''
@@ -188,11 +259,30 @@ class MaloneyOSInstaller(QWidget):
             self.worker_thread.start()
             self.commands_executed = True
 
-    def read_output(self, output):
+    def flush_log(self):
         '''
-        Allow the output to be read.
+        Draw the output collected since the last refresh in one go.
         '''
-        self.output_text.append(output)
+        text = self.log.drain()
+        if text:
+            self.output_text.appendPlainText(text)
+            self.log_status.setText(self.log.status())
+
+    def update_progress(self, event):
+        '''
+        Move the progress bar and estimate the time left from a backend event.
+        '''
+        self.progress_model.update(event)
+        self.progress_bar.setValue(int(self.progress_model.fraction() * 1000))
+        if event.get("event") == "run-end":
+            self.progress_label.setText("Install finished" if event.get("ok") else "Install failed")
+            return
+        text = f"Installing: {self.progress_model.current or 'starting'}"
+        eta = self.progress_model.eta()
+        if eta is not None:
+            minutes, seconds = divmod(int(eta), 60)
+            text += f" - about {minutes}:{seconds:02d} left"
+        self.progress_label.setText(text)
 
     def show_restart_button(self):
         '''
@@ -201,7 +291,7 @@ class MaloneyOSInstaller(QWidget):
         self.install_restart_button.setEnabled(True)
         self.install_restart_button.hide()
         self.restart_system_button.show()
-        self.output_text.append("All commands have finished.")
+        self.log.write("All commands have finished.\n")
         self.stacked_widget.setCurrentIndex(3)
 
     def restart_system(self):
@@ -212,20 +302,65 @@ class MaloneyOSInstaller(QWidget):
             process = QProcess()
             process.startDetached("shutdown", ["-r", "now"])
         except OSError as e:
-            self.output_text.append(f"Error restarting system: {str(e)}")
+            self.log.write(f"Error restarting system: {str(e)}\n")
+
+class DiskProbeThread(QThread):
+    '''
+    Probe the disks off the GUI thread and probe again whenever a disk is plugged in or removed.
+    '''
+    disks_signal = pyqtSignal(list)
+
+    def run(self):
+        '''
+        Send the cached disks, then a fresh list after every hotplug event until interrupted.
+        '''
+        inventory = disks.Inventory()
+        self.disks_signal.emit(inventory.disks())
+        try:
+            monitor = disks.Monitor()
+        except OSError as e:
+            print(f"Not watching for disk changes: {str(e)}")
+            return
+        try:
+            while not self.isInterruptionRequested():
+                if monitor.wait(1.0):
+                    self.disks_signal.emit(inventory.refresh())
+        finally:
+            monitor.close()
 
 class WorkerThread(QThread):
     '''
     Create a worker thread so we can display output real time.
     '''
-    output_signal = pyqtSignal(str)
+    event_signal = pyqtSignal(dict)
+
+    def __init__(self, log):
+        super().__init__()
+        self.log = log
+        self.pending = ""
+
+    def forward(self, data):
+        '''
+        Split backend output into progress events and text for the log.
+        '''
+        lines = (self.pending + data).split("\n")
+        self.pending = lines.pop()
+        text = []
+        for line in lines:
+            event = events.parse(line)
+            if event is not None:
+                self.event_signal.emit(event)
+            else:
+                text.append(line)
+        if text:
+            self.log.write("\n".join(text) + "\n")
 
     def run(self):
         '''
         Run the backend with the informatoin we collected with the wizard to install the system.
         '''
         commands = [
-            "python3 backend.py"
+            f"python3 -u backend.py --answers {answers.WIZARD_ANSWERS}"
         ]
 
         for command in commands:
@@ -234,15 +369,18 @@ class WorkerThread(QThread):
                 process.setProcessChannelMode(QProcess.MergedChannels)
                 process.start(command)
 
-                process.readyReadStandardOutput.connect(lambda: self.output_signal.emit(process.readAllStandardOutput().data().decode("utf-8")))
+                process.readyReadStandardOutput.connect(lambda: self.forward(process.readAllStandardOutput().data().decode("utf-8", "replace")))
                 process.waitForFinished(-1)
+                remaining = process.readAllStandardOutput().data().decode("utf-8", "replace")
+                if remaining or self.pending:
+                    self.forward(remaining + "\n")
 
                 if process.exitCode() != 0:
                     output = process.readAllStandardOutput().data().decode('utf-8')
                     raise subprocess.CalledProcessError(process.exitCode(), command, output)
 
             except subprocess.CalledProcessError as e:
-                self.output_signal.emit(f"Error executing command '{command}': {str(e)}")
+                self.log.write(f"Error executing command '{command}': {str(e)}\n")
 
         # All commands have finished, show restart button
         self.finished.emit()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''
+Step journal that lets a failed install resume instead of starting over.
+
+Every finished step is stored as a ZFS user property on the pool together with what
+it produced, for example org.maloneyos:step.install={"finished": ..., "outputs": {...}}.
+Steps that finish before the pool exists are held in memory and written once it does.
+A rerun imports the pool, reads the journal back and the scheduler skips the steps
+whose results still check out.
+'''
+
+import json
+import subprocess
+import threading
+import time
+
+STATE_PROPERTY = "org.maloneyos:journal"
+STEP_PREFIX = "org.maloneyos:step."
+
+class Journal:
+    '''
+    Finished steps of an install and their outputs, persisted on the pool.
+    '''
+    def __init__(self, pool, disk):
+        self.pool = pool
+        self.disk = disk
+        self.entries = {}
+        self.attached = False
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def load(self, mnt):
+        '''
+        Import the pool an earlier attempt left behind and read its journal.
+        Returns True when there is an unfinished install of the same disk to resume.
+        '''
+        imported = self.pool in _pools()
+        if not imported:
+            result = subprocess.run(["zpool", "import", "-f", "-N", "-R", mnt, self.pool], capture_output=True, check=False)
+            if result.returncode != 0:
+                return False
+
+        properties = _properties(self.pool)
+        state = json.loads(properties.get(STATE_PROPERTY, "{}"))
+        if state.get("state") != "running" or state.get("disk") != self.disk:
+            # Nothing to resume, leave the pool the way we found it
+            if not imported:
+                subprocess.run(["zpool", "export", self.pool], check=True)
+            return False
+
+        for name, value in properties.items():
+            if name.startswith(STEP_PREFIX):
+                self.entries[name[len(STEP_PREFIX):]] = json.loads(value)
+        self.attached = True
+        print(f"Resuming install on {self.disk}, {len(self.entries)} steps already done: {', '.join(sorted(self.entries))}")
+        return True
+
+    def complete(self, name):
+        '''
+        Whether a step finished in this or an earlier run.
+        '''
+        return name in self.entries
+
+    def outputs(self, name):
+        '''
+        What a step recorded that it produced, empty if it never finished.
+        '''
+        return self.entries.get(name, {}).get("outputs", {})
+
+    def record(self, name, outputs=None):
+        '''
+        Mark a step as finished with what it produced.
+        '''
+        entry = {"finished": round(time.time()), "outputs": outputs or {}}
+        with self._lock:
+            self.entries[name] = entry
+            if not self.attached:
+                self._pending.append(name)
+                return
+        self._write({STEP_PREFIX + name: json.dumps(entry, sort_keys=True)})
+
+    def attach(self):
+        '''
+        Start writing to the pool once it exists, including the steps that finished before it.
+        '''
+        with self._lock:
+            self.attached = True
+            pending, self._pending = self._pending, []
+        properties = {STATE_PROPERTY: json.dumps({"state": "running", "disk": self.disk})}
+        for name in pending:
+            properties[STEP_PREFIX + name] = json.dumps(self.entries[name], sort_keys=True)
+        self._write(properties)
+
+    def finish(self):
+        '''
+        Mark the install complete so a later install to this disk starts fresh.
+        '''
+        self._write({STATE_PROPERTY: json.dumps({"state": "complete", "disk": self.disk})})
+        with self._lock:
+            self.attached = False
+
+    def _write(self, properties):
+        '''
+        Store properties on the pool's root dataset.
+        '''
+        command = ["zfs", "set"]
+        for name, value in properties.items():
+            command.append(f"{name}={value}")
+        subprocess.run(command + [self.pool], check=True)
+
+def _pools():
+    '''
+    Names of the pools that are imported.
+    '''
+    result = subprocess.run(["zpool", "list", "-H", "-o", "name"], capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+def _properties(dataset):
+    '''
+    The locally set properties of a dataset.
+    '''
+    result = subprocess.run(["zfs", "get", "-H", "-p", "-s", "local", "-o", "property,value", "all", dataset],
+                            capture_output=True, text=True, check=True)
+    properties = {}
+    for line in result.stdout.splitlines():
+        name, _, value = line.partition("\t")
+        properties[name] = value
+    return properties
+
+# End-of-file (EOF)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+'''
+Buffered sink for the backend output shown by the installer.
+
+Output can arrive in many small chunks, so the sink only collects it and the installer
+drains it at a fixed refresh rate, which keeps the GUI thread from being flooded. The
+complete output is streamed to a log file by a background thread, and the sink keeps
+line and byte counts with the throughput over the last few seconds.
+'''
+
+import collections
+import os
+import queue
+import threading
+import time
+
+# Full installer log on the live system
+LOG_FILE = "/tmp/maloneyos-install.log"
+
+# Lines the display keeps and how far back the throughput is measured
+MAX_LINES = 5000
+RATE_WINDOW = 5.0
+
+class LogSink:
+    '''
+    Collects output from any thread for the display, a log file and statistics.
+    '''
+    def __init__(self, path=LOG_FILE, max_lines=MAX_LINES):
+        self.path = path
+        self.max_lines = max_lines
+        self.line_count = 0
+        self.byte_count = 0
+        self._pending = []
+        self._samples = collections.deque()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_file, daemon=True)
+        self._writer.start()
+
+    def write(self, text):
+        '''
+        Add whole lines of output, a progress bar redrawn with carriage returns only keeps its
+        last state for display.
+        '''
+        if not text:
+            return
+        self._queue.put(text)
+        lines = [line.rsplit("\r", 1)[-1] for line in (text[:-1] if text.endswith("\n") else text).split("\n")]
+        with self._lock:
+            self._pending.extend(lines)
+            self.line_count += len(lines)
+            self.byte_count += len(text.encode("utf-8", "replace"))
+            self._samples.append((time.monotonic(), len(lines), len(text)))
+
+    def drain(self):
+        '''
+        Output collected since the last drain as one block of text, empty if there is none.
+        Only the last max_lines lines are returned when more arrived in between.
+        '''
+        with self._lock:
+            pending = self._pending[-self.max_lines:]
+            self._pending = []
+        return "\n".join(pending)
+
+    def throughput(self):
+        '''
+        Lines and bytes per second over the last few seconds.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            while self._samples and self._samples[0][0] < now - RATE_WINDOW:
+                self._samples.popleft()
+            lines = sum(sample[1] for sample in self._samples)
+            size = sum(sample[2] for sample in self._samples)
+        return lines / RATE_WINDOW, size / RATE_WINDOW
+
+    def status(self):
+        '''
+        One line summary of the output statistics.
+        '''
+        lines, size = self.throughput()
+        return f"{self.line_count} lines, {lines:.0f} lines/s, {size / 1024:.1f} KiB/s, log in {self.path}"
+
+    def _write_file(self):
+        '''
+        Append queued output to the log file until close() is called.
+        '''
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                chunks = [self._queue.get()]
+                # Write everything that queued up while waiting in one go
+                while not self._queue.empty():
+                    chunks.append(self._queue.get_nowait())
+                done = None in chunks
+                f.write("".join(chunk for chunk in chunks if chunk is not None))
+                f.flush()
+                if done:
+                    return
+
+    def close(self):
+        '''
+        Finish writing the log file.
+        '''
+        self._queue.put(None)
+        self._writer.join()
+
+# End-of-file (EOF)
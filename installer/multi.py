@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+'''
+Install independent systems to several disks at once from one installer session.
+
+Every disk gets an install of its own with its own mount directory, journal and event
+log, whose events carry the disk so each disk's progress can be followed on its own. Its
+pool is created under a temporary name with zpool create -t, so the pools do not collide
+while they are imported and each one carries the name from the answers once exported.
+
+The installs run their steps side by side and the root image is read only once: when
+every install reached the install step, one reader feeds a zfs receive per disk, or one
+tar of the squashfs feeds a tar extracting onto every disk. A disk that fails drops out
+without stopping the others.
+
+The disks are meant for other machines, so no boot entries are added to this machine's
+firmware and ZFSBootMenu is also put at the path firmware looks for on removable media.
+Nothing is sized for this machine's RAM either: every disk gets the largest swap
+partition and the ARC keeps the zfs module's defaults for the RAM it boots with.
+All disks share the hostid generated once at the start. Needs root.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import answers
+import backend
+import events
+import extract
+import netsource
+import receive
+import scheduler
+
+class FanOut:
+    '''
+    Lays the image down once for every install that reaches the install step.
+    '''
+    def __init__(self, contexts):
+        self.pending = {ctx.pool for ctx in contexts}
+        self.ready = []
+        self.results = {}
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        '''
+        Wait for the installs in the background and read the image once they are all ready.
+        '''
+        self.thread.start()
+
+    def leave(self, ctx):
+        '''
+        An install that failed before its install step no longer holds up the others.
+        '''
+        with self.condition:
+            self.pending.discard(ctx.pool)
+            self.condition.notify_all()
+
+    def install(self, ctx):
+        '''
+        The install step of one disk, returns once the image was laid down on it.
+        '''
+        with self.condition:
+            self.ready.append(ctx)
+            self.pending.discard(ctx.pool)
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: ctx.pool in self.results)
+            result = self.results[ctx.pool]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _run(self):
+        '''
+        Lay the image down on every install waiting for it and hand each one its result.
+        '''
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending)
+            targets = list(self.ready)
+        try:
+            results = lay_down(targets) if targets else {}
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Without the image no install can go on, each one fails with the reason
+            results = {ctx.pool: e for ctx in targets}
+        with self.condition:
+            self.results.update(results)
+            self.condition.notify_all()
+
+def _each(targets, function, results):
+    '''
+    Call function for every target, the ones it fails for get the error as their result.
+    '''
+    remaining = []
+    for ctx in targets:
+        try:
+            function(ctx)
+            remaining.append(ctx)
+        except (OSError, subprocess.CalledProcessError) as e:
+            results[ctx.pool] = e
+    return remaining
+
+def _reporter(targets):
+    '''
+    Report progress to the event log of every target.
+    '''
+    reports = [backend.ExtractReport(ctx.events) for ctx in targets]
+    def report(progress):
+        for target_report in reports:
+            target_report(progress)
+    return report
+
+def receive_all(targets, stream, size):
+    '''
+    Receive one send stream into the root dataset of every target at the same time.
+    '''
+    results = {}
+    targets = _each(targets, backend.clear_root, results)
+    options = [arg for name, value in backend.RECEIVE_PROPERTIES.items() for arg in ("-o", f"{name}={value}")]
+    processes = {ctx.pool: subprocess.Popen(["zfs", "receive", "-u"] + options + [f"{ctx.pool}/ROOT/arch"],  # pylint: disable=consider-using-with
+                                            stdin=subprocess.PIPE) for ctx in targets}
+    progress = extract.Progress(total_bytes=size)
+    print(f"Receiving {getattr(stream, 'name', stream)} into {len(processes)} pools")
+    extract.fan_out(stream, list(processes.values()), progress, _reporter(targets))
+
+    received = []
+    for ctx in targets:
+        process = processes[ctx.pool]
+        if process.wait() != 0:
+            results[ctx.pool] = subprocess.CalledProcessError(process.returncode, process.args)
+        else:
+            received.append(ctx)
+    for ctx in _each(received, backend.mount_received, results):
+        results[ctx.pool] = {"method": "receive", "bytes": progress.bytes, "targets": len(processes)}
+    return results
+
+def extract_all(targets, source):
+    '''
+    Extract the squashfs onto every target with one tar reading it and one tar per target writing.
+    '''
+    results = {}
+    files, total = extract.scan_image(source)
+    progress = extract.Progress(files, total)
+    with extract.mounted(source) as src, subprocess.Popen(extract.tar_create(src), stdout=subprocess.PIPE) as producer:
+        consumers = {ctx.pool: subprocess.Popen(extract.tar_unpack(ctx.mnt), stdin=subprocess.PIPE)  # pylint: disable=consider-using-with
+                     for ctx in targets}
+        print(f"Extracting {source} onto {len(consumers)} disks")
+        broken = extract.fan_out(producer.stdout, list(consumers.values()), progress, _reporter(targets))
+        if len(broken) == len(consumers):
+            producer.kill()
+        failed = producer.wait() != 0
+        for ctx in targets:
+            consumer = consumers[ctx.pool]
+            returncode = consumer.wait()
+            if failed:
+                results[ctx.pool] = subprocess.CalledProcessError(producer.returncode, producer.args)
+            elif returncode != 0:
+                results[ctx.pool] = subprocess.CalledProcessError(returncode, consumer.args)
+            else:
+                results[ctx.pool] = {"method": "extract", "strategy": "tar", "files": files, "bytes": progress.bytes,
+                                     "targets": len(consumers)}
+    return results
+
+def lay_down(targets):
+    '''
+    Put the root filesystem on every target, choosing the source the way backend.install() does.
+    '''
+    source = targets[0].netsource
+    if source is not None:
+        if backend.INSTALL_METHOD == "auto" and source.has(netsource.STREAM):
+            return receive_all(targets, source.open(netsource.STREAM), source.size(netsource.STREAM))
+        image = os.path.join(targets[0].mnt, backend.NETWORK_IMAGE)
+        source.download(netsource.IMAGE, image, _reporter(targets))
+        try:
+            return extract_all(targets, image)
+        finally:
+            os.remove(image)
+
+    stream = (targets[0].stream or receive.find_stream()) if backend.INSTALL_METHOD == "auto" else None
+    if stream:
+        with open(stream, "rb") as f:
+            return receive_all(targets, f, os.path.getsize(stream))
+    return extract_all(targets, targets[0].source or extract.find_airootfs_device())
+
+def selections(raw, disks):
+    '''
+    Validated answers for every disk, raising AnswerError with the problems of all of them.
+    '''
+    problems = []
+    if not isinstance(raw, dict):
+        raise answers.AnswerError(["the answers must be a JSON object"])
+    pool = raw.get("pool", {}) if isinstance(raw.get("pool"), dict) else {}
+    if pool.get("layout", "stripe") != "stripe" or any(pool.get(role) for role in answers.AUX_VDEVS):
+        problems.append("every disk gets a system of its own, pool layouts and vdevs across disks are not supported")
+    if len(set(disks)) != len(disks):
+        problems.append("a disk is listed more than once")
+    found = []
+    for disk in disks:
+        single = {**{key: value for key, value in raw.items() if key not in ("disk", "disks")}, "disk": disk}
+        try:
+            found.append(answers.validate(single))
+        except answers.AnswerError as e:
+            problems.extend(f"{disk}: {problem}" for problem in e.problems)
+    if problems:
+        raise answers.AnswerError(problems)
+    return found
+
+def install(ctx):
+    '''
+    Run the steps of one install, returning the error that ended it, None when it finished.
+    '''
+    try:
+        scheduler.Scheduler(backend.STEPS, backend.MAX_PARALLEL_STEPS).run(ctx, ctx.journal, ctx.events)
+        return None
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # One disk failing is part of the result, the others go on
+        ctx.fanout.leave(ctx)
+        if ctx.session is not None:
+            ctx.session.close()
+        return str(e)
+    finally:
+        ctx.events.save(f"{os.path.splitext(events.LIVE_REPORT)[0]}-{os.path.basename(ctx.disk)}.json")
+
+def provision(found):
+    '''
+    Install to every disk at the same time and return the summary of each install.
+    '''
+    # Every install only touches its own pool from here on
+    subprocess.run(["zpool", "export", "-a"], check=True)
+    subprocess.run(["zgenhostid", "-f"], check=True)
+
+    contexts = []
+    for number, selection in enumerate(found, 1):
+        ctx = backend.Install(selection, mnt=f"{backend.MNT}-{number}", pool=f"{selection['pool']['name']}-{number}")
+        ctx.exclusive = False
+        ctx.events = events.EventLog(target=ctx.disk)
+        contexts.append(ctx)
+    fanout = FanOut(contexts)
+    for ctx in contexts:
+        ctx.fanout = fanout
+
+    # The boot media or install server is looked up once for all of them
+    backend.detect_media(contexts[0])
+    for ctx in contexts[1:]:
+        ctx.netsource = contexts[0].netsource
+    fanout.start()
+
+    errors = {}
+    def run(ctx):
+        errors[ctx.pool] = install(ctx)
+    threads = [threading.Thread(target=run, args=(ctx,)) for ctx in contexts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [backend.summary(ctx, errors[ctx.pool] is None, errors[ctx.pool]) for ctx in contexts]
+
+def main():
+    '''
+    Command line entry point for installing to several disks at once.
+    '''
+    parser = argparse.ArgumentParser(description="Install MaloneyOS to several disks at once, each disk a system of its own.")
+    parser.add_argument("disks", nargs="+", help="disks to install to, everything on them is erased")
+    parser.add_argument("--answers", default=answers.WIZARD_ANSWERS, help="answer file used for every disk, its disk is ignored")
+    parser.add_argument("--summary", help="write a JSON summary of every install to this file, - for stdout")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        parser.error("needs root")
+    try:
+        with open(args.answers, encoding="utf-8") as f:
+            found = selections(json.load(f), args.disks)
+    except answers.AnswerError as e:
+        print(e, file=sys.stderr)
+        if args.summary:
+            backend.write_summary(args.summary, {"ok": False, "error": "invalid answers", "problems": e.problems})
+        sys.exit(backend.EXIT_INVALID)
+    except (OSError, ValueError) as e:
+        parser.error(f"cannot read {args.answers}: {e}")
+
+    summaries = provision(found)
+    for result in summaries:
+        print(f"{result['disk']}: {'installed' if result['ok'] else 'failed: ' + str(result['error'])}")
+    ok = all(result["ok"] for result in summaries)
+    if args.summary:
+        backend.write_summary(args.summary, {"ok": ok, "targets": summaries})
+    sys.exit(backend.EXIT_OK if ok else backend.EXIT_FAILED)
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+'''
+Install source on a local HTTP server instead of the boot media.
+
+The server offers the files of a built ISO tree: the squashfs, the send stream when the
+ISO has one, the kernel and the microcode, next to a manifest with the size and the
+sha256 of every fixed size chunk of each file. The installer fetches chunks over several
+connections with range requests, checks every chunk against the manifest and hands them
+on in order, so zfs receive consumes the send stream while the rest is still downloading.
+The squashfs needs random access and is downloaded before it is extracted.
+
+Servers that ignore range requests, like a plain python3 -m http.server, are read with a
+single connection and the chunks are still checked. Run this script with serve to offer
+a mounted ISO to a whole lab, or with manifest to write the manifest for another server.
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import re
+import time
+import urllib.parse
+import urllib.request
+
+import extract
+
+MANIFEST = "maloneyos-netsource.json"
+IMAGE = "arch/x86_64/airootfs.sfs"
+STREAM = "arch/x86_64/airootfs.zfs"
+BOOT_FILES = [
+    "arch/boot/x86_64/vmlinuz-linux-lts",
+    "arch/boot/amd-ucode.img",
+    "arch/boot/intel-ucode.img",
+]
+SERVED_FILES = [IMAGE, STREAM] + BOOT_FILES
+
+# Size of the chunks that are fetched and checked one at a time
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Parallel connections per file and how many chunks each may fetch ahead of the consumer
+CONNECTIONS = 4
+READ_AHEAD = 2
+
+# Attempts per chunk before the download fails, a chunk is fetched again when its checksum is wrong
+RETRIES = 3
+TIMEOUT = 30
+
+class NetSourceError(Exception):
+    '''
+    The server could not deliver a file that matches the manifest.
+    '''
+
+def _hash_chunk(path, offset, length):
+    '''
+    Hex sha256 of a chunk of a file.
+    '''
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return hashlib.sha256(f.read(length)).hexdigest()
+
+def build_manifest(root, files=None, chunk_size=CHUNK_SIZE):
+    '''
+    Size and chunk checksums of every file below root that is served, hashed in parallel.
+    '''
+    manifest = {"chunk_size": chunk_size, "files": {}}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        for name in files or SERVED_FILES:
+            path = os.path.join(root, name)
+            if not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            offsets = range(0, size, chunk_size)
+            hashes = executor.map(lambda offset, path=path: _hash_chunk(path, offset, chunk_size), offsets)
+            manifest["files"][name] = {"size": size, "sha256": list(hashes)}
+    return manifest
+
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    '''
+    File server that answers single range requests and serves the manifest from memory.
+    '''
+    def do_GET(self):
+        '''
+        Send the manifest, a range of a file or, without a range, the whole file.
+        '''
+        if urllib.parse.urlsplit(self.path).path == f"/{MANIFEST}" and self.server.manifest is not None:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(self.server.manifest)))
+            self.end_headers()
+            self.wfile.write(self.server.manifest)
+            return
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            super().do_GET()
+            return
+
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if start > end:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = f.read(min(remaining, extract.CHUNK_SIZE))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+def serve(root, address="", port=8000, chunk_size=CHUNK_SIZE):
+    '''
+    Offer an ISO tree over HTTP, using its manifest file when it has one.
+    '''
+    manifest_path = os.path.join(root, MANIFEST)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "rb") as f:
+            manifest = f.read()
+    else:
+        print(f"Hashing the files below {root}")
+        manifest = json.dumps(build_manifest(root, chunk_size=chunk_size)).encode()
+    server = http.server.ThreadingHTTPServer((address, port), functools.partial(RangeHandler, directory=root))
+    server.manifest = manifest
+    print(f"Serving {root} on port {port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+class Reader:
+    '''
+    File object over the verified chunks of a remote file, for extract.relay and zfs receive.
+    '''
+    def __init__(self, source, name):
+        self.url = source.url_of(name)
+        self.chunks = source.chunks(name)
+        self.chunk = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        '''
+        Up to size bytes, fewer only at the end of the file.
+        '''
+        parts = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self.offset == len(self.chunk):
+                self.chunk, self.offset = next(self.chunks, b""), 0
+                if not self.chunk:
+                    break
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + wanted)
+            parts.append(self.chunk[self.offset:end])
+            wanted -= end - self.offset
+            self.offset = end
+        return b"".join(parts)
+
+    def __str__(self):
+        return self.url
+
+class Source:
+    '''
+    A server offering the install files, with the manifest read and range support probed.
+    '''
+    def __init__(self, url, connections=CONNECTIONS):
+        self.url = url.rstrip("/") + "/"
+        self.connections = connections
+        try:
+            with urllib.request.urlopen(self.url_of(MANIFEST), timeout=TIMEOUT) as response:
+                self.manifest = json.load(response)
+        except (OSError, ValueError) as e:
+            raise NetSourceError(f"No install source manifest at {self.url_of(MANIFEST)}: {e}") from e
+        self.ranges = self._supports_ranges()
+        if not self.ranges:
+            print(f"{self.url} ignores range requests, downloading over a single connection")
+
+    def url_of(self, name):
+        '''
+        URL of a file on the server.
+        '''
+        return urllib.parse.urljoin(self.url, urllib.parse.quote(name))
+
+    def _supports_ranges(self):
+        '''
+        Whether the server answers a range request with only that range.
+        '''
+        if not self.manifest["files"]:
+            return False
+        request = urllib.request.Request(self.url_of(next(iter(self.manifest["files"]))), headers={"Range": "bytes=0-0"})
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                return response.status == 206
+        except OSError:
+            return False
+
+    def has(self, name):
+        '''
+        Whether the server offers a file.
+        '''
+        return name in self.manifest["files"]
+
+    def _file(self, name):
+        '''
+        Manifest entry of a file, raising NetSourceError when the server does not offer it.
+        '''
+        if name not in self.manifest["files"]:
+            raise NetSourceError(f"{self.url} does not offer {name}, it is missing from {self.url_of(MANIFEST)}")
+        return self.manifest["files"][name]
+
+    def size(self, name):
+        '''
+        Size of a file on the server in bytes.
+        '''
+        return self._file(name)["size"]
+
+    def _check(self, name, index, data):
+        '''
+        Raise NetSourceError when a chunk does not match the manifest.
+        '''
+        if hashlib.sha256(data).hexdigest() != self._file(name)["sha256"][index]:
+            raise NetSourceError(f"Chunk {index} of {name} does not match its checksum")
+
+    def _chunk(self, name, index):
+        '''
+        Fetch one chunk with a range request and check it, trying again when that fails.
+        '''
+        chunk_size = self.manifest["chunk_size"]
+        start = index * chunk_size
+        end = min(start + chunk_size, self.size(name)) - 1
+        request = urllib.request.Request(self.url_of(name), headers={"Range": f"bytes={start}-{end}"})
+        error = None
+        for attempt in range(RETRIES):
+            try:
+                with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                    if response.status != 206:
+                        raise NetSourceError(f"{self.url_of(name)} answered a range request with status {response.status}")
+                    data = response.read()
+                self._check(name, index, data)
+                return data
+            except (OSError, NetSourceError) as e:
+                error = e
+                time.sleep(attempt + 1)
+        raise NetSourceError(f"Failed to fetch chunk {index} of {name} after {RETRIES} attempts: {error}")
+
+    def _sequential(self, name):
+        '''
+        The chunks of a file read from one plain download, each one checked.
+        '''
+        chunk_size = self.manifest["chunk_size"]
+        with urllib.request.urlopen(self.url_of(name), timeout=TIMEOUT) as response:
+            for index in range(len(self._file(name)["sha256"])):
+                data = response.read(chunk_size)
+                self._check(name, index, data)
+                yield data
+
+    def chunks(self, name):
+        '''
+        The verified chunks of a file in order, the next ones are fetched in parallel meanwhile.
+        '''
+        if not self.ranges:
+            yield from self._sequential(name)
+            return
+        indices = iter(range(len(self._file(name)["sha256"])))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.connections) as executor:
+            pending = collections.deque(executor.submit(self._chunk, name, index)
+                                        for index in itertools.islice(indices, self.connections * READ_AHEAD))
+            while pending:
+                data = pending.popleft().result()
+                index = next(indices, None)
+                if index is not None:
+                    pending.append(executor.submit(self._chunk, name, index))
+                yield data
+
+    def open(self, name):
+        '''
+        A file object reading a file from the server.
+        '''
+        return Reader(self, name)
+
+    def download(self, name, path, report=None):
+        '''
+        Download a file to path, calling report(progress) as it goes, and return the Progress.
+        '''
+        progress = extract.Progress(total_files=1, total_bytes=self.size(name))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(f"{path}.part", "wb") as f:
+                extract.relay(self.open(name), [f], progress, report)
+            os.replace(f"{path}.part", path)
+        finally:
+            if os.path.exists(f"{path}.part"):
+                os.remove(f"{path}.part")
+        progress.files = 1
+        if report:
+            report(progress)
+        return progress
+
+def main():
+    '''
+    Command line entry point for serving, describing and fetching an install source.
+    '''
+    parser = argparse.ArgumentParser(description="Install MaloneyOS from an HTTP server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="offer a mounted ISO or ISO tree over HTTP")
+    serve_parser.add_argument("root", nargs="?", default="/run/archiso/bootmnt", help="ISO tree to serve")
+    serve_parser.add_argument("--address", default="", help="address to listen on, every address by default")
+    serve_parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    serve_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="bytes per checked chunk")
+    manifest_parser = commands.add_parser("manifest", help="write the manifest into an ISO tree for another web server")
+    manifest_parser.add_argument("root", help="ISO tree to describe")
+    manifest_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="bytes per checked chunk")
+    fetch_parser = commands.add_parser("fetch", help="download and check one file from a server")
+    fetch_parser.add_argument("url", help="URL the ISO tree is served at")
+    fetch_parser.add_argument("name", choices=SERVED_FILES, help="file to download")
+    fetch_parser.add_argument("destination", help="where to save it")
+    fetch_parser.add_argument("--connections", type=int, default=CONNECTIONS, help="parallel connections")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.root, args.address, args.port, args.chunk_size)
+    elif args.command == "manifest":
+        with open(os.path.join(args.root, MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(build_manifest(args.root, chunk_size=args.chunk_size), f)
+        print(f"Wrote {os.path.join(args.root, MANIFEST)}")
+    else:
+        try:
+            progress = Source(args.url, args.connections).download(args.name, args.destination)
+        except NetSourceError as e:
+            parser.exit(1, f"{e}\n")
+        print(f"Fetched {progress.bytes // 1048576} MiB in {progress.elapsed():.1f}s "
+              f"({progress.throughput() / 1048576:.1f} MiB/s)")
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
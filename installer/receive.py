@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''
+Restore the root dataset from a zfs send stream shipped on the ISO.
+
+When the image was built with a send stream of the reference root dataset,
+backend.install() receives it into the new pool instead of extracting the squashfs
+file by file. The receive writes large sequential records and skips the per-file
+metadata work, the squashfs stays on the ISO as the fallback. Run this script with
+--benchmark to compare both ways on the current hardware.
+'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+
+import extract
+
+STREAM_FILES = [
+    "/run/archiso/bootmnt/arch/x86_64/airootfs.zfs",
+]
+
+# Pool created on a sparse file for benchmarking, sized well above the image
+BENCHMARK_POOL = "maloneyos-bench"
+BENCHMARK_SIZE = 64 * 1024 * 1024 * 1024
+
+def find_stream():
+    '''
+    Path of the send stream on the boot media, None when the ISO was built without one.
+    '''
+    if shutil.which("zfs") is None:
+        return None
+    return next((path for path in STREAM_FILES if os.path.isfile(path)), None)
+
+def receive(stream, dataset, report=None, properties=None):
+    '''
+    Receive a send stream into a new, unmounted dataset while reporting the bytes read.
+    '''
+    with open(stream, "rb") as source:
+        return receive_from(source, os.path.getsize(stream), dataset, report, properties)
+
+def receive_from(source, size, dataset, report=None, properties=None):
+    '''
+    Receive a send stream of a known size read from a file object, like one reading from the network.
+    '''
+    options = []
+    for name, value in (properties or {}).items():
+        options += ["-o", f"{name}={value}"]
+    progress = extract.Progress(total_bytes=size)
+    with subprocess.Popen(["zfs", "receive", "-u"] + options + [dataset], stdin=subprocess.PIPE) as process:
+        try:
+            extract.relay(source, [process.stdin], progress, report)
+        finally:
+            process.stdin.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    if report:
+        report(progress)
+    return progress
+
+def _dataset_stats(dataset):
+    '''
+    Space used and written by a dataset according to zfs.
+    '''
+    output = subprocess.check_output(["zfs", "get", "-Hp", "-o", "property,value", "used,logicalused", dataset], text=True)
+    return {name: int(value) for name, value in (line.split("\t") for line in output.splitlines())}
+
+def benchmark(source, stream, workdir, strategy="unsquashfs"):
+    '''
+    Time receiving the stream against extracting the squashfs into a dataset on the same pool.
+    '''
+    backing = os.path.join(workdir, f"{BENCHMARK_POOL}.img")
+    altroot = tempfile.mkdtemp(prefix=f"{BENCHMARK_POOL}-", dir=workdir)
+    with open(backing, "wb") as f:
+        f.truncate(BENCHMARK_SIZE)
+    subprocess.run(["zpool", "create", "-f", "-o", "ashift=12", "-O", "compression=zstd", "-O", "acltype=posixacl",
+                    "-O", "xattr=sa", "-O", "dnodesize=auto", "-O", "normalization=formD", "-O", "relatime=on", "-m", "none", "-R", altroot,
+                    BENCHMARK_POOL, backing], check=True)
+    results = []
+    try:
+        progress = receive(stream, f"{BENCHMARK_POOL}/received", properties={"mountpoint": "/received"})
+        results.append({"method": "receive", "seconds": round(progress.elapsed(), 2), "bytes": progress.bytes,
+                        "mib_per_second": round(progress.throughput() / (1024 * 1024), 1), **_dataset_stats(f"{BENCHMARK_POOL}/received")})
+
+        subprocess.run(["zfs", "create", "-o", "mountpoint=/extracted", f"{BENCHMARK_POOL}/extracted"], check=True)
+        progress = extract.extract(source, os.path.join(altroot, "extracted"), strategy)
+        subprocess.run(["zpool", "sync", BENCHMARK_POOL], check=True)
+        results.append({"method": strategy, "seconds": round(progress.elapsed(), 2), "files": progress.files, "bytes": progress.bytes,
+                        "mib_per_second": round(progress.throughput() / (1024 * 1024), 1), **_dataset_stats(f"{BENCHMARK_POOL}/extracted")})
+    finally:
+        subprocess.run(["zpool", "destroy", "-f", BENCHMARK_POOL], check=False)
+        os.remove(backing)
+        shutil.rmtree(altroot, ignore_errors=True)
+    fastest = min(results, key=lambda result: result["seconds"])["method"] if len(results) == 2 else None
+    return {"hardware": extract.hardware(), "source": source, "stream": stream, "results": results, "fastest": fastest}
+
+def main():
+    '''
+    Command line entry point for comparing zfs receive with squashfs extraction on this machine.
+    '''
+    parser = argparse.ArgumentParser(description="Compare installing by zfs receive with extracting the squashfs.")
+    parser.add_argument("--benchmark", action="store_true", help="time both ways of installing")
+    parser.add_argument("--source", help="squashfs image or device, found automatically by default")
+    parser.add_argument("--stream", help="zfs send stream, found automatically by default")
+    parser.add_argument("--workdir", default="/tmp", help="directory for the sparse file backing the scratch pool")
+    parser.add_argument("--strategy", default="unsquashfs", choices=sorted(extract.STRATEGIES), help="extraction strategy to compare against")
+    parser.add_argument("--output", help="append the JSON report to this file")
+    args = parser.parse_args()
+
+    stream = args.stream or find_stream()
+    if not args.benchmark:
+        print(stream or "No send stream on this ISO")
+        return
+    if stream is None:
+        parser.error("no send stream found, pass --stream")
+
+    extract.print_report(benchmark(args.source or extract.find_airootfs_device(), stream, args.workdir, args.strategy), args.output)
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
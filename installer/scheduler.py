@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+'''
+Dependency graph scheduler for the install steps.
+
+Each step names the resources it requires and the resources it provides. A step
+becomes ready once every step providing its requirements has finished, and ready
+steps run in parallel up to a concurrency limit. After a run the scheduler reports
+the critical path, the chain of steps that set the wall-clock time.
+
+Given a journal, steps an earlier run already finished are skipped as long as their
+verify check passes and nothing they depend on had to run again. Given an event log,
+every step start, end and skip is emitted as a structured event.
+'''
+
+import concurrent.futures
+import time
+
+class Step:
+    '''
+    An install step with the resources it needs and the resources it produces.
+    '''
+    def __init__(self, name, func, requires=(), provides=(), **options):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.provides = tuple(provides)
+        # Steps that only set up state for this run, like mounts, are never resumable
+        self.resumable = options.get("resumable", True)
+        # Called as verify(context, outputs) to check a journaled result is still there
+        self.verify = options.get("verify")
+
+class Scheduler:
+    '''
+    Runs steps as soon as their inputs are ready, at most workers at a time.
+    '''
+    def __init__(self, steps, workers=4):
+        self.steps = {}
+        self.workers = workers
+        self.timings = {}
+        providers = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"Duplicate step: {step.name}")
+            self.steps[step.name] = step
+            for resource in step.provides:
+                if resource in providers:
+                    raise ValueError(f"{resource} is provided by both {providers[resource]} and {step.name}")
+                providers[resource] = step.name
+
+        # Each step depends on the steps that provide what it requires
+        self.depends = {}
+        for step in steps:
+            missing = [resource for resource in step.requires if resource not in providers]
+            if missing:
+                raise ValueError(f"Nothing provides {', '.join(missing)} for {step.name}")
+            self.depends[step.name] = {providers[resource] for resource in step.requires}
+        self.order = self._sort()
+
+    def _sort(self):
+        '''
+        Order the steps so every step comes after its dependencies, rejecting cycles.
+        '''
+        order = []
+        remaining = dict(self.depends)
+        while remaining:
+            ready = [name for name, depends in remaining.items() if depends <= set(order)]
+            if not ready:
+                raise ValueError(f"Dependency cycle between: {', '.join(sorted(remaining))}")
+            for name in ready:
+                order.append(name)
+                del remaining[name]
+        return order
+
+    def run(self, context, journal=None, events=None):
+        '''
+        Run every step with context as its argument, raising the first failure once running steps finish.
+        Finished steps are recorded in the journal along with the outputs they return.
+        '''
+        emit = events.emit if events is not None else lambda event, **fields: None
+        started = time.monotonic()
+        done = set()
+        rerun = set()
+        running = {}
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while len(done) < len(self.steps):
+                if failure is None:
+                    for name in self.order:
+                        if name in done or name in running.values() or len(running) >= self.workers:
+                            continue
+                        if not self.depends[name] <= done:
+                            continue
+                        if journal is not None and self._resumable(name, context, journal, rerun):
+                            print(f"==> Skipping {name}, finished by an earlier run", flush=True)
+                            emit("step-skip", step=name)
+                            done.add(name)
+                            continue
+                        if self.steps[name].resumable or self.depends[name] & rerun:
+                            rerun.add(name)
+                        print(f"==> Starting {name}", flush=True)
+                        emit("step-start", step=name)
+                        running[executor.submit(self._timed, name, context)] = name
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        print(f"==> {name} failed: {future.exception()}", flush=True)
+                        emit("step-end", step=name, ok=False, duration=round(self.duration(name), 3), error=str(future.exception()))
+                        failure = failure or future.exception()
+                        continue
+                    done.add(name)
+                    if journal is not None:
+                        journal.record(name, future.result())
+                    print(f"==> Finished {name} in {self.duration(name):.1f}s", flush=True)
+                    emit("step-end", step=name, ok=True, duration=round(self.duration(name), 3))
+        wall = time.monotonic() - started
+        self.report(wall)
+        path, total = self.critical_path()
+        emit("run-end", ok=failure is None, duration=round(wall, 3), critical_path=path, critical_duration=round(total, 3))
+        if failure is not None:
+            raise failure
+
+    def _resumable(self, name, context, journal, rerun):
+        '''
+        Whether a step can be skipped: an earlier run finished it, its results still verify,
+        and nothing it depends on had to run again in this run.
+        '''
+        step = self.steps[name]
+        if not step.resumable or not journal.complete(name) or self.depends[name] & rerun:
+            return False
+        return step.verify is None or step.verify(context, journal.outputs(name))
+
+    def _timed(self, name, context):
+        '''
+        Run one step, remember when it started and finished, and return its outputs.
+        '''
+        start = time.monotonic()
+        try:
+            return self.steps[name].func(context)
+        finally:
+            self.timings[name] = (start, time.monotonic())
+
+    def duration(self, name):
+        '''
+        How long a finished step took in seconds.
+        '''
+        start, end = self.timings.get(name, (0.0, 0.0))
+        return end - start
+
+    def critical_path(self):
+        '''
+        The chain of dependent steps with the longest total duration and its length in seconds.
+        '''
+        longest = {}
+        previous = {}
+        for name in self.order:
+            before = max(self.depends[name], key=lambda depend: longest[depend], default=None)
+            longest[name] = self.duration(name) + (longest[before] if before else 0.0)
+            previous[name] = before
+        if not longest:
+            return [], 0.0
+        name = max(longest, key=longest.get)
+        total = longest[name]
+        path = []
+        while name:
+            path.append(name)
+            name = previous[name]
+        return list(reversed(path)), total
+
+    def report(self, wall):
+        '''
+        Print how long each step took, the serial total and the critical path.
+        '''
+        for name in self.order:
+            if name in self.timings:
+                print(f"{name:<16} {self.duration(name):8.1f}s")
+        path, total = self.critical_path()
+        serial = sum(self.duration(name) for name in self.timings)
+        print(f"Wall clock {wall:.1f}s, serial total {serial:.1f}s")
+        print(f"Critical path ({total:.1f}s): {' -> '.join(path)}", flush=True)
+
+# End-of-file (EOF)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+'''
+Stand-in for the commands the install needs real hardware or UEFI firmware for.
+
+benchmark.py puts a wrapper named after each command in INTERCEPT first in PATH, the
+wrapper runs this file with the command name and its arguments. Calls the command does
+not need hardware for are handed to the real command untouched. The others are, with
+MALONEYOS_SHIM_MODE=record, run for real and their output and exit status appended to
+the MALONEYOS_SHIM_LOG file, and with MALONEYOS_SHIM_MODE=replay answered from that
+file, or with no output and success when nothing was recorded. Paths that change from
+run to run, like loop devices, are recorded as placeholders.
+
+Only uses the standard library, it also runs inside the target's chroot.
+'''
+
+import json
+import os
+import subprocess
+import sys
+
+# Commands and the argument that marks a call needing hardware, None for every call
+INTERCEPT = {
+    "efibootmgr": None,
+    "mount": "efivarfs",
+    "umount": "efivars",
+}
+
+MODE = "MALONEYOS_SHIM_MODE"
+LOG = "MALONEYOS_SHIM_LOG"
+DIR = "MALONEYOS_SHIM_DIR"
+# JSON object of paths and the placeholders they are recorded as
+PATHS = "MALONEYOS_SHIM_PATHS"
+
+def real_command(name):
+    '''
+    Path of the command the wrapper stands in for, searching PATH without the wrappers.
+    '''
+    shims = os.environ.get(DIR, "")
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, name)
+        if directory != shims and os.access(path, os.X_OK) and not os.path.isdir(path):
+            return path
+    raise FileNotFoundError(f"{name} not found in PATH")
+
+def normalize(args, paths):
+    '''
+    Arguments with run specific paths replaced by their placeholders, longest paths first.
+    '''
+    normalized = []
+    for arg in args:
+        for path in sorted(paths, key=len, reverse=True):
+            arg = arg.replace(path, paths[path])
+        normalized.append(arg)
+    return normalized
+
+def record(name, args, paths):
+    '''
+    Run the real command, pass its output on and append the call to the log.
+    '''
+    result = subprocess.run([real_command(name)] + args, stdout=subprocess.PIPE, text=True, check=False)
+    entry = {"command": name, "args": normalize(args, paths), "returncode": result.returncode,
+             "stdout": normalize([result.stdout], paths)[0]}
+    with open(os.environ[LOG], "a", encoding="utf-8") as log:
+        log.write(json.dumps(entry) + "\n")
+    sys.stdout.write(result.stdout)
+    return result.returncode
+
+def replay(name, args, paths):
+    '''
+    Answer a call from the log, the last matching recording wins.
+    '''
+    key = normalize(args, paths)
+    found = None
+    if os.path.exists(os.environ.get(LOG, "")):
+        with open(os.environ[LOG], encoding="utf-8") as log:
+            for line in log:
+                entry = json.loads(line)
+                if entry["command"] == name and entry["args"] == key:
+                    found = entry
+    if found is None:
+        return 0
+    stdout = found["stdout"]
+    for path, placeholder in paths.items():
+        stdout = stdout.replace(placeholder, path)
+    sys.stdout.write(stdout)
+    return found["returncode"]
+
+def main():
+    '''
+    Entry point of the wrappers: shim.py COMMAND ARGS...
+    '''
+    name, args = sys.argv[1], sys.argv[2:]
+    marker = INTERCEPT.get(name)
+    if name in INTERCEPT and (marker is None or any(marker in arg for arg in args)):
+        paths = json.loads(os.environ.get(PATHS, "{}"))
+        mode = os.environ.get(MODE, "replay")
+        sys.exit(record(name, args, paths) if mode == "record" else replay(name, args, paths))
+    command = real_command(name)
+    os.execv(command, [command] + args)
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+'''
+Pick the pool's ashift and compression for the hardware being installed to.
+
+The ashift follows the largest physical sector size or optimal IO size of the pool's disks,
+never below 4K since plenty of flash reports 512 byte sectors it does not have. For
+compression, a sample of the files the image installs is compressed with lz4 and a few
+zstd levels using their command line tools. Each candidate is scored by how many bytes
+per second it lets the pool take in: limited either by compressing on every core or by
+the disks writing the compressed data. The decision and the measurements behind it are
+kept on the pool as org.maloneyos:tune.* user properties. A root received from the
+compressed send stream keeps the blocks as the image build compressed them, which its
+compression-received property says.
+'''
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import time
+
+import answers
+import disks
+
+PROPERTY_PREFIX = "org.maloneyos:tune."
+
+# Files of the live system, the same files the image installs, sampled for compression
+SAMPLE_ROOT = "/usr"
+SAMPLE_SIZE = 32 * 1024 * 1024
+SAMPLE_CHUNK = 128 * 1024
+
+# ZFS compression setting and the command that compresses the same way to stdout
+CANDIDATES = {
+    "lz4": ["lz4", "-1", "-c"],
+    "zstd-1": ["zstd", "-1", "-c", "-T1"],
+    "zstd": ["zstd", "-3", "-c", "-T1"],
+    "zstd-9": ["zstd", "-9", "-c", "-T1"],
+}
+
+# Rough sustained write speed in MB/s when the disk does not tell
+WRITE_SPEED = {"rotational": 150, "nvme": 2000, "ssd": 450}
+
+# A slower candidate wins when it stays within this fraction of the best score and compresses better
+SCORE_TOLERANCE = 0.05
+
+MIN_ASHIFT = 12
+MAX_ASHIFT = 16
+
+def choose_ashift(disk):
+    '''
+    ashift for a disk from its physical sector and optimal IO size, with the reason.
+    '''
+    sizes = {"physical sector": disk.physical_sector_size}
+    # Optimal IO sizes that are not a power of two or are huge describe RAID stripes, not pages
+    if disk.optimal_io_size and disk.optimal_io_size & (disk.optimal_io_size - 1) == 0 and disk.optimal_io_size <= 2 ** MAX_ASHIFT:
+        sizes["optimal IO"] = disk.optimal_io_size
+    source, size = max(sizes.items(), key=lambda item: item[1])
+    ashift = min(max(int(math.log2(size)), MIN_ASHIFT), MAX_ASHIFT)
+    return ashift, f"{source} size {size}"
+
+def write_speed(disk):
+    '''
+    Estimated sustained write speed of a disk in bytes per second.
+    '''
+    if disk.rotational:
+        kind = "rotational"
+    elif disk.transport == "nvme" or disk.name.startswith("nvme"):
+        kind = "nvme"
+    else:
+        kind = "ssd"
+    return WRITE_SPEED[kind] * 1000 * 1000
+
+def pool_write_speed(found, layout):
+    '''
+    Estimated write speed of a pool of these disks in bytes per second.
+    '''
+    speeds = [write_speed(disk) for disk in found]
+    if layout == "stripe":
+        return sum(speeds)
+    if layout == "mirror":
+        return min(speeds)
+    # raidz writes data to all but the parity disks of every stripe
+    parity = int(layout[-1]) if layout[-1].isdigit() else 1
+    return min(speeds) * max(len(speeds) - parity, 1)
+
+def sample(root=SAMPLE_ROOT, size=SAMPLE_SIZE):
+    '''
+    Up to size bytes taken from the start of the regular files below root.
+    '''
+    chunks = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if total >= size:
+                return b"".join(chunks)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "rb") as f:
+                    chunk = f.read(SAMPLE_CHUNK)
+            except OSError:
+                continue
+            chunks.append(chunk)
+            total += len(chunk)
+    return b"".join(chunks)
+
+def measure(data):
+    '''
+    Compression ratio and single core speed in bytes per second of every available candidate.
+    '''
+    results = {}
+    for name, command in CANDIDATES.items():
+        start = time.monotonic()
+        try:
+            compressed = subprocess.run(command, input=data, capture_output=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        elapsed = max(time.monotonic() - start, 1e-6)
+        results[name] = {"ratio": round(len(data) / max(len(compressed), 1), 3), "speed": round(len(data) / elapsed)}
+    return results
+
+def choose_compression(measurements, disk_speed, cores):
+    '''
+    The candidate that lets the pool take in the most data per second, with every score.
+    '''
+    scores = {}
+    for name, result in measurements.items():
+        # ZFS compresses records on every core, the disk then only writes the compressed bytes
+        scores[name] = round(min(result["speed"] * cores, disk_speed * result["ratio"]))
+    if not scores:
+        return "lz4", scores
+    best = max(scores.values())
+    close = [name for name, score in scores.items() if score >= best * (1 - SCORE_TOLERANCE)]
+    return max(close, key=lambda name: measurements[name]["ratio"]), scores
+
+def tune(disk_paths, ashift="auto", compression="auto", layout="stripe"):
+    '''
+    Decide the pool's ashift and compression, keeping values the answers set explicitly.
+    '''
+    found = [disks.find(path) for path in disk_paths]
+    known = [disk for disk in found if disk]
+    result = {"disks": [disk.to_dict() if disk else {"path": path} for disk, path in zip(found, disk_paths)]}
+    if ashift != "auto":
+        result["ashift"], result["ashift_reason"] = ashift, "set in the answers"
+    elif not known:
+        result["ashift"], result["ashift_reason"] = MIN_ASHIFT, "disks not found in sysfs"
+    else:
+        result["ashift"], result["ashift_reason"] = max(choose_ashift(disk) for disk in known)
+
+    if compression != "auto":
+        result["compression"], result["compression_reason"] = compression, "set in the answers"
+        return result
+    data = sample()
+    cores = os.cpu_count() or 1
+    disk_speed = pool_write_speed(known, layout) if known else WRITE_SPEED["ssd"] * 1000 * 1000
+    measurements = measure(data)
+    result["compression"], scores = choose_compression(measurements, disk_speed, cores)
+    result["compression_reason"] = f"best intake for {cores} cores and {disk_speed // 1000000} MB/s writes"
+    result["measurements"] = {"sample_bytes": len(data), "cores": cores, "disk_speed": disk_speed,
+                              "candidates": measurements, "scores": scores}
+    return result
+
+def record(dataset, result):
+    '''
+    Keep the decisions and the measurements behind them as user properties of a dataset.
+    '''
+    properties = {
+        "ashift": result["ashift"],
+        "ashift-reason": result["ashift_reason"],
+        "compression": result["compression"],
+        "compression-reason": result["compression_reason"],
+        "measurements": json.dumps(result.get("measurements", {}), sort_keys=True, separators=(",", ":")),
+    }
+    subprocess.run(["zfs", "set"] + [f"{PROPERTY_PREFIX}{name}={value}" for name, value in properties.items()] + [dataset], check=True)
+
+def record_received(dataset):
+    '''
+    Note on a dataset received from a compressed send stream that its blocks kept the
+    compression the image was built with, the chosen one only applies to later writes.
+    '''
+    subprocess.run(["zfs", "set", f"{PROPERTY_PREFIX}compression-received=blocks kept the compression of the send stream, "
+                    "later writes use the chosen compression", dataset], check=True)
+
+def main():
+    '''
+    Print the tuning decision for a pool without touching its disks.
+    '''
+    parser = argparse.ArgumentParser(description="Show the ashift and compression the installer would pick.")
+    parser.add_argument("disks", nargs="+", help="disks of the pool, for example /dev/nvme0n1")
+    parser.add_argument("--layout", default="stripe", choices=list(answers.LAYOUTS), help="pool layout")
+    args = parser.parse_args()
+    print(json.dumps(tune(args.disks, layout=args.layout), indent=2))
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+'''
+Offline, content-addressed store for the files a build downloads.
+
+Every artifact is pinned in artifacts.json by version, URL and sha256, and is kept in
+the store under its sha256 so a build only downloads it when the cached copy is gone or
+no longer matches its checksum. An artifact without a pinned checksum is an error, run
+this script with --pin to download a new version once and write its checksum into
+artifacts.json for review.
+
+Run it before going offline to fill the store, builds with --offline never use the network.
+'''
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urllib.request
+
+import pkgcache
+
+STORE = os.path.join(pkgcache.CACHE_ROOT, "artifacts")
+OBJECTS = os.path.join(STORE, "sha256")
+MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "artifacts.json")
+
+# Files of the checkout that are not copied onto the image
+CHECKOUT_IGNORE = (".git", "__pycache__", "*.py[cod]")
+
+def _sha256(path):
+    '''
+    Hex sha256 of a file.
+    '''
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _load(path):
+    '''
+    A JSON file as a dict, empty if it does not exist.
+    '''
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def pinned(name):
+    '''
+    The manifest entry of an artifact, which must pin the checksum to expect.
+    '''
+    entry = _load(MANIFEST)[name]
+    if not entry.get("sha256"):
+        raise ValueError(f"Artifact {name} has no sha256 pinned in {MANIFEST}, run artifacts.py --pin {name}")
+    return entry
+
+def _object(digest):
+    '''
+    Where the artifact with a checksum is kept in the store.
+    '''
+    return os.path.join(OBJECTS, digest)
+
+def _cached(digest):
+    '''
+    Whether the store holds a valid copy of the artifact with a checksum.
+    '''
+    if not os.path.isfile(_object(digest)):
+        return False
+    if _sha256(_object(digest)) == digest:
+        return True
+    os.remove(_object(digest))
+    return False
+
+def _download(entry, expected):
+    '''
+    Download an artifact into the store, check it against the expected checksum unless it
+    is None and return its checksum.
+    '''
+    os.makedirs(OBJECTS, exist_ok=True)
+    print(f"Downloading {entry['url']}")
+    descriptor, temporary = tempfile.mkstemp(dir=STORE, prefix=".download-")
+    try:
+        with os.fdopen(descriptor, "wb") as f, urllib.request.urlopen(entry["url"], timeout=60) as response:
+            shutil.copyfileobj(response, f, 1024 * 1024)
+        digest = _sha256(temporary)
+        if expected is not None and digest != expected:
+            raise ValueError(f"Checksum mismatch for {entry['url']}: expected {expected}, got {digest}")
+        os.replace(temporary, _object(digest))
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return digest
+
+def fetch(name, offline=False):
+    '''
+    Path of a verified copy of an artifact in the store, downloading it only when needed.
+    '''
+    entry = pinned(name)
+    if _cached(entry["sha256"]):
+        print(f"Artifact {name} {entry['version']} found in the store")
+        return _object(entry["sha256"])
+    if offline:
+        raise FileNotFoundError(f"Artifact {name} {entry['version']} is not in {STORE} and the build is offline")
+    return _object(_download(entry, entry["sha256"]))
+
+def pin(name):
+    '''
+    Download an artifact and write its checksum into the manifest, after its URL or version changed.
+    '''
+    manifest = _load(MANIFEST)
+    digest = _download(manifest[name], None)
+    manifest[name]["sha256"] = digest
+    with open(f"{MANIFEST}.part", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    os.replace(f"{MANIFEST}.part", MANIFEST)
+    print(f"Pinned {name} {manifest[name]['version']} sha256 {digest} in {MANIFEST}, review it before committing")
+
+def install(name, destination, offline=False):
+    '''
+    Copy an artifact from the store to destination.
+    '''
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copyfile(fetch(name, offline), destination)
+
+def copy_checkout(source, destination):
+    '''
+    Copy the local checkout, without version control data and bytecode, to destination.
+    '''
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    shutil.copytree(source, destination, symlinks=True, ignore=shutil.ignore_patterns(*CHECKOUT_IGNORE))
+
+def main():
+    '''
+    Fill the store with every artifact in the manifest and print their checksums.
+    '''
+    parser = argparse.ArgumentParser(description="Fetch and verify the pinned build artifacts.")
+    parser.add_argument("--offline", action="store_true", help="only verify what is already in the store")
+    parser.add_argument("--pin", metavar="NAME", action="append", default=[], help="download an artifact and pin its checksum in artifacts.json")
+    args = parser.parse_args()
+    if args.pin:
+        for name in args.pin:
+            pin(name)
+        return
+    for name in _load(MANIFEST):
+        path = fetch(name, args.offline)
+        print(f"{name} {pinned(name)['version']} sha256 {os.path.basename(path)}")
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
@@ -2,15 +2,30 @@
 '''
 Script to customize and make all preparations before building.
 '''
+import argparse
+import functools
 import os
+import re
 import shutil
 import subprocess
+import sys
+
+import artifacts
+import footprint
+import pkgcache
+import releng
+import squashfs
+import zfsmodule
 
 # Define variables
 WORKDIR = "/tmp/maloneyos"
 ISO = f"{WORKDIR}/archiso-tmp"
 RELENG = f"{WORKDIR}/archlive"
 
+# Stock profile shipped with archiso and the checkout this script runs from
+TEMPLATE = "/usr/share/archiso/configs/releng/"
+CHECKOUT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 # Set the kernel version to be used in functions
 KERNEL = "linux-lts"
 
@@ -19,132 +34,108 @@ def config():
     Copy configuration we will modify to make our customizations.
     '''
     # Copy the releng configuration
-    shutil.copytree('/usr/share/archiso/configs/releng/', RELENG, symlinks=True)
+    shutil.copytree(TEMPLATE, RELENG, symlinks=True)
 
-def replace_kernel_in_packages():
+def replace_kernel_in_packages(profile):
     '''
     Function to modify package list to replace rolling kernel with linux-lts kernel.
     '''
-    # Add linux-lts to packages.x86_64
-    with open(os.path.join(RELENG, "packages.x86_64"), "a", encoding="utf-8") as f:
-        f.write("linux-lts\n")
-
-    # Remove line with the exact match of "linux" from packages.x86_64
-    with open(os.path.join(RELENG, "packages.x86_64"), "r+", encoding="utf-8") as f:
-        lines = f.readlines()
-        f.seek(0)
-        for line in lines:
-            if "linux" in line and line.strip() == "linux":
-                continue
-            f.write(line)
-        f.truncate()
-
-    # Remove packages that pull in linux from packages.x86_64
-    with open(os.path.join(RELENG, "packages.x86_64"), "r+", encoding="utf-8") as f:
-        lines = f.readlines()
-        f.seek(0)
-        for line in lines:
-            if not line.startswith(("broadcom-wl", "b43-fwcutter")):
-                f.write(line)
-        f.truncate()
-
-def replace_kernel_in_bootloader():
+    # Add linux-lts, remove linux and the packages that pull in linux
+    profile.add_packages(KERNEL)
+    profile.remove_packages(lambda name: name == "linux" or name.startswith(("broadcom-wl", "b43-fwcutter")))
+
+def replace_kernel_in_bootloader(profile):
     '''
     Replace linux with linux-lts in syslinux, efiboot, and grub.
     '''
-    # Replace linux with linux-lts in syslinux bootloader for BIOS boot
-    syslinux_cfg_path = os.path.join(RELENG, "syslinux", "archiso_sys-linux.cfg")
-    with open(syslinux_cfg_path, "r+", encoding="utf-8") as f:
-        content = f.read()
-        content = content.replace("vmlinuz-linux", f"vmlinuz-{KERNEL}")
-        content = content.replace("initramfs-linux.img", f"initramfs-{KERNEL}.img")
-        f.seek(0)
-        f.write(content)
-        f.truncate()
-
-    # Replace linux with linux-lts in efiboot bootloader for UEFI boot
-    efiboot_cfg_path = os.path.join(RELENG, "efiboot", "loader", "entries", "01-archiso-x86_64-linux.conf")
-    with open(efiboot_cfg_path, "r+", encoding="utf-8") as f:
-        content = f.read()
-        content = content.replace("vmlinuz-linux", f"vmlinuz-{KERNEL}")
-        content = content.replace("initramfs-linux.img", f"initramfs-{KERNEL}.img")
-        f.seek(0)
-        f.write(content)
-        f.truncate()
-
-    # Replace linux with linux-lts in grub bootloader for UEFI boot
-    grub_cfg_path = os.path.join(RELENG, "grub", "grub.cfg")
-    with open(grub_cfg_path, "r+", encoding="utf-8") as f:
-        content = f.read()
-        content = content.replace("vmlinuz-linux", "vmlinuz-linux-lts")
-        content = content.replace("initramfs-linux.img", "initramfs-linux-lts.img")
-        f.seek(0)
-        f.write(content)
-        f.truncate()
-
-def replace_kernel_in_mkinitcpio():
+    # Syslinux for BIOS boot, efiboot and grub for UEFI boot
+    for config_path in ("syslinux/archiso_sys-linux.cfg", "efiboot/loader/entries/01-archiso-x86_64-linux.conf", "grub/grub.cfg"):
+        profile.replace(config_path, "vmlinuz-linux", f"vmlinuz-{KERNEL}")
+        profile.replace(config_path, "initramfs-linux.img", f"initramfs-{KERNEL}.img")
+
+def replace_kernel_in_mkinitcpio(profile):
     '''
     Ensure we only build image for lts-kernel so we don't pull in linux as well.
     '''
     # Replace linux preset with linux-lts mkinitcpio preset
-    mkinitcpio_preset_path = os.path.join(RELENG, "airootfs", "etc", "mkinitcpio.d", "linux.preset")
-    new_preset_path = os.path.join(RELENG, "airootfs", "etc", "mkinitcpio.d", f"{KERNEL}.preset")
-    os.rename(mkinitcpio_preset_path, new_preset_path)
-    with open(new_preset_path, "r+", encoding="utf-8") as f:
-        content = f.read()
-        content = content.replace("vmlinuz-linux", f"vmlinuz-{KERNEL}")
-        content = content.replace("initramfs-linux.img", f"initramfs-{KERNEL}.img")
-        f.seek(0)
-        f.write(content)
-        f.truncate()
-
-def recreate_systemd_overlay():
+    content = profile.text("airootfs/etc/mkinitcpio.d/linux.preset")
+    content = content.replace("vmlinuz-linux", f"vmlinuz-{KERNEL}")
+    content = content.replace("initramfs-linux.img", f"initramfs-{KERNEL}.img")
+    profile.remove("airootfs/etc/mkinitcpio.d/linux.preset")
+    profile.write(f"airootfs/etc/mkinitcpio.d/{KERNEL}.preset", content)
+
+def recreate_systemd_overlay(profile):
     '''
     Function to remove systemd-networkd so we can replace with NetworkManager.
     '''
-    # Remove systemd-networkd and resolved services
-    base_dir = "/tmp/maloneyos/archlive/airootfs/etc/"
+    # Remove systemd-networkd and resolved services and recreate an empty multi-user target
+    profile.remove("airootfs/etc/systemd")
+    profile.mkdir("airootfs/etc/systemd/system/multi-user.target.wants")
 
-    # Define the paths to the directories you want to remove
-    directory1 = os.path.join(base_dir, "systemd/")
+def target_initramfs(profile):
+    '''
+    Build the generic zfs initramfs for installed systems along with the live one, so the
+    installer only has to copy it, and ship the unit that builds the autodetect image on first boot.
+    '''
+    # The kernel package hook builds every preset in the kernel's preset file
+    preset = f"airootfs/etc/mkinitcpio.d/{KERNEL}.preset"
+    profile.write(preset, re.sub(r"^PRESETS=\((.*)\)$", r"PRESETS=(\1 'target')", profile.text(preset), flags=re.MULTILINE))
+    profile.append(preset, f"\ntarget_config='/etc/maloneyos/mkinitcpio-target.conf'\ntarget_image='/usr/lib/maloneyos/initramfs-{KERNEL}.img'\n")
 
-    # Remove the specified directories and their contents
-    try:
-        shutil.rmtree(directory1)
-        print(f"Directory {directory1} and its contents removed successfully.")
-    except FileNotFoundError:
-        print(f"Directory {directory1} not found.")
+    # No autodetect so the image boots on any machine. No keymap and consolefont either, they
+    # would embed the live system's console settings, the first boot build adds the installed ones
+    profile.write("airootfs/etc/maloneyos/mkinitcpio-target.conf",
+                  "MODULES=()\nBINARIES=()\nFILES=()\n"
+                  "HOOKS=(base udev microcode modconf kms keyboard block zfs filesystems)\n"
+                  "COMPRESSION=\"zstd\"\n")
 
-    # Recreate the specified directory
-    try:
-        os.makedirs(os.path.join(directory1, "system/multi-user.target.wants/"))
-        print(f"Directory {os.path.join(directory1, 'system/multi-user.target.wants/')} created successfully.")
-    except FileNotFoundError:
-        print(f"Directory {directory1} not found.")
+    # Only runs on an installed system where the installer left the marker behind
+    profile.write("airootfs/etc/systemd/system/maloneyos-initramfs.service",
+                  "[Unit]\n"
+                  "Description=Build the initramfs for this machine\n"
+                  "ConditionPathExists=/var/lib/maloneyos/initramfs-pending\n"
+                  "After=local-fs.target\n\n"
+                  "[Service]\n"
+                  "Type=oneshot\n"
+                  "Nice=19\n"
+                  "IOSchedulingClass=idle\n"
+                  f"ExecStart=/usr/bin/mkinitcpio -p {KERNEL}\n"
+                  "ExecStartPost=/usr/bin/rm -f /var/lib/maloneyos/initramfs-pending\n\n"
+                  "[Install]\n"
+                  "WantedBy=multi-user.target\n")
 
-def zfs():
+def zfs(profile):
     '''
     Add package and set up repo for OpenZFS.
     '''
-    # Add zfs-linux to packages.x86_64
-    with open(os.path.join(RELENG, "packages.x86_64"), "a", encoding="utf-8") as f:
-        f.write("zfs-dkms\n")
-        f.write(f"{KERNEL}-headers\n")
+    # Add zfs-dkms and the kernel headers it builds against
+    profile.add_packages("zfs-dkms", f"{KERNEL}-headers")
 
     # Add archzfs repository to pacman.conf
-    pacman_conf_path = os.path.join(RELENG, "pacman.conf")
-    with open(pacman_conf_path, "a", encoding="utf-8") as f:
-        f.write("\n[archzfs]\nServer = https://zxcvfdsa.com/archzfs/$repo/x86_64\n")
-        f.write("SigLevel = Never\n")
+    profile.append("pacman.conf", "\n[archzfs]\nServer = https://zxcvfdsa.com/archzfs/$repo/x86_64\nSigLevel = Never\n")
 
-    # Get ZFSbootmenu so it can be installed offline
-    subprocess.run(["wget", "https://get.zfsbootmenu.org/latest.EFI", "-O", f"{RELENG}/airootfs/zfsbootmenu.EFI"], check=True)
+def zfs_module_cache(profile, offline=False):
+    '''
+    Install the module DKMS built for the same kernel and zfs versions before, DKMS then
+    skips the build. Only real builds use the cache, it depends on the build host.
+    '''
+    cached = zfsmodule.lookup(profile.text("pacman.conf"), offline)
+    if cached:
+        print(f"Using the cached ZFS module {cached}")
+        profile.append("pacman.conf", zfsmodule.repo_section())
+        profile.add_packages(cached)
 
-def plasma():
+def package_cache(profile):
+    '''
+    Use the persistent package cache so packages are only downloaded once across builds.
+    '''
+    profile.write("pacman.conf", pkgcache.configure(profile.text("pacman.conf")))
+
+def plasma(profile):
     '''
     Add plasma and various related packages.
     '''
-    packages = [
+    profile.add_packages(
         "plasma-desktop",
         "ark",
         "discover",
@@ -167,113 +158,165 @@ def plasma():
         "spectacle",
         "wget",
         "xdg-desktop-portal-kde"
-    ]
-    with open(os.path.join(RELENG, "packages.x86_64"), "a", encoding="utf-8") as f:
-        for package in packages:
-            f.write(f"{package}\n")
+    )
 
-def sddm():
+def sddm(profile):
     '''
     Configure SDDM and autologin.
     '''
-    # Define sddm.conf path
-    sddm_conf_path = os.path.join(RELENG, "airootfs", "etc", "sddm.conf.d", "autologin.conf")
-
     # Add sddm to packages.x86_64
-    with open(os.path.join(RELENG, "packages.x86_64"), "a", encoding="utf-8") as f:
-        f.write("sddm\n")
+    profile.add_packages("sddm")
 
     # Add sddm to display-manager.service
-    display_manager_path = os.path.join(RELENG, "airootfs", "etc", "systemd", "system", "display-manager.service")
-    os.symlink("/usr/lib/systemd/system/sddm.service", display_manager_path)
+    profile.symlink("airootfs/etc/systemd/system/display-manager.service", "/usr/lib/systemd/system/sddm.service")
 
     # Add autologin to sddm.conf
-    os.makedirs(os.path.dirname(sddm_conf_path), exist_ok=True)
-    with open(sddm_conf_path, "w", encoding="utf-8") as f:
-        f.write("[Autologin]\n")
-        f.write("User=archie\n")
-        f.write("Session=plasma\n")
+    profile.write("airootfs/etc/sddm.conf.d/autologin.conf", "[Autologin]\nUser=archie\nSession=plasma\n")
+
+def zram(profile):
+    '''
+    Add zram-generator, the installer configures compressed swap in RAM with it.
+    '''
+    profile.add_packages("zram-generator")
 
-def networkmanager():
+def networkmanager(profile):
     '''
     Symlink NetworkManager service from the installed system into overlay for ISO.
     '''
     # Add NetworkManager service to multi-user-target-wants
-    wants_path = os.path.join(RELENG, "airootfs", "etc", "systemd", "system", "multi-user.target.wants", "NetworkManager.service")
-    os.symlink("/usr/lib/systemd/system/NetworkManager.service", wants_path)
+    profile.symlink("airootfs/etc/systemd/system/multi-user.target.wants/NetworkManager.service",
+                    "/usr/lib/systemd/system/NetworkManager.service")
 
-def user():
+def user(profile):
     '''
     Setup livecd user and add to groups.
     '''
-    # Define user files
-    passwd_file = os.path.join(RELENG, "airootfs", "etc", "passwd")
-    shadow_file = os.path.join(RELENG, "airootfs", "etc", "shadow")
-    group_file = os.path.join(RELENG, "airootfs", "etc", "group")
-    gshadow_file = os.path.join(RELENG, "airootfs", "etc", "gshadow")
-    sudoers_dir = os.path.join(RELENG, "airootfs", "etc", "sudoers.d")
-
     # Add user to airootfs
-    with open(passwd_file, "a", encoding="utf-8") as f:
-        f.write("archie:x:1000:1000::/home/archie:/usr/bin/zsh\n")
-    with open(shadow_file, "a", encoding="utf-8") as f:
-        f.write("archie:$6$veQypn8kEQiN8Qjm$SrUpS4dGB7LUmSImYV8y1jJPRug2mJ8TghJCoHGgfXTrMBViRmEV0yaCFcgruX9.CI9gMNRK99SqrtNlmyU3G.:14871::::::\n")
-    with open(group_file, "a", encoding="utf-8") as f:
-        f.write("root:x:0:root\n")
-        f.write("adm:x:4:archie\n")
-        f.write("wheel:x:10:archie\n")
-        f.write("uucp:x:14:archie\n")
-        f.write("archie:x:1000:\n")
-    with open(gshadow_file, "a", encoding="utf-8") as f:
-        f.write("root:!*::root\n")
-        f.write("archie:!*::\n")
-    with open(os.path.join(RELENG, "profiledef.sh"), "r+", encoding="utf-8") as f:
-        content = f.read()
-        content = content.replace("shadow.*=.*0:0:400", '[\"/etc/gshadow\"]=\"0:0:0400\"')
-        f.seek(0)
-        f.write(content)
-        f.truncate()
-    with open(os.path.join(RELENG, "profiledef.sh"), "r+", encoding="utf-8") as f:
-        content = f.read()
-        content = content.replace('["/usr/local/bin/livecd-sound"]="0:0:755"', '["/usr/local/bin/livecd-sound"]="0:0:755"\n  ["/home/archie/Desktop/installer.desktop"]="0:0:755"')
-        f.seek(0)
-        f.write(content)
-        f.truncate()
+    profile.append("airootfs/etc/passwd", "archie:x:1000:1000::/home/archie:/usr/bin/zsh\n")
+    profile.append("airootfs/etc/shadow", "archie:$6$veQypn8kEQiN8Qjm$SrUpS4dGB7LUmSImYV8y1jJPRug2mJ8TghJCoHGgfXTrMBViRmEV0yaCFcgruX9.CI9gMNRK99SqrtNlmyU3G.:14871::::::\n")
+    profile.append("airootfs/etc/group", "root:x:0:root\nadm:x:4:archie\nwheel:x:10:archie\nuucp:x:14:archie\narchie:x:1000:\n")
+    profile.append("airootfs/etc/gshadow", "root:!*::root\narchie:!*::\n")
+
+    # Keep gshadow as private as shadow and make the desktop shortcut executable
+    profile.replace("profiledef.sh", '["/etc/shadow"]="0:0:400"', '["/etc/shadow"]="0:0:400"\n  ["/etc/gshadow"]="0:0:400"')
+    profile.replace("profiledef.sh", '["/usr/local/bin/livecd-sound"]="0:0:755"', '["/usr/local/bin/livecd-sound"]="0:0:755"\n  ["/home/archie/Desktop/installer.desktop"]="0:0:755"')
 
     # Add archie to sudoers
-    os.makedirs(sudoers_dir, exist_ok=True)
-    with open(os.path.join(sudoers_dir, "00_archie"), "w", encoding="utf-8") as f:
-        f.write("archie ALL=(ALL) NOPASSWD: ALL\n")
+    profile.write("airootfs/etc/sudoers.d/00_archie", "archie ALL=(ALL) NOPASSWD: ALL\n")
+
+def desktop_shortcut(profile):
+    '''
+    Create a desktop shortcut for the live system user.
+    '''
+    with open(os.path.join(CHECKOUT, "installer", "installer.desktop"), encoding="utf-8") as f:
+        profile.write("airootfs/home/archie/Desktop/installer.desktop", f.read(), mode=0o755)
+
+def squashfs_compression(profile, name):
+    '''
+    Compress the airootfs image with one of the compression profiles.
+    '''
+    profile.write("profiledef.sh", squashfs.configure(profile.text("profiledef.sh"), name))
+
+def zfsbootmenu(offline=False):
+    '''
+    Get ZFSbootmenu from the artifact store so it can be installed offline.
+    '''
+    artifacts.install("zfsbootmenu", f"{RELENG}/airootfs/zfsbootmenu.EFI", offline)
 
 def installer():
     '''
     Copy the installer to ISO dir so it will be on the image.
     '''
-    # Clone the repository to ISO/maloneyOS
-    subprocess.run(["git", "clone", "https://github.com/pkgdemon/maloneyos.git", f"{RELENG}/airootfs/maloneyos"], check=True)
+    # Copy this checkout to ISO/maloneyOS
+    artifacts.copy_checkout(CHECKOUT, f"{RELENG}/airootfs/maloneyos")
+    subprocess.run(["chown", "-R", "1000:1000", os.path.join(RELENG, "airootfs", "home", "archie", "Desktop")], check=True)
+
+# Customizations applied to the releng profile, in order
+TRANSFORMS = (
+    replace_kernel_in_packages,
+    replace_kernel_in_bootloader,
+    replace_kernel_in_mkinitcpio,
+    recreate_systemd_overlay,
+    zfs,
+    package_cache,
+    plasma,
+    sddm,
+    networkmanager,
+    zram,
+    target_initramfs,
+    user,
+    desktop_shortcut,
+)
+
+def check_footprint(profile, dbpath, max_size, max_files, report=False):
+    '''
+    Work out what the package list installs from the local sync databases and return the
+    ways it is over the budget. Without sync databases nothing can be checked.
+    '''
+    result = footprint.analyze(list(profile.packages), profile.text("pacman.conf"), dbpath)
+    if not result["packages"]:
+        print(f"No sync databases in {dbpath}, skipping the footprint check")
+        return []
+    if report:
+        footprint.print_report(result)
+    else:
+        print(f"Image footprint: {result['packages']} packages, {result['size'] // (1024 * 1024)} MiB installed, "
+              f"{'unknown' if result['files'] is None else result['files']} files")
+    return footprint.check(result, max_size, max_files)
 
-def desktop_shortcut():
+def main():
     '''
-    Create a desktop shortcut for the live system user.
+    Apply every customization to the releng profile in one pass and write it out once.
     '''
-    desktop_folder = os.path.join(RELENG, "airootfs", "home", "archie", "Desktop")
-    installer_desktop = os.path.join(RELENG, "airootfs", "maloneyos", "installer", "installer.desktop")
-    os.makedirs(desktop_folder, exist_ok=True)
-    shutil.copy(installer_desktop, desktop_folder)
-    subprocess.run(["chown", "-R", "1000:1000", desktop_folder], check=True)
-    subprocess.run(["chmod", "+x", installer_desktop], check=True)
-
-config()
-replace_kernel_in_packages()
-replace_kernel_in_bootloader()
-replace_kernel_in_mkinitcpio()
-recreate_systemd_overlay()
-zfs()
-plasma()
-sddm()
-networkmanager()
-user()
-installer()
-desktop_shortcut()
+    parser = argparse.ArgumentParser(description="Customize the releng profile for building maloneyOS.")
+    parser.add_argument("--dry-run", action="store_true", help="print the changes to the stock releng profile without writing anything")
+    parser.add_argument("--compression", choices=sorted(squashfs.PROFILES), default=squashfs.DEFAULT,
+                        help="squashfs compression profile, dev builds fastest and release makes the smallest image")
+    parser.add_argument("--offline", action="store_true", help="take downloads only from the artifact store")
+    parser.add_argument("--footprint", action="store_true", help="report what every listed package installs and check the budget, without building")
+    parser.add_argument("--dbpath", default=footprint.DBPATH, help="pacman database directory with the sync databases to resolve packages from")
+    parser.add_argument("--max-size", type=float, default=footprint.MAX_SIZE / 1024 ** 3, help="installed size budget of the image in GiB, 0 for none")
+    parser.add_argument("--max-files", type=int, default=footprint.MAX_FILES, help="file count budget of the image, 0 for none")
+    args = parser.parse_args()
+    budget = (args.dbpath, int(args.max_size * 1024 ** 3), args.max_files)
+
+    if args.footprint:
+        profile = releng.Profile(TEMPLATE)
+        profile.apply(*TRANSFORMS)
+        problems = check_footprint(profile, *budget, report=True)
+        for problem in problems:
+            print(f"Over budget: {problem}", file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+    if args.dry_run:
+        profile = releng.Profile(TEMPLATE)
+        profile.apply(*TRANSFORMS, functools.partial(squashfs_compression, name=args.compression))
+        print(profile.diff(), end="")
+        return
+
+    # An unpinned download stops the build, better before the profile is copied than after
+    try:
+        artifacts.pinned("zfsbootmenu")
+    except ValueError as e:
+        sys.exit(str(e))
+    config()
+    profile = releng.Profile(RELENG)
+    profile.apply(*TRANSFORMS, functools.partial(squashfs_compression, name=args.compression))
+
+    # Stop before anything is built when the image would be over its budget
+    problems = check_footprint(profile, *budget)
+    if problems:
+        for problem in problems:
+            print(f"Over budget: {problem}", file=sys.stderr)
+        sys.exit(1)
+    zfs_module_cache(profile, args.offline)
+    changed = profile.flush()
+    print(f"Customized {len(changed)} files in {RELENG}")
+    os.makedirs(pkgcache.PKG_CACHE, exist_ok=True)
+    zfsbootmenu(args.offline)
+    installer()
+
+if __name__ == "__main__":
+    main()
 
 # End-of-file (EOF)
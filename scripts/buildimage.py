@@ -2,14 +2,57 @@
 '''
 Script to build the after customizations.
 '''
+import glob
+import os
 import subprocess
+import sys
+import time
+
+import flatpaks
+import incremental
+import pkgcache
+import sendstream
+import squashfs
+import zfsmodule
 
 # Define variables
 WORKDIR="/tmp/maloneyos"
-ISO=f"{WORKDIR}/archiso-tmp"
+ISO=incremental.WORK
 RELENG=f"{WORKDIR}/archlive"
 
+# Decide which stages of the last build can be reused
+inputs = incremental.prepare(RELENG)
+
+# A send stream from an earlier build must not end up in this image
+sendstream.remove()
+
+# Put the offline Flatpak repo into the ISO tree, or take the one of an earlier build out
+if "--flatpaks" in sys.argv[1:]:
+    flatpaks.build()
+else:
+    flatpaks.remove()
+
+# Remember what the package cache held to report hits and misses afterwards
+cached = pkgcache.snapshot()
+
 # Build the image
+started = time.monotonic()
 subprocess.run(["mkarchiso", "-v", "-w", ISO, "-o", WORKDIR, RELENG], check=True)
 
+# Add a zfs send stream of the root filesystem for the installer and build the image again with it
+if "--send-stream" in sys.argv[1:]:
+    sendstream.build()
+    for image in glob.glob(os.path.join(WORKDIR, "*.iso")):
+        os.remove(image)
+    incremental.reset_image(ISO)
+    subprocess.run(["mkarchiso", "-v", "-w", ISO, "-o", WORKDIR, RELENG], check=True)
+incremental.save(inputs)
+squashfs.record_build(RELENG, time.monotonic() - started)
+
+# Keep the ZFS module DKMS built so the next build with the same kernel skips compiling it
+zfsmodule.harvest()
+
+# Report package cache statistics and evict old package versions
+pkgcache.report(cached, os.path.join(ISO, "iso", "arch", "pkglist.x86_64.txt"))
+
 # End-of-file (EOF)
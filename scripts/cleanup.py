@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 '''
 Script to cleanup all working directorys in order to rebuild.
+
+The package cache is kept so the next build does not download everything again,
+pass --all to remove it as well.
 '''
 import os
 import shutil
+import sys
+
+import pkgcache
 
 # Define variables
 WORKDIR="/tmp/maloneyos"
@@ -12,4 +18,8 @@ WORKDIR="/tmp/maloneyos"
 if os.path.isdir(WORKDIR):
     shutil.rmtree(WORKDIR)
 
+# Remove the persistent caches only when asked to
+if "--all" in sys.argv[1:] and os.path.isdir(pkgcache.CACHE_ROOT):
+    shutil.rmtree(pkgcache.CACHE_ROOT)
+
 # End-of-file (EOF)
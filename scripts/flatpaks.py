@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+'''
+Offline Flatpak repo on the ISO so new installs have the standard apps without downloading them.
+
+The apps listed in flatpaks.json are installed into a Flatpak installation kept in the
+build cache, so later builds only download updates, and exported with flatpak create-usb
+into an OSTree repo in the ISO tree next to the squashfs. Apps and the runtimes they
+share are stored once in that repo. The installer sideloads from it into the target's
+system installation. Needs flatpak on the build host.
+'''
+import json
+import os
+import shutil
+import subprocess
+
+import artifacts
+import incremental
+import pkgcache
+
+MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flatpaks.json")
+INSTALLATION = os.path.join(pkgcache.CACHE_ROOT, "flatpak")
+OUTPUT = os.path.join(incremental.WORK, "iso", "flatpak")
+
+def _flatpak(*args):
+    '''
+    Run flatpak on the installation in the build cache.
+    '''
+    subprocess.run(["flatpak", "--user", *args], env=dict(os.environ, FLATPAK_USER_DIR=INSTALLATION), check=True)
+
+def load():
+    '''
+    The remote and the apps to put on the ISO.
+    '''
+    with open(MANIFEST, encoding="utf-8") as f:
+        return json.load(f)
+
+def remove(output=OUTPUT):
+    '''
+    Take the repo of an earlier build out of the ISO tree.
+    '''
+    if os.path.exists(output):
+        shutil.rmtree(output)
+
+def build(output=OUTPUT):
+    '''
+    Install or update the apps in the cache and export them with their runtimes to output.
+    '''
+    manifest = load()
+    remote = manifest["remote"]
+    remote_file = artifacts.fetch(manifest["artifact"])
+    _flatpak("remote-add", "--if-not-exists", "--from", remote, remote_file)
+    # create-usb and sideloading find refs by collection ID
+    _flatpak("remote-modify", f"--collection-id={manifest['collection_id']}", remote)
+    _flatpak("install", "--noninteractive", "--or-update", "-y", remote, *manifest["apps"])
+
+    # create-usb only copies objects the repo does not have yet, prune what no ref needs anymore
+    os.makedirs(output, exist_ok=True)
+    _flatpak("create-usb", "--destination-repo=repo", output, *manifest["apps"])
+    subprocess.run(["ostree", "prune", f"--repo={os.path.join(output, 'repo')}", "--refs-only"], check=True)
+    shutil.copy2(remote_file, os.path.join(output, f"{remote}.flatpakrepo"))
+    with open(os.path.join(output, "apps.json"), "w", encoding="utf-8") as f:
+        json.dump({"remote": remote, "collection_id": manifest["collection_id"], "apps": manifest["apps"]}, f, indent=2)
+        f.write("\n")
+    size = int(subprocess.check_output(["du", "-sb", output]).split()[0])
+    print(f"Flatpak repo with {len(manifest['apps'])} apps written to {output}, {size // (1024 * 1024)} MiB")
+
+# End-of-file (EOF)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+'''
+Installed size and file count of the packages the image is built from, worked out offline.
+
+The dependency closure of the profile's package list is resolved from the sync databases
+pacman keeps on the build host, in the order the profile's pacman.conf lists the repos, so
+neither the network nor a build is needed. File counts come from the .files databases once
+pacman -Fy has fetched them. Every package on the list is reported with its own size, the
+size of everything it pulls in, and the size only it pulls in, which is what dropping it
+from the list would save. Size and file count are what extraction time grows with.
+'''
+import io
+import os
+import re
+import subprocess
+import tarfile
+
+DBPATH = "/var/lib/pacman"
+
+# Budget for everything installed on the image, bootstrap.py fails the build above it
+MAX_SIZE = 8 * 1024 * 1024 * 1024
+MAX_FILES = 300000
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def repos(pacman_conf):
+    '''
+    Names of the repos in a pacman.conf in the order pacman searches them.
+    '''
+    return [name for name in re.findall(r"^\s*\[([^\]]+)\]", pacman_conf, flags=re.MULTILINE) if name != "options"]
+
+def _open(path):
+    '''
+    Open a sync database, the gzip and xz ones directly and zstd ones through zstd.
+    '''
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == ZSTD_MAGIC:
+        return tarfile.open(fileobj=io.BytesIO(subprocess.check_output(["zstd", "-dcq", path])), mode="r:")
+    return tarfile.open(path, "r:*")
+
+def _parse(text):
+    '''
+    The %FIELD% sections of a desc or files entry as lists of values.
+    '''
+    fields = {}
+    for block in text.split("\n\n"):
+        lines = block.strip().splitlines()
+        if lines and re.fullmatch(r"%[A-Z0-9]+%", lines[0]):
+            fields[lines[0].strip("%")] = lines[1:]
+    return fields
+
+def _name(dependency):
+    '''
+    Package or virtual name of a dependency without its version constraint.
+    '''
+    return re.split(r"[<>=]", dependency, maxsplit=1)[0]
+
+def load(pacman_conf, dbpath=DBPATH):
+    '''
+    Packages by name and their providers by virtual name from the sync databases, the first
+    repo having a package wins like in pacman. Also returns the repos without a database.
+    '''
+    packages, providers, missing = {}, {}, []
+    for repo in repos(pacman_conf):
+        path = next((path for path in (os.path.join(dbpath, "sync", f"{repo}.{kind}") for kind in ("files", "db")) if os.path.isfile(path)), None)
+        if path is None:
+            missing.append(repo)
+            continue
+        entries = {}
+        with _open(path) as tar:
+            for member in tar:
+                if member.isfile():
+                    entries.setdefault(os.path.dirname(member.name), {}).update(_parse(tar.extractfile(member).read().decode("utf-8", "replace")))
+        for fields in entries.values():
+            name = fields.get("NAME", [None])[0]
+            if name is None or name in packages:
+                continue
+            listed = fields.get("FILES")
+            packages[name] = {
+                "repo": repo,
+                "version": fields.get("VERSION", [""])[0],
+                "size": int(fields.get("ISIZE", ["0"])[0]),
+                "files": None if listed is None else sum(1 for file in listed if not file.endswith("/")),
+                "depends": [_name(dependency) for dependency in fields.get("DEPENDS", [])],
+            }
+            for provided in fields.get("PROVIDES", []):
+                providers.setdefault(_name(provided), []).append(name)
+    return packages, providers, missing
+
+def _resolve(dependency, packages, providers, preferred):
+    '''
+    Package that satisfies a dependency, preferring one on the package list, None if none does.
+    '''
+    if dependency in packages:
+        return dependency
+    candidates = providers.get(dependency, [])
+    return next((name for name in candidates if name in preferred), candidates[0] if candidates else None)
+
+def closure(names, packages, providers, preferred=()):
+    '''
+    Every package names pull in, themselves included, and the dependencies nothing satisfies.
+    '''
+    found, unresolved = set(), set()
+    pending = list(names)
+    while pending:
+        dependency = pending.pop()
+        name = _resolve(dependency, packages, providers, preferred)
+        if name is None:
+            unresolved.add(dependency)
+        elif name not in found:
+            found.add(name)
+            pending.extend(packages[name]["depends"])
+    return found, unresolved
+
+def _total(names, packages):
+    '''
+    Installed size and file count of packages, no file count if one of them has none.
+    '''
+    files = [packages[name]["files"] for name in names]
+    return sum(packages[name]["size"] for name in names), None if None in files else sum(files)
+
+def analyze(names, pacman_conf, dbpath=DBPATH):
+    '''
+    Footprint of the image and of every package on the list.
+    '''
+    packages, providers, missing = load(pacman_conf, dbpath)
+    preferred = set(names)
+    image, unresolved = closure(names, packages, providers, preferred)
+    closures = {name: closure([name], packages, providers, preferred)[0] for name in names}
+    pulled = {}
+    for found in closures.values():
+        for name in found:
+            pulled[name] = pulled.get(name, 0) + 1
+
+    rows = []
+    for name in names:
+        if name not in closures or not closures[name]:
+            continue
+        own = _resolve(name, packages, providers, preferred)
+        unique = [package for package in closures[name] if pulled[package] == 1]
+        rows.append({
+            "package": name,
+            "size": packages[own]["size"],
+            "files": packages[own]["files"],
+            "closure_packages": len(closures[name]),
+            "closure_size": _total(closures[name], packages)[0],
+            "closure_files": _total(closures[name], packages)[1],
+            "unique_packages": len(unique),
+            "unique_size": _total(unique, packages)[0],
+            "unique_files": _total(unique, packages)[1],
+        })
+    rows.sort(key=lambda row: row["unique_size"], reverse=True)
+    size, files = _total(image, packages)
+    return {"packages": len(image), "size": size, "files": files, "unresolved": sorted(unresolved),
+            "missing_repos": missing, "rows": rows}
+
+def check(result, max_size=MAX_SIZE, max_files=MAX_FILES):
+    '''
+    Every way the image is over its budget, a budget of 0 is not checked.
+    '''
+    problems = []
+    if max_size and result["size"] > max_size:
+        problems.append(f"installed size {result['size'] / 1024 ** 3:.2f} GiB is over the budget of {max_size / 1024 ** 3:.2f} GiB")
+    if max_files and result["files"] is not None and result["files"] > max_files:
+        problems.append(f"{result['files']} files are over the budget of {max_files}")
+    return problems
+
+def print_report(result):
+    '''
+    Print the packages on the list by what only they pull in, largest first.
+    '''
+    def mib(size):
+        return f"{size / 1024 ** 2:,.0f}"
+
+    def count(files):
+        return "?" if files is None else f"{files:,}"
+
+    print(f"{'package':<28}{'own MiB':>10}{'pulls in':>10}{'MiB':>10}{'files':>10}{'only it':>9}{'MiB':>10}{'files':>10}")
+    for row in result["rows"]:
+        print(f"{row['package']:<28}{mib(row['size']):>10}{row['closure_packages']:>10}{mib(row['closure_size']):>10}"
+              f"{count(row['closure_files']):>10}{row['unique_packages']:>9}{mib(row['unique_size']):>10}{count(row['unique_files']):>10}")
+    print(f"Image: {result['packages']} packages, {mib(result['size'])} MiB installed, {count(result['files'])} files")
+    if result["files"] is None:
+        print("File counts need the .files databases, run pacman -Fy")
+    if result["missing_repos"]:
+        print(f"No sync database for {', '.join(result['missing_repos'])}, their packages are not counted")
+    if result["unresolved"]:
+        print(f"Not found in any sync database: {', '.join(result['unresolved'])}")
+
+# End-of-file (EOF)
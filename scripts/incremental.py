@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+Incremental ISO builds keyed on a content hash of the customization inputs.
+
+mkarchiso skips every stage whose stamp file (for example base._make_packages) already
+exists in its work dir, so the work dir is kept outside WORKDIR and this module decides
+which stamps to drop before each build:
+
+* the package list or pacman.conf changed, or a file the package hooks read such as the
+  mkinitcpio presets and configs: start from an empty work dir
+* only overlay files, installer sources or profile files changed: keep the installed
+  packages and redo the stages after them, which layers the overlay on again
+* nothing changed: only build the ISO image again from the existing squashfs
+'''
+import hashlib
+import json
+import os
+import shutil
+
+import pkgcache
+
+BUILD_CACHE = os.path.join(pkgcache.CACHE_ROOT, "build")
+WORK = os.path.join(BUILD_CACHE, "archiso-tmp")
+STATE = os.path.join(BUILD_CACHE, "inputs.json")
+
+# Stages that only depend on the package list and the stages that produce the ISO image
+PACKAGE_STAGES = ("_make_pacman_conf", "_make_packages")
+IMAGE_STAGES = ("_build_iso_image",)
+
+# Stamp prefixes: the stages every build mode shares run as "base", for example
+# base._make_custom_airootfs and base._prepare_airootfs_image, the rest under the build mode
+BUILD_MODES = ("base", "iso", "netboot", "bootstrap")
+
+# Overlay files the package hooks read, mkinitcpio builds the live and the target initramfs
+# while the kernel is installed, so they are only used when the packages are installed again
+PACKAGE_HOOK_INPUTS = ("etc/mkinitcpio.conf", "etc/mkinitcpio.conf.d/", "etc/mkinitcpio.d/", "etc/maloneyos/mkinitcpio-target.conf")
+
+# Installer sources live in the overlay, they are reported on their own
+INSTALLER_PREFIX = "maloneyos/"
+
+def _digest(path):
+    '''
+    Hash of a file's content, or of its target for a symlink.
+    '''
+    if os.path.islink(path):
+        return "link:" + os.readlink(path)
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def manifest(root, skip=()):
+    '''
+    Hash every file below root, keyed by its path relative to root.
+    '''
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative = os.path.relpath(dirpath, root)
+        dirnames[:] = [name for name in dirnames if name != ".git" and os.path.normpath(os.path.join(relative, name)) not in skip]
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if name in filenames or os.path.islink(path):
+                files[os.path.normpath(os.path.join(relative, name))] = _digest(path)
+    return files
+
+def inputs(releng):
+    '''
+    The hashed inputs of a build: the package set, the overlay and the rest of the profile.
+    '''
+    with open(os.path.join(releng, "packages.x86_64"), encoding="utf-8") as f:
+        packages = sorted({line.strip() for line in f if line.strip() and not line.startswith("#")})
+    sha256 = hashlib.sha256("\n".join(packages).encode("utf-8"))
+    sha256.update(_digest(os.path.join(releng, "pacman.conf")).encode("utf-8"))
+    return {
+        "packages": sha256.hexdigest(),
+        "overlay": manifest(os.path.join(releng, "airootfs")),
+        "profile": manifest(releng, skip=("airootfs",)),
+    }
+
+def _load_state():
+    '''
+    Inputs of the last successful build, None if there is none.
+    '''
+    try:
+        with open(STATE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _changed(old, new):
+    '''
+    Paths that were added or modified and paths that were removed between two manifests.
+    '''
+    changed = sorted(path for path, digest in new.items() if old.get(path) != digest)
+    removed = sorted(path for path in old if path not in new)
+    return changed, removed
+
+def plan(current, work=WORK):
+    '''
+    Decide how much of the last build can be reused, returns the action and the changed paths.
+    '''
+    previous = _load_state()
+    if previous is None or not os.path.isdir(work):
+        return "full", []
+    if previous["packages"] != current["packages"]:
+        return "full", []
+
+    overlay, removed = _changed(previous["overlay"], current["overlay"])
+    profile, profile_removed = _changed(previous["profile"], current["profile"])
+    hooks = [path for path in overlay + removed if path.startswith(PACKAGE_HOOK_INPUTS)]
+    if hooks:
+        return "full", hooks
+    if removed or profile_removed:
+        # Layering the overlay again cannot take files away, start over
+        return "full", removed + profile_removed
+    if overlay or profile:
+        return "relayer", overlay + profile
+    return "reuse", []
+
+def _reset_stages(work, redo):
+    '''
+    Delete mkarchiso stage stamps so redo(stage) stages run again.
+    '''
+    for name in os.listdir(work):
+        mode, _, stage = name.partition(".")
+        if mode in BUILD_MODES and stage.startswith("_") and os.path.isfile(os.path.join(work, name)) and redo(stage):
+            os.remove(os.path.join(work, name))
+
+def prepare(releng, work=WORK):
+    '''
+    Hash the inputs, prepare the work dir for the cheapest correct rebuild and return the inputs.
+    '''
+    current = inputs(releng)
+    action, changed = plan(current, work)
+    if action == "full":
+        if changed:
+            print(f"Incremental build: {len(changed)} changed files need the packages installed again, building from scratch")
+            for path in changed[:20]:
+                print(f"  {path}")
+        else:
+            print("Incremental build: package set changed or no previous build, building from scratch")
+        if os.path.isdir(work):
+            shutil.rmtree(work)
+    elif action == "relayer":
+        installer = [path for path in changed if path.startswith(INSTALLER_PREFIX)]
+        print(f"Incremental build: reusing installed packages, layering {len(changed)} changed files "
+              f"({len(installer)} installer files)")
+        for path in changed[:20]:
+            print(f"  {path}")
+        _reset_stages(work, lambda stage: stage not in PACKAGE_STAGES)
+    else:
+        print("Incremental build: inputs unchanged, reusing the airootfs and squashfs")
+        reset_image(work)
+    os.makedirs(work, exist_ok=True)
+    return current
+
+def reset_image(work=WORK):
+    '''
+    Make the next mkarchiso run only build the ISO image again, after files were added to it.
+    '''
+    _reset_stages(work, lambda stage: stage in IMAGE_STAGES)
+
+def save(current):
+    '''
+    Remember the inputs of a successful build.
+    '''
+    os.makedirs(BUILD_CACHE, exist_ok=True)
+    with open(STATE, "w", encoding="utf-8") as f:
+        json.dump(current, f)
+
+# End-of-file (EOF)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+'''
+Persistent pacman package cache shared by every build.
+
+The cache lives outside WORKDIR so cleanup.py leaves it alone, and bootstrap.py points
+the releng pacman.conf at it. After each build buildimage.py reports how many packages
+came from the cache and evicts old package versions to keep the cache bounded.
+'''
+import os
+
+CACHE_ROOT = "/var/cache/maloneyos"
+PKG_CACHE = os.path.join(CACHE_ROOT, "pkg")
+
+# Package versions to keep per package and the upper bound for the whole cache
+KEEP_VERSIONS = 2
+MAX_SIZE = 20 * 1024 * 1024 * 1024
+
+def configure(pacman_conf):
+    '''
+    Return the text of a pacman.conf with its CacheDir pointed at the persistent cache.
+    '''
+    lines = [line for line in pacman_conf.splitlines() if not line.lstrip("#").strip().startswith("CacheDir")]
+    index = lines.index("[options]") + 1
+    lines.insert(index, f"CacheDir    = {PKG_CACHE}/")
+    return "\n".join(lines) + "\n"
+
+def snapshot():
+    '''
+    Names of the package files in the cache right now.
+    '''
+    if not os.path.isdir(PKG_CACHE):
+        return set()
+    return {name for name in os.listdir(PKG_CACHE) if ".pkg.tar" in name and not name.endswith(".sig")}
+
+def statistics(before, pkglist_path):
+    '''
+    Count cache hits and misses for the packages listed in the pkglist mkarchiso wrote.
+    '''
+    hits = 0
+    misses = 0
+    with open(pkglist_path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            name, version = line.split()
+            prefix = f"{name}-{version}-"
+            if any(cached.startswith(prefix) for cached in before):
+                hits += 1
+            else:
+                misses += 1
+    return hits, misses
+
+def _package_name(filename):
+    '''
+    Package name from a file name like name-version-release-arch.pkg.tar.zst.
+    '''
+    return filename.split(".pkg.tar")[0].rsplit("-", 3)[0]
+
+def _remove(path):
+    '''
+    Remove a package file and its signature, returning the bytes freed.
+    '''
+    freed = 0
+    for candidate in (path, f"{path}.sig"):
+        if os.path.exists(candidate):
+            freed += os.path.getsize(candidate)
+            os.remove(candidate)
+    return freed
+
+def evict(keep=KEEP_VERSIONS, max_size=MAX_SIZE):
+    '''
+    Drop all but the newest versions of each package, then the least recently used
+    packages until the cache fits in max_size. Returns the number of files and bytes removed.
+    '''
+    packages = {}
+    for name in snapshot():
+        path = os.path.join(PKG_CACHE, name)
+        packages.setdefault(_package_name(name), []).append(path)
+
+    removed = 0
+    freed = 0
+    remaining = []
+    for paths in packages.values():
+        paths.sort(key=os.path.getmtime, reverse=True)
+        remaining.extend(paths[:keep])
+        for path in paths[keep:]:
+            freed += _remove(path)
+            removed += 1
+
+    size = sum(os.path.getsize(path) for path in remaining)
+    for path in sorted(remaining, key=os.path.getatime):
+        if size <= max_size:
+            break
+        size -= os.path.getsize(path)
+        freed += _remove(path)
+        removed += 1
+    return removed, freed
+
+def report(before, pkglist_path):
+    '''
+    Print the hit and miss statistics for a build and evict old packages.
+    '''
+    hits, misses = statistics(before, pkglist_path)
+    total = hits + misses
+    rate = hits / total if total else 0.0
+    print(f"Package cache: {hits} hits, {misses} misses ({rate:.0%} hit rate) in {PKG_CACHE}")
+    removed, freed = evict()
+    if removed:
+        print(f"Package cache: evicted {removed} files, {freed // (1024 * 1024)} MiB")
+
+# End-of-file (EOF)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+'''
+In-memory model of the archiso releng profile.
+
+The profile is read once, customizations are applied to it as transforms, and every
+change is written back in a single flush. The package list is kept as an ordered set
+so adding a package twice is harmless. Before flushing, diff() shows exactly what the
+customizations do to the stock profile.
+'''
+import difflib
+import os
+import shutil
+import tempfile
+
+PACKAGES = "packages.x86_64"
+
+class Profile:
+    '''
+    A releng profile whose files are edited in memory until flush().
+    '''
+    def __init__(self, root):
+        self.root = root
+        self._original = {}
+        self._files = {}
+        self._modes = {}
+        self._links = {}
+        self._directories = []
+        self._removed = []
+        self.packages = dict.fromkeys(line.strip() for line in self.text(PACKAGES).splitlines() if line.strip())
+
+    def path(self, relpath):
+        '''
+        Where a file of the profile lives on disk.
+        '''
+        return os.path.join(self.root, relpath)
+
+    def _is_removed(self, relpath):
+        '''
+        Whether a path is inside a tree that is going to be removed.
+        '''
+        return any(relpath == removed or relpath.startswith(removed.rstrip("/") + "/") for removed in self._removed)
+
+    def text(self, relpath):
+        '''
+        The current content of a text file, empty if it does not exist.
+        '''
+        if relpath not in self._files:
+            content = ""
+            if not self._is_removed(relpath) and os.path.isfile(self.path(relpath)):
+                with open(self.path(relpath), encoding="utf-8") as f:
+                    content = f.read()
+            self._original.setdefault(relpath, content)
+            self._files[relpath] = content
+        return self._files[relpath]
+
+    def write(self, relpath, content, mode=None):
+        '''
+        Replace the content of a file.
+        '''
+        self.text(relpath)
+        self._files[relpath] = content
+        if mode is not None:
+            self._modes[relpath] = mode
+
+    def append(self, relpath, content):
+        '''
+        Add content to the end of a file.
+        '''
+        self.write(relpath, self.text(relpath) + content)
+
+    def replace(self, relpath, old, new):
+        '''
+        Replace text in a file.
+        '''
+        self.write(relpath, self.text(relpath).replace(old, new))
+
+    def symlink(self, relpath, target):
+        '''
+        Create a symlink in the profile.
+        '''
+        self._links[relpath] = target
+
+    def mkdir(self, relpath):
+        '''
+        Create a directory in the profile.
+        '''
+        self._directories.append(relpath)
+
+    def remove(self, relpath):
+        '''
+        Remove a file or directory tree from the profile.
+        '''
+        self._removed.append(relpath)
+        for path in list(self._files):
+            if self._is_removed(path):
+                self._files[path] = None
+        for path in list(self._links):
+            if self._is_removed(path):
+                del self._links[path]
+
+    def add_packages(self, *names):
+        '''
+        Add packages to the package list, keeping the order and skipping duplicates.
+        '''
+        for name in names:
+            self.packages[name] = None
+
+    def remove_packages(self, predicate):
+        '''
+        Remove the packages predicate(name) is true for.
+        '''
+        for name in [name for name in self.packages if predicate(name)]:
+            del self.packages[name]
+
+    def apply(self, *transforms):
+        '''
+        Run each transform(profile) in order.
+        '''
+        for transform in transforms:
+            transform(self)
+
+    def _sync_packages(self):
+        '''
+        Put the package set back into the package list file.
+        '''
+        self.write(PACKAGES, "".join(f"{name}\n" for name in self.packages))
+
+    def changes(self):
+        '''
+        Paths of the files that differ from what is on disk.
+        '''
+        self._sync_packages()
+        return sorted(path for path, content in self._files.items() if content != self._original.get(path))
+
+    def diff(self):
+        '''
+        A unified diff of everything flush() would change.
+        '''
+        lines = []
+        for relpath in self._removed:
+            lines.append(f"removed {relpath}\n")
+        for relpath in self._directories:
+            lines.append(f"directory {relpath}\n")
+        for relpath, target in sorted(self._links.items()):
+            lines.append(f"symlink {relpath} -> {target}\n")
+        for relpath in self.changes():
+            before = self._original.get(relpath, "")
+            after = self._files[relpath] or ""
+            lines.extend(difflib.unified_diff(before.splitlines(True), after.splitlines(True),
+                                              f"a/{relpath}", f"b/{relpath}"))
+        return "".join(lines)
+
+    def flush(self):
+        '''
+        Write every change to disk, each file replaced atomically, and return the changed paths.
+        '''
+        changed = self.changes()
+        for relpath in self._removed:
+            if os.path.isdir(self.path(relpath)) and not os.path.islink(self.path(relpath)):
+                shutil.rmtree(self.path(relpath))
+            elif os.path.lexists(self.path(relpath)):
+                os.remove(self.path(relpath))
+        for relpath in self._directories:
+            os.makedirs(self.path(relpath), exist_ok=True)
+
+        # Stage every file next to its destination first, then move them all into place
+        staged = []
+        for relpath in changed:
+            if self._files[relpath] is None:
+                continue
+            path = self.path(relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            mode = self._modes.get(relpath, os.stat(path).st_mode & 0o7777 if os.path.exists(path) else 0o644)
+            descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".releng-")
+            with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+                f.write(self._files[relpath])
+            os.chmod(temporary, mode)
+            staged.append((temporary, path))
+        for temporary, path in staged:
+            os.replace(temporary, path)
+
+        for relpath, target in self._links.items():
+            path = self.path(relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = os.path.join(os.path.dirname(path), f".releng-{os.path.basename(path)}")
+            os.symlink(target, temporary)
+            os.replace(temporary, path)
+        return changed + sorted(self._links)
+
+# End-of-file (EOF)
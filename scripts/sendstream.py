@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''
+Build a zfs send stream of the root filesystem to ship on the ISO next to the squashfs.
+
+The airootfs mkarchiso produced is copied into a dataset on a pool backed by a sparse
+file, created with the same dataset properties the installer uses, snapshotted and sent
+with compressed, large block records. The installer receives the stream into the new
+pool instead of extracting the squashfs file by file. Needs the zfs module on the build host.
+'''
+import os
+import shutil
+import subprocess
+import tempfile
+
+import incremental
+
+POOL = "maloneyos-build"
+AIROOTFS = os.path.join(incremental.WORK, "x86_64", "airootfs")
+STREAM = os.path.join(incremental.WORK, "iso", "arch", "x86_64", "airootfs.zfs")
+SNAPSHOT = "image"
+
+# Room for the copy on top of what the airootfs takes, the backing file is sparse
+HEADROOM = 2 * 1024 * 1024 * 1024
+
+def _size(path):
+    '''
+    Bytes used by a directory tree according to du.
+    '''
+    return int(subprocess.check_output(["du", "-sxb", path]).split()[0])
+
+def remove():
+    '''
+    Take the stream of an earlier build out of the ISO tree.
+    '''
+    if os.path.exists(STREAM):
+        os.remove(STREAM)
+
+def build(airootfs=AIROOTFS, output=STREAM, workdir=None):
+    '''
+    Copy airootfs into a scratch pool and write a send stream of it to output.
+    '''
+    workdir = tempfile.mkdtemp(prefix=f"{POOL}-", dir=workdir)
+    backing = os.path.join(workdir, "pool.img")
+    altroot = os.path.join(workdir, "root")
+    with open(backing, "wb") as f:
+        f.truncate(_size(airootfs) * 2 + HEADROOM)
+    subprocess.run(["zpool", "create", "-f", "-o", "ashift=12",
+                    "-O", "acltype=posixacl", "-O", "compression=zstd", "-O", "dnodesize=auto",
+                    "-O", "normalization=formD", "-O", "relatime=on", "-O", "xattr=sa",
+                    "-m", "none", "-R", altroot, POOL, backing], check=True)
+    try:
+        subprocess.run(["zfs", "create", "-o", "mountpoint=/", f"{POOL}/arch"], check=True)
+        subprocess.run(["cp", "-a", f"{airootfs}/.", altroot], check=True)
+        subprocess.run(["zfs", "snapshot", f"{POOL}/arch@{SNAPSHOT}"], check=True)
+        with open(f"{output}.part", "wb") as f:
+            subprocess.run(["zfs", "send", "--compressed", "--large-block", "--embed", f"{POOL}/arch@{SNAPSHOT}"], stdout=f, check=True)
+        os.replace(f"{output}.part", output)
+    finally:
+        subprocess.run(["zpool", "destroy", "-f", POOL], check=False)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"Send stream of {airootfs} written to {output}, {os.path.getsize(output) // (1024 * 1024)} MiB")
+
+# End-of-file (EOF)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+'''
+Squashfs compression profiles for the airootfs image and a benchmark to choose between them.
+
+bootstrap.py writes the options of the selected profile into airootfs_image_tool_options
+in profiledef.sh. The benchmark compresses the airootfs of the last build with every
+profile, then extracts each image with unsquashfs the way the installer does. It records
+the compression time, the image size, the resulting ISO size and the extraction throughput,
+next to the time of the last full build made with each profile.
+'''
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+import incremental
+import pkgcache
+
+# mksquashfs options per profile, release is what the stock releng profile uses
+PROFILES = {
+    "dev": ["-comp", "lz4", "-b", "1M"],
+    "balanced": ["-comp", "zstd", "-Xcompression-level", "15", "-b", "1M"],
+    "release": ["-comp", "xz", "-Xbcj", "x86", "-b", "1M", "-Xdict-size", "1M"],
+}
+DEFAULT = "release"
+
+# Output of the last build the benchmark works from
+WORKDIR = "/tmp/maloneyos"
+AIROOTFS = os.path.join(incremental.WORK, "x86_64", "airootfs")
+IMAGE = os.path.join(incremental.WORK, "iso", "arch", "x86_64", "airootfs.sfs")
+REPORT = os.path.join(pkgcache.CACHE_ROOT, "benchmarks", "compression.json")
+BUILDS = os.path.join(pkgcache.CACHE_ROOT, "benchmarks", "builds.json")
+
+def configure(profiledef, name):
+    '''
+    Return the text of a profiledef.sh with the image options of a compression profile.
+    '''
+    options = " ".join(f"'{option}'" for option in PROFILES[name])
+    return re.sub(r"^airootfs_image_tool_options=\(.*\)$", f"airootfs_image_tool_options=({options})",
+                  profiledef, flags=re.MULTILINE)
+
+def selected(profiledef):
+    '''
+    Name of the compression profile a profiledef.sh uses, None for options of its own.
+    '''
+    match = re.search(r"^airootfs_image_tool_options=\((.*)\)$", profiledef, flags=re.MULTILINE)
+    options = [option.strip("'\"") for option in match.group(1).split()] if match else []
+    return next((name for name, profile in PROFILES.items() if profile == options), None)
+
+def _load_builds():
+    '''
+    Earlier build records, newest last.
+    '''
+    try:
+        with open(BUILDS, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def record_build(releng, seconds):
+    '''
+    Remember how long a full build with the profile's compression took and how big its ISO is.
+    '''
+    with open(os.path.join(releng, "profiledef.sh"), encoding="utf-8") as f:
+        name = selected(f.read())
+    builds = _load_builds()
+    builds.append({"time": time.time(), "profile": name, "build_seconds": round(seconds, 3), "iso_bytes": _iso_size()})
+    os.makedirs(os.path.dirname(BUILDS), exist_ok=True)
+    with open(BUILDS, "w", encoding="utf-8") as f:
+        json.dump(builds[-100:], f, indent=2)
+    print(f"Built with {name or 'custom'} compression in {seconds:.0f}s")
+
+def _tree_bytes(path):
+    '''
+    Total size of the regular files below path.
+    '''
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            if not os.path.islink(os.path.join(dirpath, name)):
+                total += os.path.getsize(os.path.join(dirpath, name))
+    return total
+
+def _iso_size():
+    '''
+    Size of the ISO the last build produced, 0 if there is none.
+    '''
+    images = [os.path.join(WORKDIR, name) for name in os.listdir(WORKDIR) if name.endswith(".iso")] if os.path.isdir(WORKDIR) else []
+    return os.path.getsize(max(images, key=os.path.getmtime)) if images else 0
+
+def measure(name, airootfs, workdir):
+    '''
+    Compress airootfs with a profile and extract it again, returning the timings and sizes.
+    '''
+    image = os.path.join(workdir, f"{name}.sfs")
+    start = time.monotonic()
+    subprocess.run(["mksquashfs", airootfs, image, "-noappend", "-no-progress", "-quiet"] + PROFILES[name], check=True)
+    compress = time.monotonic() - start
+
+    target = os.path.join(workdir, f"{name}-extract")
+    start = time.monotonic()
+    subprocess.run(["unsquashfs", "-f", "-n", "-d", target, image], check=True)
+    extract = time.monotonic() - start
+    extracted = _tree_bytes(target)
+    shutil.rmtree(target)
+
+    size = os.path.getsize(image)
+    os.remove(image)
+    return {
+        "options": PROFILES[name],
+        "compress_seconds": round(compress, 3),
+        "image_bytes": size,
+        "extract_seconds": round(extract, 3),
+        "extract_bytes": extracted,
+        "extract_mib_per_second": round(extracted / extract / (1024 * 1024), 1) if extract else None,
+    }
+
+def benchmark(names, workdir):
+    '''
+    Measure every profile in names against the airootfs of the last build.
+    '''
+    if not os.path.isdir(AIROOTFS):
+        raise FileNotFoundError(f"No airootfs at {AIROOTFS}, build the image first")
+    # Everything in the ISO that is not the airootfs image stays the same between profiles
+    base = _iso_size() - os.path.getsize(IMAGE) if os.path.isfile(IMAGE) and _iso_size() else 0
+    results = {}
+    for name in names:
+        print(f"Benchmarking {name}: {' '.join(PROFILES[name])}", flush=True)
+        results[name] = measure(name, AIROOTFS, workdir)
+        results[name]["iso_bytes"] = base + results[name]["image_bytes"] if base else None
+        # Full build time is only known for profiles that were actually built with
+        builds = [build for build in _load_builds() if build["profile"] == name]
+        results[name]["build_seconds"] = builds[-1]["build_seconds"] if builds else None
+    return results
+
+def main():
+    '''
+    Benchmark the compression profiles and save the report.
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the squashfs compression profiles.")
+    parser.add_argument("--profile", action="append", choices=sorted(PROFILES), help="profile to measure, all when not given")
+    parser.add_argument("--workdir", default=None, help="scratch directory for the images, must hold the extracted airootfs")
+    parser.add_argument("--output", default=REPORT, help="where to write the JSON report")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="maloneyos-compression-", dir=args.workdir)
+    try:
+        results = benchmark(args.profile or list(PROFILES), workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'profile':<10} {'build':>8} {'compress':>9} {'image':>10} {'iso':>10} {'extract':>12}")
+    for name, result in results.items():
+        build = f"{result['build_seconds']:.0f}s" if result["build_seconds"] else "-"
+        iso = f"{result['iso_bytes'] // (1024 * 1024)}M" if result["iso_bytes"] else "-"
+        print(f"{name:<10} {build:>8} {result['compress_seconds']:8.1f}s {result['image_bytes'] // (1024 * 1024):9}M {iso:>10} "
+              f"{result['extract_mib_per_second'] or 0:8} MiB/s")
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"time": time.time(), "results": results}, f, indent=2)
+    print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    main()
+
+# End-of-file (EOF)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+'''
+Cache of the ZFS module DKMS builds, keyed by the linux-lts and zfs-dkms versions.
+
+Installing zfs-dkms makes DKMS compile the module inside mkarchiso on every build. After
+a build, harvest() packs what DKMS built in the airootfs into a package of its own and
+adds it to a local pacman repo. When the next build installs the same kernel and
+zfs-dkms versions, bootstrap.py adds that package next to zfs-dkms. Its files already
+sit in the DKMS tree when the DKMS hook runs, so DKMS finds the module built and only
+installs it. zfs-dkms stays installed so installed systems still build the module for
+new kernels. On a cache miss nothing changes and DKMS compiles as before.
+
+The versions are read from sync databases of the profile's repos, archzfs included, kept
+next to the cache and refreshed before every build. Offline builds read the databases the
+last refresh left. The package does not pin the versions it was built for, and the installer drops it from the
+pacman database of installed systems, so their DKMS tree belongs to DKMS alone again.
+'''
+import json
+import os
+import re
+import subprocess
+import tarfile
+import tempfile
+import time
+
+import footprint
+import incremental
+import pkgcache
+
+KERNEL = "linux-lts"
+DKMS_PACKAGE = "zfs-dkms"
+REPO_NAME = "maloneyos-zfs"
+REPO = os.path.join(pkgcache.CACHE_ROOT, "zfs-modules")
+INDEX = os.path.join(REPO, "index.json")
+
+# pacman database directory with the sync databases of the profile's repos
+SYNC_DBPATH = os.path.join(REPO, "db")
+AIROOTFS = os.path.join(incremental.WORK, "x86_64", "airootfs")
+
+# Where DKMS keeps the module source links and builds inside the airootfs
+DKMS_TREE = "var/lib/dkms/zfs"
+
+# Module builds to keep, one per kernel and zfs version pair
+KEEP_BUILDS = 3
+
+def package_name(kernel, zfs):
+    '''
+    Package name of the module built for a kernel and zfs-dkms version.
+    '''
+    return re.sub(r"[^A-Za-z0-9@._+-]", "_", f"zfs-dkms-built-{kernel}-{zfs}")
+
+def _index():
+    '''
+    Cached builds by package name.
+    '''
+    if not os.path.exists(INDEX):
+        return {}
+    with open(INDEX, encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_index(index):
+    '''
+    Write the index of cached builds.
+    '''
+    with open(f"{INDEX}.part", "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    os.replace(f"{INDEX}.part", INDEX)
+
+def refresh(pacman_conf, dbpath=SYNC_DBPATH):
+    '''
+    Download the sync databases of the repos in a pacman.conf, the ones from the last
+    refresh stay when that fails. Returns whether it worked.
+    '''
+    os.makedirs(dbpath, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="maloneyos-zfs-") as tmp:
+        conf = os.path.join(tmp, "pacman.conf")
+        with open(conf, "w", encoding="utf-8") as f:
+            f.write(pacman_conf)
+        try:
+            result = subprocess.run(["pacman", "--config", conf, "--dbpath", dbpath, "-Sy"], capture_output=True, text=True, check=False)
+        except OSError as e:
+            print(f"Cannot refresh the sync databases for the ZFS module cache: {e}")
+            return False
+    if result.returncode != 0:
+        print(f"Cannot refresh the sync databases for the ZFS module cache: {result.stderr.strip()}")
+    return result.returncode == 0
+
+def resolve(pacman_conf, dbpath=SYNC_DBPATH):
+    '''
+    Versions of the kernel and zfs-dkms the repos in a pacman.conf would install according
+    to the sync databases in dbpath, None when they have no entry for either.
+    '''
+    try:
+        packages = footprint.load(pacman_conf, dbpath)[0]
+    except (OSError, subprocess.CalledProcessError, tarfile.TarError):
+        return None
+    if KERNEL not in packages or DKMS_PACKAGE not in packages:
+        return None
+    return {KERNEL: packages[KERNEL]["version"], DKMS_PACKAGE: packages[DKMS_PACKAGE]["version"]}
+
+def lookup(pacman_conf, offline=False, dbpath=SYNC_DBPATH):
+    '''
+    Name of the cached module package for what a pacman.conf would install, None on a miss.
+    Offline the sync databases are not refreshed.
+    '''
+    if not offline:
+        refresh(pacman_conf, dbpath)
+    found = resolve(pacman_conf, dbpath)
+    if found is None:
+        return None
+    name = package_name(found[KERNEL], found[DKMS_PACKAGE])
+    return name if name in _index() else None
+
+def repo_section():
+    '''
+    pacman.conf section of the local repo with the cached module packages.
+    '''
+    return f"\n[{REPO_NAME}]\nSigLevel = Optional TrustAll\nServer = file://{REPO}\n"
+
+def _installed(airootfs, name):
+    '''
+    Installed version of a package in the airootfs, None when it is not installed.
+    '''
+    result = subprocess.run(["pacman", "--root", airootfs, "--dbpath", os.path.join(airootfs, "var/lib/pacman"), "-Q", name],
+                            capture_output=True, text=True, check=False)
+    return result.stdout.split()[1] if result.returncode == 0 else None
+
+def _pkginfo(name, kernel, zfs, size):
+    '''
+    The .PKGINFO of a module package.
+    '''
+    return (f"pkgname = {name}\npkgbase = {name}\npkgver = 1-1\n"
+            f"pkgdesc = ZFS module built by DKMS from {DKMS_PACKAGE} {zfs} for {KERNEL} {kernel}\n"
+            f"builddate = {int(time.time())}\npackager = MaloneyOS build\nsize = {size}\narch = x86_64\n"
+            f"depend = {KERNEL}\ndepend = {DKMS_PACKAGE}\n")
+
+def harvest(airootfs=AIROOTFS):
+    '''
+    Pack the module DKMS built in the airootfs into the cache when it is not there yet.
+    '''
+    kernel = _installed(airootfs, KERNEL)
+    zfs = _installed(airootfs, DKMS_PACKAGE)
+    if kernel is None or zfs is None:
+        return None
+    name = package_name(kernel, zfs)
+    index = _index()
+    if name in index:
+        print(f"ZFS module for {KERNEL} {kernel} and {DKMS_PACKAGE} {zfs} came from the cache")
+        return None
+
+    # The build directory of the installed kernel below the installed zfs version, the source
+    # and kernel-* links are DKMS's own and builds for other versions are left behind
+    builds = []
+    directory = os.path.join(airootfs, DKMS_TREE, zfs.rsplit("-", 1)[0])
+    if os.path.isdir(directory) and not os.path.islink(directory):
+        builds = [os.path.join(DKMS_TREE, os.path.basename(directory), build) for build in sorted(os.listdir(directory))
+                  if build.startswith(kernel) and os.path.isdir(os.path.join(directory, build))
+                  and not os.path.islink(os.path.join(directory, build))]
+    if not builds:
+        return None
+
+    os.makedirs(REPO, exist_ok=True)
+    filename = f"{name}-1-1-x86_64.pkg.tar.zst"
+    size = sum(os.path.getsize(os.path.join(dirpath, file)) for build in builds
+               for dirpath, _, files in os.walk(os.path.join(airootfs, build)) for file in files)
+    with tempfile.TemporaryDirectory(prefix="maloneyos-zfs-") as staging:
+        with open(os.path.join(staging, ".PKGINFO"), "w", encoding="utf-8") as f:
+            f.write(_pkginfo(name, kernel, zfs, size))
+        with tarfile.open(os.path.join(staging, "package.tar"), "w") as tar:
+            tar.add(os.path.join(staging, ".PKGINFO"), ".PKGINFO")
+            for build in builds:
+                tar.add(os.path.join(airootfs, build), build)
+        with open(os.path.join(REPO, f"{filename}.part"), "wb") as f:
+            subprocess.run(["zstd", "-q", "-c", "-T0", os.path.join(staging, "package.tar")], stdout=f, check=True)
+    os.replace(os.path.join(REPO, f"{filename}.part"), os.path.join(REPO, filename))
+    subprocess.run(["repo-add", "-q", os.path.join(REPO, f"{REPO_NAME}.db.tar.gz"), os.path.join(REPO, filename)], check=True)
+
+    index[name] = {"kernel": kernel, "zfs": zfs, "file": filename, "built": int(time.time())}
+    _save_index(evict(index))
+    print(f"Cached the ZFS module for {KERNEL} {kernel} and {DKMS_PACKAGE} {zfs} as {name}")
+    return name
+
+def evict(index, keep=KEEP_BUILDS):
+    '''
+    Drop all but the newest module builds from the repo and return the index of the rest.
+    '''
+    newest = sorted(index, key=lambda name: index[name]["built"], reverse=True)
+    for name in newest[keep:]:
+        subprocess.run(["repo-remove", "-q", os.path.join(REPO, f"{REPO_NAME}.db.tar.gz"), name], check=False)
+        path = os.path.join(REPO, index[name]["file"])
+        if os.path.exists(path):
+            os.remove(path)
+    return {name: index[name] for name in newest[:keep]}
+
+# End-of-file (EOF)
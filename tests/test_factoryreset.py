@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+'''
+Tests of maloneyos-reset against a small in-memory model of the ZFS commands it runs.
+
+The model knows clones, promotion, holds and user properties well enough to refuse a
+zfs destroy -r the way ZFS does while a clone or a hold depends on a snapshot.
+'''
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "installer"))
+
+import factoryreset  # pylint: disable=wrong-import-position
+
+POOL = "zroot"
+PARENT = f"{POOL}/ROOT"
+
+class FakeZfs:
+    '''
+    Datasets with their origin and snapshots in creation order, snapshots with their holds.
+    '''
+    def __init__(self):
+        self.origins = {PARENT: None, f"{PARENT}/arch": None}
+        self.snapshots = {PARENT: [], f"{PARENT}/arch": ["factory"]}
+        self.holds = {f"{PARENT}/arch@factory": {"maloneyos-factory"}}
+        self.properties = {(PARENT, factoryreset.FACTORY_PROPERTY): f"{PARENT}/arch@factory"}
+        self.root = f"{PARENT}/arch"
+        self.bootfs = self.root
+
+    def fail(self, args):
+        '''
+        The error a failing command raises.
+        '''
+        raise subprocess.CalledProcessError(1, args)
+
+    def check_output(self, args, **_):
+        '''
+        Stand-in for subprocess.check_output.
+        '''
+        if args[0] == "findmnt":
+            return f"{self.root}\n"
+        if args[:2] == ["zfs", "get"]:
+            return self.properties.get((args[-1], args[-2]), "-") + "\n"
+        return self.fail(args)
+
+    def run(self, args, **_):
+        '''
+        Stand-in for subprocess.run.
+        '''
+        if args[:2] == ["zfs", "clone"]:
+            self.clone(args[-2], args[-1])
+        elif args[:2] == ["zfs", "promote"]:
+            self.promote(args[-1])
+        elif args[:2] == ["zfs", "set"]:
+            prop, value = args[2].split("=", 1)
+            self.properties[(args[3], prop)] = value
+        elif args[:2] == ["zfs", "destroy"] and args[2] == "-r":
+            self.destroy(args[3], args)
+        elif args[:2] == ["zpool", "set"] and args[2].startswith("bootfs="):
+            self.bootfs = args[2].split("=", 1)[1]
+        else:
+            self.fail(args)
+        return subprocess.CompletedProcess(args, 0)
+
+    def clone(self, snapshot, dataset):
+        '''
+        zfs clone
+        '''
+        origin, name = snapshot.split("@")
+        if name not in self.snapshots.get(origin, []) or dataset in self.origins:
+            self.fail(["zfs", "clone", snapshot, dataset])
+        self.origins[dataset] = snapshot
+        self.snapshots[dataset] = []
+
+    def promote(self, dataset):
+        '''
+        zfs promote, the snapshots of the origin up to the cloned one move to the clone.
+        '''
+        snapshot = self.origins[dataset]
+        if snapshot is None:
+            self.fail(["zfs", "promote", dataset])
+        origin, name = snapshot.split("@")
+        moved = self.snapshots[origin][:self.snapshots[origin].index(name) + 1]
+        self.snapshots[origin] = self.snapshots[origin][len(moved):]
+        self.snapshots[dataset] = moved + self.snapshots[dataset]
+        for short in moved:
+            if f"{origin}@{short}" in self.holds:
+                self.holds[f"{dataset}@{short}"] = self.holds.pop(f"{origin}@{short}")
+            for clone, source in self.origins.items():
+                if source == f"{origin}@{short}":
+                    self.origins[clone] = f"{dataset}@{short}"
+        self.origins[dataset] = self.origins[origin]
+        self.origins[origin] = f"{dataset}@{name}"
+
+    def destroy(self, dataset, args):
+        '''
+        zfs destroy -r, refused while a snapshot of the dataset has clones or holds.
+        '''
+        for short in self.snapshots[dataset]:
+            snapshot = f"{dataset}@{short}"
+            if self.holds.get(snapshot) or snapshot in self.origins.values():
+                self.fail(args)
+        del self.origins[dataset]
+        del self.snapshots[dataset]
+
+    def boot(self):
+        '''
+        Reboot into the pool's bootfs.
+        '''
+        self.root = self.bootfs
+
+    def factory(self):
+        '''
+        The recorded factory snapshot, checking that it exists and is still held.
+        '''
+        snapshot = self.properties[(PARENT, factoryreset.FACTORY_PROPERTY)]
+        dataset, name = snapshot.split("@")
+        assert name in self.snapshots[dataset], f"{snapshot} does not exist"
+        assert self.holds.get(snapshot), f"{snapshot} is not held"
+        return snapshot
+
+class ResetTest(unittest.TestCase):
+    '''
+    Resetting, booting the new boot environment and destroying the old one, repeatedly.
+    '''
+    def setUp(self):
+        self.zfs = FakeZfs()
+        patcher = mock.patch.multiple(factoryreset.subprocess, check_output=self.zfs.check_output, run=self.zfs.run)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reset(self, name):
+        '''
+        Reset to a boot environment called name and boot it.
+        '''
+        old, new = factoryreset.reset(name)
+        self.assertEqual(new, f"{PARENT}/{name}")
+        self.assertEqual(self.zfs.bootfs, new)
+        self.zfs.boot()
+        return old
+
+    def test_first_reset(self):
+        '''
+        The boot environment the installer made can be destroyed after a reset.
+        '''
+        old = self.reset("one")
+        self.assertEqual(self.zfs.factory(), f"{PARENT}/one@factory")
+        subprocess.run(["zfs", "destroy", "-r", old], check=True)
+        self.assertNotIn(old, self.zfs.origins)
+
+    def test_second_reset(self):
+        '''
+        A boot environment made by an earlier reset can be destroyed after the next one.
+        '''
+        first = self.reset("one")
+        second = self.reset("two")
+        self.assertEqual(second, f"{PARENT}/one")
+        self.assertEqual(self.zfs.factory(), f"{PARENT}/two@factory")
+
+        # Both earlier boot environments go away with the command the tool prints
+        subprocess.run(["zfs", "destroy", "-r", second], check=True)
+        subprocess.run(["zfs", "destroy", "-r", first], check=True)
+        self.reset("three")
+        self.assertEqual(self.zfs.factory(), f"{PARENT}/three@factory")
+        subprocess.run(["zfs", "destroy", "-r", f"{PARENT}/two"], check=True)
+
+    def test_dry_run(self):
+        '''
+        A dry run changes nothing.
+        '''
+        with mock.patch.object(factoryreset.subprocess, "run") as run:
+            factoryreset.reset("one", dry_run=True)
+        run.assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
+
+# End-of-file (EOF)
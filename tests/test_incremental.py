@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+'''
+Tests of the stamps incremental.py drops from an mkarchiso work dir before a build.
+
+The work dir holds the stamps an mkarchiso iso build leaves behind: the stages every build
+mode shares under base, the ISO image under iso, next to the directories of the build.
+'''
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+
+import incremental  # pylint: disable=wrong-import-position
+
+STAMPS = [
+    "base._make_pacman_conf",
+    "base._make_custom_airootfs",
+    "base._make_packages",
+    "base._make_version",
+    "base._make_customize_airootfs",
+    "base._make_pkglist",
+    "base._cleanup_pacstrap_dir",
+    "base._prepare_airootfs_image",
+    "iso._build_iso_image",
+]
+DIRECTORIES = ["x86_64", "iso", "efiboot"]
+
+class ResetStagesTest(unittest.TestCase):
+    '''
+    What a relayer build and an image only rebuild leave of a finished work dir.
+    '''
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        self.work = directory.name
+        for name in STAMPS:
+            with open(os.path.join(self.work, name), "w", encoding="utf-8"):
+                pass
+        for name in DIRECTORIES:
+            os.mkdir(os.path.join(self.work, name))
+
+    def left(self):
+        '''
+        Stamps still in the work dir.
+        '''
+        return sorted(name for name in os.listdir(self.work) if name not in DIRECTORIES)
+
+    def test_relayer_keeps_only_the_packages(self):
+        '''
+        A relayer build runs every stage after the package install again.
+        '''
+        incremental._reset_stages(self.work, lambda stage: stage not in incremental.PACKAGE_STAGES)  # pylint: disable=protected-access
+        self.assertEqual(self.left(), ["base._make_packages", "base._make_pacman_conf"])
+
+    def test_reset_image(self):
+        '''
+        An image only rebuild keeps the airootfs and the squashfs.
+        '''
+        incremental.reset_image(self.work)
+        self.assertEqual(self.left(), sorted(STAMPS[:-1]))
+
+if __name__ == "__main__":
+    unittest.main()
+
+# End-of-file (EOF)
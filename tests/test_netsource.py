@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+'''
+Tests of the install server client against local HTTP servers.
+
+The ISO tree holds an image that is not a multiple of the chunk size, the manifest is
+written into the tree, and it is served both by RangeHandler and by the plain
+http.server handler that ignores range requests.
+'''
+import functools
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "installer"))
+
+import netsource  # pylint: disable=wrong-import-position
+
+CHUNK_SIZE = 1000
+IMAGE_SIZE = 4 * CHUNK_SIZE + 123
+
+class QuietRangeHandler(netsource.RangeHandler):
+    '''
+    RangeHandler without a log line per request.
+    '''
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+class QuietPlainHandler(http.server.SimpleHTTPRequestHandler):
+    '''
+    The plain http.server handler, which answers range requests with the whole file.
+    '''
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+class FlakyRangeHandler(QuietRangeHandler):
+    '''
+    Answers the first request for the second chunk with garbage of the right length.
+    '''
+    failed = []
+
+    def do_GET(self):
+        if self.headers.get("Range", "").startswith(f"bytes={CHUNK_SIZE}-") and not self.failed:
+            self.failed.append(self.path)
+            self.send_response(206)
+            self.send_header("Content-Length", str(CHUNK_SIZE))
+            self.end_headers()
+            self.wfile.write(b"\0" * CHUNK_SIZE)
+            return
+        super().do_GET()
+
+class SourceTest(unittest.TestCase):
+    '''
+    Fetching the image in chunks, reassembled in order and checked against the manifest.
+    '''
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.image = os.urandom(IMAGE_SIZE)
+        os.makedirs(os.path.join(self.root, os.path.dirname(netsource.IMAGE)))
+        with open(os.path.join(self.root, netsource.IMAGE), "wb") as f:
+            f.write(self.image)
+        with open(os.path.join(self.root, netsource.MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(netsource.build_manifest(self.root, chunk_size=CHUNK_SIZE), f)
+
+        # Retries back off in seconds, not worth waiting for here
+        patcher = mock.patch.object(netsource.time, "sleep")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def serve(self, handler):
+        '''
+        Serve the tree on a free port with a handler and return a Source reading from it.
+        '''
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler, directory=self.root))
+        server.manifest = None
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return netsource.Source(f"http://127.0.0.1:{server.server_address[1]}", connections=2)
+
+    def corrupt(self, index):
+        '''
+        Change one byte of a chunk of the image on the server.
+        '''
+        with open(os.path.join(self.root, netsource.IMAGE), "r+b") as f:
+            f.seek(index * CHUNK_SIZE)
+            f.write(bytes([self.image[index * CHUNK_SIZE] ^ 0xff]))
+
+    def read(self, source, size):
+        '''
+        The image read from the server size bytes at a time.
+        '''
+        reader = source.open(netsource.IMAGE)
+        parts = []
+        while True:
+            data = reader.read(size)
+            if not data:
+                return b"".join(parts)
+            parts.append(data)
+
+    def test_ranges(self):
+        '''
+        A server with range support is read over several connections in order.
+        '''
+        source = self.serve(QuietRangeHandler)
+        self.assertTrue(source.ranges)
+        self.assertEqual(source.size(netsource.IMAGE), IMAGE_SIZE)
+        for size in (-1, 1, 777, CHUNK_SIZE, 3 * CHUNK_SIZE + 1):
+            self.assertEqual(self.read(source, size), self.image, f"read({size})")
+
+    def test_without_ranges(self):
+        '''
+        A server ignoring ranges is read as one download that is still checked chunk by chunk.
+        '''
+        source = self.serve(QuietPlainHandler)
+        self.assertFalse(source.ranges)
+        for size in (-1, 777, CHUNK_SIZE):
+            self.assertEqual(self.read(source, size), self.image, f"read({size})")
+
+    def test_download(self):
+        '''
+        A download ends up complete at its path without a partial file next to it.
+        '''
+        source = self.serve(QuietRangeHandler)
+        path = os.path.join(self.root, "out", "image")
+        progress = source.download(netsource.IMAGE, path)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.image)
+        self.assertEqual(progress.bytes, IMAGE_SIZE)
+        self.assertFalse(os.path.exists(f"{path}.part"))
+
+    def test_bad_chunk_is_fetched_again(self):
+        '''
+        A chunk that arrives damaged once is fetched again and the file comes out right.
+        '''
+        FlakyRangeHandler.failed = []
+        source = self.serve(FlakyRangeHandler)
+        self.assertEqual(self.read(source, -1), self.image)
+        self.assertEqual(len(FlakyRangeHandler.failed), 1)
+
+    def test_corrupt_chunk_with_ranges(self):
+        '''
+        A chunk that never matches the manifest fails the download after the retries.
+        '''
+        source = self.serve(QuietRangeHandler)
+        self.corrupt(2)
+        path = os.path.join(self.root, "out", "image")
+        with self.assertRaisesRegex(netsource.NetSourceError, "chunk 2"):
+            source.download(netsource.IMAGE, path)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(f"{path}.part"))
+
+    def test_corrupt_chunk_without_ranges(self):
+        '''
+        A damaged chunk of a single download fails it.
+        '''
+        source = self.serve(QuietPlainHandler)
+        self.corrupt(4)
+        with self.assertRaisesRegex(netsource.NetSourceError, "Chunk 4"):
+            self.read(source, -1)
+
+    def test_missing_file(self):
+        '''
+        A file the manifest does not list is reported by name.
+        '''
+        source = self.serve(QuietRangeHandler)
+        self.assertFalse(source.has(netsource.STREAM))
+        with self.assertRaisesRegex(netsource.NetSourceError, netsource.STREAM):
+            source.size(netsource.STREAM)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# End-of-file (EOF)